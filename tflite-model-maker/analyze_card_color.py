@@ -4,9 +4,101 @@ import cv2
 import numpy as np
 
 from card_model import Card
+from instrumentation import instrumented
 from predict_utils import target_to_image_names
 
 
+# HSV color ranges (inclusive lower and upper bounds) for red, green, and purple
+# These ranges might need fine-tuning based on your specific card colors and lighting
+COLOR_RANGES = {
+    'r': [((0, 100, 100), (10, 255, 255)), ((167, 100, 100), (180, 255, 255))],
+    'g': [((30, 50, 30), (90, 255, 255))],
+    'p': [((110, 35, 20), (165, 255, 255))],
+}
+COLOR_THRESHOLD_PERCENTAGE = 0.01  # Minimum percentage of card area for a color to be considered
+
+
+class ColorClassifier:
+    """
+    Classifies the pixels of HSV images by color, using precomputed lookup tables.
+
+    Every range is a box in HSV space, so whether a pixel falls in a range is the AND of three per-channel tests.
+    The classifier precomputes, for each channel, a 256-entry table with one bit per range, and labels every pixel
+    with the AND of its three table lookups. A pixel histogram over those labels then gives the pixel count of each
+    color, where a color counts a pixel if any of its ranges contains it.
+    """
+
+    def __init__(self, color_ranges=None, threshold_percentage=COLOR_THRESHOLD_PERCENTAGE):
+        """
+        Args:
+            color_ranges (dict): Maps each color to a list of (lower, upper) HSV bounds. Defaults to `COLOR_RANGES`.
+            threshold_percentage (float): Minimum fraction of the card area for a color to be considered.
+        """
+        self.color_ranges = COLOR_RANGES if color_ranges is None else color_ranges
+        self.colors = list(self.color_ranges)
+        self.threshold_percentage = threshold_percentage
+
+        ranges = [(color, lower, upper) for color in self.colors for lower, upper in self.color_ranges[color]]
+        if len(ranges) > 8:
+            raise ValueError(f'At most 8 color ranges are supported, got [{len(ranges)}]')
+
+        values = np.arange(256)
+        self._channel_luts = np.zeros((3, 256), dtype=np.uint8)
+        # _label_colors[label, c] is 1 if a pixel with that label belongs to color c
+        self._label_colors = np.zeros((256, len(self.colors)), dtype=np.int64)
+        labels = np.arange(256)
+        for bit, (color, lower, upper) in enumerate(ranges):
+            for channel in range(3):
+                in_range = (lower[channel] <= values) & (values <= upper[channel])
+                self._channel_luts[channel] |= in_range.astype(np.uint8) << bit
+            self._label_colors[(labels >> bit) & 1 == 1, self.colors.index(color)] = 1
+
+    def label(self, hsv_image):
+        """Returns the label (a bit mask of the ranges containing the pixel) of every pixel of an 8-bit HSV image"""
+        h, s, v = cv2.split(hsv_image)
+        return cv2.bitwise_and(cv2.bitwise_and(cv2.LUT(h, self._channel_luts[0]), cv2.LUT(s, self._channel_luts[1])),
+                               cv2.LUT(v, self._channel_luts[2]))
+
+    def histograms(self, hsv_images):
+        """
+        Counts, for each image, the pixels of each color.
+
+        Args:
+            hsv_images (list): 8-bit HSV images, e.g. card crops of different sizes.
+
+        Returns:
+            numpy.ndarray: A (len(hsv_images), len(self.colors)) array of pixel counts.
+        """
+        label_counts = np.zeros((len(hsv_images), 256), dtype=np.int64)
+        for i, hsv_image in enumerate(hsv_images):
+            label_counts[i] = cv2.calcHist([self.label(hsv_image)], [0], None, [256], [0, 256]).ravel()
+        return label_counts @ self._label_colors
+
+    def analyze(self, hsv_images):
+        """Returns the detected colors (see `analyze_card_color`) of each of the 8-bit HSV images"""
+        results = []
+        for hsv_image, counts in zip(hsv_images, self.histograms(hsv_images)):
+            height, width = hsv_image.shape[:2]
+            detected_colors = []
+            for color, color_pixel_count in zip(self.colors, counts.tolist()):
+                if color_pixel_count > (height * width * self.threshold_percentage):
+                    detected_colors.append({'color': color, 'count': color_pixel_count / (height * width) * 100})
+            detected_colors.sort(key=lambda x: x['count'], reverse=True)
+            results.append(detected_colors)
+        return results
+
+
+_default_classifier = None
+
+
+def default_classifier():
+    """Returns the classifier with the default color ranges"""
+    global _default_classifier
+    if _default_classifier is None:
+        _default_classifier = ColorClassifier()
+    return _default_classifier
+
+
 def analyze_card_color(card_image):
     """
     Analyzes the colors present in the shapes of a card image.
@@ -19,37 +111,26 @@ def analyze_card_color(card_image):
               Returns an empty list if no dominant shape color is found.
     """
 
-    hsv_image = cv2.cvtColor(card_image, cv2.COLOR_BGR2HSV)
-    height, width, _ = card_image.shape
-
-    # Define HSV color ranges for red, green, and purple
-    # These ranges might need fine-tuning based on your specific card colors and lighting
-    lower_red = np.array([0, 100, 100])
-    upper_red = np.array([10, 255, 255])
-    lower_red2 = np.array([167, 100, 100])
-    upper_red2 = np.array([180, 255, 255])
-    lower_green = np.array([30, 50, 30])
-    upper_green = np.array([90, 255, 255])
-    lower_purple = np.array([110, 35, 20])
-    upper_purple = np.array([165, 255, 255])
-
-    color_masks = {
-        'r': cv2.inRange(hsv_image, lower_red, upper_red) + cv2.inRange(hsv_image, lower_red2, upper_red2),
-        'g': cv2.inRange(hsv_image, lower_green, upper_green),
-        'p': cv2.inRange(hsv_image, lower_purple, upper_purple)
-    }
-
-    detected_colors = []
-    color_threshold_percentage = 0.01  # Minimum percentage of card area for a color to be considered
-
-    for color, mask in color_masks.items():
-        color_pixel_count = cv2.countNonZero(mask)
-        if color_pixel_count > (height * width * color_threshold_percentage):
-            detected_colors.append({'color': color, 'count': color_pixel_count / (height * width) * 100})
-
-    detected_colors.sort(key=lambda x: x['count'], reverse=True)
-
-    return detected_colors
+    return analyze_card_color_hsv(cv2.cvtColor(card_image, cv2.COLOR_BGR2HSV))
+
+
+@instrumented('analyze_card_color', counts=lambda result, *_, **__: {'colors': len(result)})
+def analyze_card_color_hsv(hsv_image):
+    """
+    Analyzes the colors present in the shapes of a card image that has already been converted to HSV.
+
+    Args:
+        hsv_image (numpy.ndarray): The image of a single card, in the (8-bit) HSV color space.
+
+    Returns:
+        list: See `analyze_card_color`.
+    """
+    return default_classifier().analyze([hsv_image])[0]
+
+
+def analyze_card_colors(card_images):
+    """Analyzes the colors of a batch of card images at once, returning a list like `analyze_card_color` per card"""
+    return default_classifier().analyze([cv2.cvtColor(card_image, cv2.COLOR_BGR2HSV) for card_image in card_images])
 
 
 if __name__ == '__main__':
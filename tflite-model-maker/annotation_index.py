@@ -0,0 +1,281 @@
+"""
+An index of the Pascal VOC annotations of a dataset, so that dataset statistics do not need to parse every
+annotation again.
+
+The annotations (the image they belong to, its size, and the label and box of every object) are stored in SQLite.
+Updating the index only parses the annotation files whose modification time or size changed since the last update,
+and drops the ones that were removed, so after the first run an update of tens of thousands of annotations takes
+about as long as listing the directory. Annotation files that cannot be parsed are reported and left out of the index.
+
+Usage:
+    python annotation_index.py data-cards counts
+    python annotation_index.py data-shapes sizes --bins 8 --label oval-empty
+    python annotation_index.py data-shapes images --label oval-empty
+    python annotation_index.py data-cards orphans
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+import voc
+
+DEFAULT_PATH = os.path.join('.cache', 'annotations.sqlite')
+QUERIES = ('update', 'counts', 'sizes', 'images', 'orphans')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    image TEXT,
+    width INTEGER,
+    height INTEGER,
+    UNIQUE (dataset, name)
+);
+CREATE TABLE IF NOT EXISTS objects (
+    annotation_id INTEGER NOT NULL REFERENCES annotations (id) ON DELETE CASCADE,
+    label TEXT NOT NULL,
+    xmin REAL NOT NULL,
+    ymin REAL NOT NULL,
+    xmax REAL NOT NULL,
+    ymax REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_annotation ON objects (annotation_id);
+CREATE INDEX IF NOT EXISTS objects_label ON objects (label);
+'''
+
+
+class AnnotationIndex:
+    """
+    A SQLite backed index of the annotations of one or more datasets, each a directory with 'Annotations' and
+    'images' folders.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA foreign_keys=ON')
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    @staticmethod
+    def _dataset_key(dataset_dir: str) -> str:
+        return os.path.abspath(dataset_dir)
+
+    def update(self, dataset_dir: str) -> dict:
+        """
+        Brings the index of a dataset up to date with its 'Annotations' folder, parsing only the annotation files that
+        were added or changed (by modification time and size) since the last update. Annotation files that cannot be
+        parsed are left out of the index (their previous version too), the others are still indexed.
+
+        Returns:
+            dict: The number of annotations 'added', 'updated', 'removed', 'unchanged' and 'invalid', and the 'errors'
+                  of the invalid annotation files, by file name.
+        """
+        dataset = self._dataset_key(dataset_dir)
+        annotations_dir = os.path.join(dataset_dir, 'Annotations')
+        indexed = {name: (annotation_id, mtime_ns, size) for annotation_id, name, mtime_ns, size in
+                   self._connection.execute('SELECT id, name, mtime_ns, size FROM annotations WHERE dataset = ?',
+                                            (dataset,))}
+
+        stats = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'invalid': 0, 'errors': {}}
+        with os.scandir(annotations_dir) as entries:
+            files = {os.path.splitext(entry.name)[0]: entry.stat() for entry in entries
+                     if entry.name.endswith('.xml') and entry.is_file()}
+
+        self._connection.execute('BEGIN')
+        try:
+            for name, stat in files.items():
+                previous = indexed.get(name)
+                if previous is not None and previous[1:] == (stat.st_mtime_ns, stat.st_size):
+                    stats['unchanged'] += 1
+                    continue
+                if previous is not None:
+                    self._connection.execute('DELETE FROM annotations WHERE id = ?', (previous[0],))
+                try:
+                    annotation = voc.parse_annotation(os.path.join(annotations_dir, f'{name}.xml'))
+                except (ET.ParseError, ValueError, TypeError, AttributeError, OSError) as e:
+                    stats['invalid'] += 1
+                    stats['errors'][f'{name}.xml'] = f'{type(e).__name__}: {e}'
+                    continue
+                annotation_id = self._connection.execute(
+                    'INSERT INTO annotations (dataset, name, mtime_ns, size, image, width, height) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (dataset, name, stat.st_mtime_ns, stat.st_size, annotation['filename'], annotation['width'],
+                     annotation['height'])).lastrowid
+                self._connection.executemany(
+                    'INSERT INTO objects (annotation_id, label, xmin, ymin, xmax, ymax) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(annotation_id, obj['label'], *obj['box']) for obj in annotation['objects']])
+                stats['updated' if previous is not None else 'added'] += 1
+
+            removed = [(annotation_id,) for name, (annotation_id, _, _) in indexed.items() if name not in files]
+            self._connection.executemany('DELETE FROM annotations WHERE id = ?', removed)
+            stats['removed'] = len(removed)
+            self._connection.execute('COMMIT')
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        return stats
+
+    def class_counts(self, dataset_dir: str) -> dict:
+        """
+        Returns:
+            dict: Per label (sorted), the number of 'objects' with the label and of 'images' with at least one of them.
+        """
+        rows = self._connection.execute(
+            'SELECT label, COUNT(*), COUNT(DISTINCT annotation_id) FROM objects JOIN annotations ON id = annotation_id '
+            'WHERE dataset = ? GROUP BY label ORDER BY label', (self._dataset_key(dataset_dir),))
+        return {label: {'objects': objects, 'images': images} for label, objects, images in rows}
+
+    def box_sizes(self, dataset_dir: str, label: str = None, relative: bool = False):
+        """
+        Returns the size of every object box, as the square root of its area: in pixels, or relative to the image
+        (the square root of the fraction of the image it covers). Boxes of images without a known size are left out
+        when relative.
+
+        Returns:
+            numpy.ndarray: The sizes, in no particular order.
+        """
+        query = 'SELECT xmax - xmin, ymax - ymin, width, height FROM objects JOIN annotations ON id = annotation_id ' \
+                'WHERE dataset = ?'
+        parameters = [self._dataset_key(dataset_dir)]
+        if label is not None:
+            query += ' AND label = ?'
+            parameters.append(label)
+        if relative:
+            query += ' AND width > 0 AND height > 0'
+        rows = np.array(self._connection.execute(query, parameters).fetchall(), dtype=np.float64).reshape(-1, 4)
+        sizes = np.sqrt(np.clip(rows[:, 0], 0, None) * np.clip(rows[:, 1], 0, None))
+        if relative:
+            sizes /= np.sqrt(rows[:, 2] * rows[:, 3])
+        return sizes
+
+    def box_size_histogram(self, dataset_dir: str, bins=10, label: str = None, relative: bool = False) -> dict:
+        """
+        Returns a histogram of the box sizes (see `box_sizes`).
+
+        Args:
+            bins (int|list): Number of equal width bins, or the bin edges, like for `numpy.histogram`.
+
+        Returns:
+            dict: The bin 'edges' and the 'counts' per bin.
+        """
+        counts, edges = np.histogram(self.box_sizes(dataset_dir, label, relative), bins=bins)
+        return {'edges': [round(float(edge), 5) for edge in edges], 'counts': counts.tolist()}
+
+    def images_with_label(self, dataset_dir: str, label: str) -> list:
+        """Returns the (sorted) names of the annotations with at least one object with the label"""
+        return [name for name, in self._connection.execute(
+            'SELECT DISTINCT name FROM annotations JOIN objects ON id = annotation_id WHERE dataset = ? AND label = ? '
+            'ORDER BY name', (self._dataset_key(dataset_dir), label))]
+
+    def images_per_label(self, dataset_dir: str) -> dict:
+        """Returns the (sorted) names of the annotations with at least one object with a label, per label"""
+        images = {}
+        for label, name in self._connection.execute(
+                'SELECT DISTINCT label, name FROM annotations JOIN objects ON id = annotation_id WHERE dataset = ? '
+                'ORDER BY label, name', (self._dataset_key(dataset_dir),)):
+            images.setdefault(label, []).append(name)
+        return images
+
+    def orphans(self, dataset_dir: str) -> dict:
+        """
+        Finds the images without annotation and the annotations without image. An annotation belongs to the image
+        named in it, or else to the image with the same name.
+
+        Returns:
+            dict: The (sorted) 'images' without annotation, the 'annotations' without image (both file names) and the
+                  'empty' annotations, without any objects.
+        """
+        dataset = self._dataset_key(dataset_dir)
+        images_dir = os.path.join(dataset_dir, 'images')
+        with os.scandir(images_dir) as entries:
+            images = {entry.name for entry in entries if entry.is_file()}
+        images_by_stem = {os.path.splitext(image)[0]: image for image in images}
+
+        annotated = set()
+        missing = []
+        for name, image in self._connection.execute('SELECT name, image FROM annotations WHERE dataset = ?',
+                                                    (dataset,)):
+            if image not in images:
+                image = images_by_stem.get(name)
+            if image is None:
+                missing.append(f'{name}.xml')
+            else:
+                annotated.add(image)
+        empty = [f'{name}.xml' for name, in self._connection.execute(
+            'SELECT name FROM annotations WHERE dataset = ? AND NOT EXISTS '
+            '(SELECT 1 FROM objects WHERE annotation_id = id) ORDER BY name', (dataset,))]
+        return {'images': sorted(images - annotated), 'annotations': sorted(missing), 'empty': empty}
+
+
+def _print_result(query: str, result):
+    if query == 'update':
+        print(', '.join(f'{count} {stat}' for stat, count in result.items() if stat != 'errors'))
+    elif query == 'counts':
+        for label, counts in result.items():
+            print(f'{label:>20} {counts["objects"]:8d} objects {counts["images"]:8d} images')
+    elif query == 'sizes':
+        for start, end, count in zip(result['edges'], result['edges'][1:], result['counts']):
+            print(f'{start:10.3f} - {end:10.3f} {count:8d}')
+    elif query == 'images':
+        for label, names in result.items():
+            print(f'{label} ({len(names)}): {" ".join(names)}')
+    elif query == 'orphans':
+        print(f'{len(result["images"])} images without annotation: {" ".join(result["images"])}')
+        print(f'{len(result["annotations"])} annotations without image: {" ".join(result["annotations"])}')
+        print(f'{len(result["empty"])} annotations without objects: {" ".join(result["empty"])}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the Pascal VOC annotations of a dataset and query them.')
+    parser.add_argument('dataset', help='a directory containing images and Annotations (e.g. data-cards)')
+    parser.add_argument('query', nargs='?', choices=QUERIES, default='update',
+                        help='update the index only, or also count the objects and images per label, show a histogram '
+                             'of the box sizes, list the images per label, or list the orphaned images and '
+                             'annotations (default: update)')
+    parser.add_argument('--label', help='only the objects with this label (sizes and images)')
+    parser.add_argument('--bins', type=int, default=10, help='number of histogram bins (default: 10)')
+    parser.add_argument('--relative', action='store_true', help='box sizes relative to the image size')
+    parser.add_argument('--index', default=DEFAULT_PATH, help=f'the index database (default: {DEFAULT_PATH})')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args()
+
+    with AnnotationIndex(args.index) as index:
+        update_stats = index.update(args.dataset)
+        for invalid_name, invalid_error in update_stats['errors'].items():
+            print(f'Skipped {invalid_name}: {invalid_error}', file=sys.stderr)
+        if args.query == 'update':
+            result = update_stats
+        elif args.query == 'counts':
+            result = index.class_counts(args.dataset)
+        elif args.query == 'sizes':
+            result = index.box_size_histogram(args.dataset, args.bins, args.label, args.relative)
+        elif args.query == 'images':
+            result = {args.label: index.images_with_label(args.dataset, args.label)} if args.label \
+                else index.images_per_label(args.dataset)
+        else:
+            result = index.orphans(args.dataset)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        _print_result(args.query, result)
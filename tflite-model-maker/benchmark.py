@@ -0,0 +1,296 @@
+"""
+Benchmarks the stages of the recognition pipeline and reports latency percentiles and throughput as JSON.
+
+By default everything runs offline: table photos and card crops are synthesized (or loaded with --tables/--cards),
+and the models are replaced by stub sessions that return fixed detections. The stubs measure the pipeline around the
+models; pass --card-model/--shape-model to benchmark real `.tflite` files across --threads and --batch-sizes.
+
+Results can be compared against an earlier run with --baseline, which flags every benchmark whose p50 latency got
+slower by more than --tolerance and exits with a non-zero status if there are any.
+
+Usage:
+    python benchmark.py --output benchmark.json
+    python benchmark.py --card-model model_card_detection.tflite --threads 1 2 4 --baseline benchmark.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+import predict_card_detection
+import recognition
+from analyze_card_color import analyze_card_color
+from card_model import Card, DECK_SIZE
+from model_session import ModelSession
+from predict_utils import preprocess_image, detect_objects, detect_objects_batch, filter_objects_by_overlap, \
+    extract_objects, target_to_image_names
+
+CARD_SIZE = (380, 250)  # (height, width) of a synthesized card
+TABLE_LAYOUT = (3, 4)  # rows and columns of cards on a synthesized table
+_BGR_COLORS = {'r': (40, 30, 220), 'g': (60, 160, 20), 'p': (140, 30, 120)}
+
+
+class StubSession:
+    """
+    A stand-in for `model_session.ModelSession` that returns fixed detections without running a model.
+
+    The detections are the cells of a rows x columns grid, each reported twice (with a slightly shifted box and a
+    lower score), so that the overlap filter has work to do.
+    """
+
+    def __init__(self, input_size=(320, 320), grid=TABLE_LAYOUT, class_id=0, max_detections=25):
+        self.input_size = input_size
+        rows, columns = grid
+        boxes, scores = [], []
+        for row in range(rows):
+            for column in range(columns):
+                box = [(row + 0.1) / rows, (column + 0.1) / columns, (row + 0.9) / rows, (column + 0.9) / columns]
+                boxes += [box, [box[0] + 0.01, box[1] + 0.01, box[2] + 0.01, box[3] + 0.01]]
+                scores += [0.9, 0.6]
+        count = min(len(boxes), max_detections)
+        self._outputs = {
+            'output_0': np.array([count], dtype=np.float32),
+            'output_1': np.zeros((1, max_detections), dtype=np.float32),
+            'output_2': np.full((1, max_detections), class_id, dtype=np.float32),
+            'output_3': np.zeros((1, max_detections, 4), dtype=np.float32),
+        }
+        self._outputs['output_1'][0, :count] = scores[:count]
+        self._outputs['output_3'][0, :count] = boxes[:count]
+
+    def get_input_details(self):
+        height, width = self.input_size
+        return [{'shape': np.array([1, height, width, 3]), 'shape_signature': np.array([-1, height, width, 3])}]
+
+    def get_signature_runner(self):
+        def run(images):
+            return {name: np.repeat(value, len(images), axis=0) for name, value in self._outputs.items()}
+
+        return run
+
+
+def synthesize_card(card: Card, rng) -> np.ndarray:
+    """Draws a card (as a BGR image) with roughly the look of a real one"""
+    height, width = CARD_SIZE
+    image = np.full((height, width, 3), 235, dtype=np.uint8)
+    color = _BGR_COLORS[str(card.color)]
+    shape_height = height // 4
+    top = (height - card.count * shape_height - (card.count - 1) * shape_height // 3) // 2
+    for i in range(card.count):
+        y = top + i * (shape_height + shape_height // 3)
+        x0, x1, y1 = width // 6, width - width // 6, y + shape_height
+        if card.shape.to_short() == 'o':
+            center = ((x0 + x1) // 2, (y + y1) // 2)
+            points = cv2.ellipse2Poly(center, ((x1 - x0) // 2, shape_height // 2), 0, 0, 360, 10)
+        elif card.shape.to_short() == 'r':
+            points = np.array([[x0, (y + y1) // 2], [(x0 + x1) // 2, y], [x1, (y + y1) // 2], [(x0 + x1) // 2, y1]])
+        else:
+            xs = np.linspace(x0, x1, 24)
+            wave = np.sin(np.linspace(0, 2 * np.pi, 24)) * shape_height / 6
+            points = np.concatenate([np.stack([xs, y + shape_height / 4 + wave], axis=1),
+                                     np.stack([xs[::-1], y1 - shape_height / 4 + wave[::-1]], axis=1)])
+        points = np.int32(points)
+        if card.filling.to_short() == 'f':
+            cv2.fillPoly(image, [points], color)
+        elif card.filling.to_short() == 'p':
+            for stripe in range(x0, x1, 8):
+                cv2.line(image, (stripe, y), (stripe, y1), color, 2)
+            mask = np.zeros(image.shape[:2], dtype=np.uint8)
+            cv2.fillPoly(mask, [points], 255)
+            image[(mask == 0) & np.all(image == color, axis=2)] = 235
+        cv2.polylines(image, [points], True, color, 4)
+    noise = rng.normal(0, 4, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def synthesize_table(rng, cards) -> np.ndarray:
+    """Lays out the cards (BGR images) in a grid on a noisy table background, returning a BGR image"""
+    rows, columns = TABLE_LAYOUT
+    height, width = CARD_SIZE
+    margin = 60
+    table = rng.normal((70, 110, 60), 12, (rows * (height + margin) + margin, columns * (width + margin) + margin, 3))
+    table = np.clip(table, 0, 255).astype(np.uint8)
+    for i, card_image in enumerate(cards[:rows * columns]):
+        y = margin + (i // columns) * (height + margin)
+        x = margin + (i % columns) * (width + margin)
+        table[y:y + height, x:x + width] = card_image
+    return table
+
+
+def synthesize_corpus(directory: str, tables: int, seed: int = 0):
+    """Writes `tables` synthesized table photos and their card crops (named by card code) to the directory"""
+    rng = np.random.default_rng(seed)
+    tables_dir = os.path.join(directory, 'tables')
+    cards_dir = os.path.join(directory, 'cards')
+    os.makedirs(tables_dir, exist_ok=True)
+    os.makedirs(cards_dir, exist_ok=True)
+    rows, columns = TABLE_LAYOUT
+    for t in range(tables):
+        cards = [Card.from_int(int(code)) for code in rng.choice(DECK_SIZE, rows * columns, replace=False)]
+        card_images = [synthesize_card(card, rng) for card in cards]
+        cv2.imwrite(os.path.join(tables_dir, f'table-{t}.jpg'), synthesize_table(rng, card_images))
+        for i, (card, card_image) in enumerate(zip(cards, card_images)):
+            cv2.imwrite(os.path.join(cards_dir, f'table-{t}-{i}-{card}.jpg'), card_image)
+    return tables_dir, cards_dir
+
+
+def latency_stats(samples, items_per_sample: int = 1) -> dict:
+    """Summarizes latency samples (in seconds) as p50/p95/p99 milliseconds and items per second"""
+    samples = np.asarray(samples)
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+    return {
+        'samples': len(samples),
+        'p50_ms': round(float(p50), 4),
+        'p95_ms': round(float(p95), 4),
+        'p99_ms': round(float(p99), 4),
+        'items_per_second': round(float(items_per_sample * len(samples) / samples.sum()), 2),
+    }
+
+
+def measure(function, inputs, repeat: int, items_per_call: int = 1) -> dict:
+    """Calls `function` on every input `repeat` times (after one warm-up pass) and returns its `latency_stats`"""
+    for value in inputs:
+        function(value)
+    samples = []
+    for _ in range(repeat):
+        for value in inputs:
+            start = time.perf_counter()
+            function(value)
+            samples.append(time.perf_counter() - start)
+    return latency_stats(samples, items_per_call)
+
+
+def _sessions(args, threads):
+    if args.card_model is None:
+        card_session = StubSession()
+    else:
+        card_session = ModelSession(args.card_model, threads)
+    if args.shape_model is None:
+        shape_session = StubSession(grid=(1, 2), class_id=1)
+    else:
+        shape_session = ModelSession(args.shape_model, threads)
+    return card_session, shape_session
+
+
+def run_benchmarks(args, tables_dir: str, cards_dir: str) -> dict:
+    _, table_names = target_to_image_names(tables_dir)
+    _, card_names = target_to_image_names(cards_dir)
+    table_paths = [os.path.join(tables_dir, name) for name in table_names]
+    card_images = [cv2.imread(os.path.join(cards_dir, name)) for name in card_names]
+    card_crops = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in card_images]
+
+    results = {}
+    repeat = args.repeat
+    card_session, shape_session = _sessions(args, None)
+    input_size = card_session.input_size
+
+    results['preprocess_image'] = measure(lambda path: preprocess_image(path, input_size), table_paths, repeat)
+    preprocessed = [preprocess_image(path, input_size) for path in table_paths]
+
+    for threads in args.threads:
+        card_session, shape_session = _sessions(args, threads)
+        for batch_size in args.batch_sizes:
+            batches = [
+                [image for image, _ in preprocessed[start:start + batch_size]]
+                for start in range(0, len(preprocessed), batch_size)
+            ]
+            if batch_size == 1:
+                stats = measure(lambda batch: detect_objects(card_session, predict_card_detection.CLASSES, batch[0],
+                                                             predict_card_detection.DETECTION_THRESHOLD),
+                                batches, repeat)
+            else:
+                stats = measure(lambda batch: detect_objects_batch(card_session, predict_card_detection.CLASSES,
+                                                                   batch, predict_card_detection.DETECTION_THRESHOLD),
+                                batches, repeat, batch_size)
+            results[f'detect_objects[threads={threads},batch={batch_size}]'] = stats
+
+        results[f'validator[threads={threads}]'] = measure(
+            lambda crop: recognition.card_from_analysis(*recognition.analyze_card(crop, shape_session=shape_session)),
+            card_crops, repeat)
+
+    raw_results = [
+        detect_objects(card_session, predict_card_detection.CLASSES, image, threshold=0.0)
+        for image, _ in preprocessed
+    ]
+    results['filter_objects_by_overlap'] = measure(
+        lambda raw: filter_objects_by_overlap(raw, predict_card_detection.OVERLAP_THRESHOLD), raw_results, repeat)
+
+    detections = [
+        (original_image, filter_objects_by_overlap(raw, predict_card_detection.OVERLAP_THRESHOLD))
+        for (_, original_image), raw in zip(preprocessed, raw_results)
+    ]
+    results['extract_objects'] = measure(lambda detection: extract_objects(*detection), detections, repeat)
+    results['analyze_card_color'] = measure(analyze_card_color, card_images, repeat)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'card_model': args.card_model or 'stub',
+            'shape_model': args.shape_model or 'stub',
+        },
+        'results': results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """Returns a description of every benchmark whose p50 latency regressed by more than `tolerance` (a fraction)"""
+    regressions = []
+    for name, stats in report['results'].items():
+        baseline_stats = baseline['results'].get(name)
+        if baseline_stats is None:
+            continue
+        if stats['p50_ms'] > baseline_stats['p50_ms'] * (1 + tolerance):
+            regressions.append(f'{name}: p50 {baseline_stats["p50_ms"]:.3f}ms -> {stats["p50_ms"]:.3f}ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the recognition pipeline.')
+    parser.add_argument('--tables', help='directory of table photos (default: synthesize them)')
+    parser.add_argument('--cards', help='directory of card crops (default: synthesize them)')
+    parser.add_argument('--corpus-size', type=int, default=8, help='number of tables to synthesize (default: 8)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthesized corpus (default: 0)')
+    parser.add_argument('--card-model', help='card detection .tflite model (default: a stub)')
+    parser.add_argument('--shape-model', help='shape detection .tflite model (default: a stub)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1], help='interpreter thread counts (default: 1)')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1], help='detection batch sizes (default: 1)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed passes over the corpus (default: 5)')
+    parser.add_argument('--output', help='file to write the JSON report to (default: stdout)')
+    parser.add_argument('--baseline', help='JSON report of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed p50 slowdown relative to the baseline, as a fraction (default: 0.1)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as corpus_dir:
+        tables_dir, cards_dir = args.tables, args.cards
+        if tables_dir is None or cards_dir is None:
+            synthesized_tables_dir, synthesized_cards_dir = synthesize_corpus(corpus_dir, args.corpus_size, args.seed)
+            tables_dir = tables_dir or synthesized_tables_dir
+            cards_dir = cards_dir or synthesized_cards_dir
+        report = run_benchmarks(args, tables_dir, cards_dir)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
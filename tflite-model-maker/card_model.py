@@ -3,18 +3,17 @@ class Color:
     PURPLE = None
     RED = None
 
-    def __init__(self, color: str):
+    __slots__ = ('color', 'index')
+
+    def __init__(self, color: str, index: int):
         self.color = color
+        self.index = index
 
     def from_short(color: str):
-        if color == 'g':
-            return Color.GREEN
-        elif color == 'p':
-            return Color.PURPLE
-        elif color == 'r':
-            return Color.RED
-        else:
-            raise ValueError(f'Invalid color [{color}]')
+        try:
+            return _COLORS_BY_SHORT[color]
+        except KeyError:
+            raise ValueError(f'Invalid color [{color}]') from None
 
     def to_short(self):
         return self.color[0]
@@ -26,18 +25,25 @@ class Color:
         return self.to_short()
 
     def __hash__(self):
-        return hash(self.color)
+        return self.index
 
     def __eq__(self, __value):
         if not isinstance(__value, Color):
             return NotImplemented
-        return self.color == __value.color
+        # There is exactly one instance per color
+        return self is __value
+
+    def __reduce__(self):
+        # Unpickle and copy to the single instance, which equality relies on
+        return Color.from_short, (self.to_short(),)
 
 
 # Now define the instances
-Color.GREEN = Color('green')
-Color.PURPLE = Color('purple')
-Color.RED = Color('red')
+Color.GREEN = Color('green', 0)
+Color.PURPLE = Color('purple', 1)
+Color.RED = Color('red', 2)
+_COLORS = (Color.GREEN, Color.PURPLE, Color.RED)
+_COLORS_BY_SHORT = {color.to_short(): color for color in _COLORS}
 
 
 class Shape:
@@ -45,28 +51,23 @@ class Shape:
     RHOMBUS = None
     WAVE = None
 
-    def __init__(self, shape: str):
+    __slots__ = ('shape', 'index')
+
+    def __init__(self, shape: str, index: int):
         self.shape = shape
+        self.index = index
 
     def from_short(shape: str):
-        if shape == 'o':
-            return Shape.OVAL
-        elif shape == 'r':
-            return Shape.RHOMBUS
-        elif shape == 'w':
-            return Shape.WAVE
-        else:
-            raise ValueError(f'Invalid shape [{shape}]')
+        try:
+            return _SHAPES_BY_SHORT[shape]
+        except KeyError:
+            raise ValueError(f'Invalid shape [{shape}]') from None
 
     def from_long(shape: str):
-        if shape == 'oval':
-            return Shape.OVAL
-        elif shape == 'rhombus':
-            return Shape.RHOMBUS
-        elif shape == 'wave':
-            return Shape.WAVE
-        else:
-            raise ValueError(f'Invalid shape [{shape}]')
+        try:
+            return _SHAPES_BY_LONG[shape]
+        except KeyError:
+            raise ValueError(f'Invalid shape [{shape}]') from None
 
     def to_short(self):
         return self.shape[0]
@@ -78,17 +79,25 @@ class Shape:
         return self.to_short()
 
     def __hash__(self):
-        return hash(self.shape)
+        return self.index
 
     def __eq__(self, __value):
         if not isinstance(__value, Shape):
             return NotImplemented
-        return self.shape == __value.shape
+        # There is exactly one instance per shape
+        return self is __value
 
+    def __reduce__(self):
+        # Unpickle and copy to the single instance, which equality relies on
+        return Shape.from_short, (self.to_short(),)
 
-Shape.OVAL = Shape('oval')
-Shape.RHOMBUS = Shape('rhombus')
-Shape.WAVE = Shape('wave')
+
+Shape.OVAL = Shape('oval', 0)
+Shape.RHOMBUS = Shape('rhombus', 1)
+Shape.WAVE = Shape('wave', 2)
+_SHAPES = (Shape.OVAL, Shape.RHOMBUS, Shape.WAVE)
+_SHAPES_BY_SHORT = {shape.to_short(): shape for shape in _SHAPES}
+_SHAPES_BY_LONG = {shape.to_long(): shape for shape in _SHAPES}
 
 
 class Filling:
@@ -96,28 +105,23 @@ class Filling:
     FILLED = None
     PARTIAL = None
 
-    def __init__(self, filling: str):
+    __slots__ = ('filling', 'index')
+
+    def __init__(self, filling: str, index: int):
         self.filling = filling
+        self.index = index
 
     def from_short(filling: str):
-        if filling == 'e':
-            return Filling.EMPTY
-        elif filling == 'f':
-            return Filling.FILLED
-        elif filling == 'p':
-            return Filling.PARTIAL
-        else:
-            raise ValueError(f'Invalid filling [{filling}]')
+        try:
+            return _FILLINGS_BY_SHORT[filling]
+        except KeyError:
+            raise ValueError(f'Invalid filling [{filling}]') from None
 
     def from_long(filling: str):
-        if filling == 'empty':
-            return Filling.EMPTY
-        elif filling == 'filled':
-            return Filling.FILLED
-        elif filling == 'partial':
-            return Filling.PARTIAL
-        else:
-            raise ValueError(f'Invalid filling [{filling}]')
+        try:
+            return _FILLINGS_BY_LONG[filling]
+        except KeyError:
+            raise ValueError(f'Invalid filling [{filling}]') from None
 
     def to_short(self):
         return self.filling[0]
@@ -129,39 +133,107 @@ class Filling:
         return self.to_short()
 
     def __hash__(self):
-        return hash(self.filling)
+        return self.index
 
     def __eq__(self, __value):
         if not isinstance(__value, Filling):
             return NotImplemented
-        return self.filling == __value.filling
+        # There is exactly one instance per filling
+        return self is __value
 
+    def __reduce__(self):
+        # Unpickle and copy to the single instance, which equality relies on
+        return Filling.from_short, (self.to_short(),)
 
-Filling.EMPTY = Filling('empty')
-Filling.FILLED = Filling('filled')
-Filling.PARTIAL = Filling('partial')
+
+Filling.EMPTY = Filling('empty', 0)
+Filling.FILLED = Filling('filled', 1)
+Filling.PARTIAL = Filling('partial', 2)
+_FILLINGS = (Filling.EMPTY, Filling.FILLED, Filling.PARTIAL)
+_FILLINGS_BY_SHORT = {filling.to_short(): filling for filling in _FILLINGS}
+_FILLINGS_BY_LONG = {filling.to_long(): filling for filling in _FILLINGS}
+
+DECK_SIZE = 81
 
 
 class Card:
-    def __init__(self, color: Color, shape: Shape, filling: Filling, count: int):
-        self.color = color
-        self.shape = shape
-        self.filling = filling
-        self.count = count
+    """
+    A card, identified by its four properties.
+
+    The 81 cards of the deck are interned: creating a card with a count of 1, 2 or 3 returns the same instance every
+    time, which can be converted to and from an integer code in 0..80 with one base-3 digit per property. Cards with
+    any other count (e.g. when too many shapes were detected) are not part of the deck and are created as needed.
+    """
+
+    __slots__ = ('color', 'shape', 'filling', 'count', '_code', '_short')
+
+    def __new__(cls, color: Color, shape: Shape, filling: Filling, count: int):
+        if count in (1, 2, 3):
+            return _CARDS[_encode(color, shape, filling, count)]
+        return cls._create(color, shape, filling, count, None)
+
+    @classmethod
+    def _create(cls, color: Color, shape: Shape, filling: Filling, count: int, code):
+        card = object.__new__(cls)
+        card.color = color
+        card.shape = shape
+        card.filling = filling
+        card.count = count
+        card._code = code
+        card._short = f'{color}{shape}{filling}{count}'
+        return card
 
     def from_filename(filename: str):
-        return Card.from_short(filename.rsplit('.', 1)[0].split('-')[-1])
+        return Card.from_short(filename.rsplit('.', 1)[0].rsplit('-', 1)[-1])
 
     def from_short(card: str):
+        interned = _CARDS_BY_SHORT.get(card)
+        if interned is not None:
+            return interned
         return Card(Color.from_short(card[0]), Shape.from_short(card[1]), Filling.from_short(card[2]), int(card[3]))
 
+    def from_int(code: int):
+        if not 0 <= code < DECK_SIZE:
+            raise ValueError(f'Invalid card code [{code}]')
+        return _CARDS[code]
+
+    def to_int(self):
+        if self._code is None:
+            raise ValueError(f'Card [{self}] is not part of the deck')
+        return self._code
+
     def __str__(self):
-        return f'{self.color}{self.shape}{self.filling}{self.count}'
+        return self._short
 
     def __hash__(self):
+        if self._code is not None:
+            return self._code
         return hash((self.color, self.shape, self.filling, self.count))
 
     def __eq__(self, __value):
         if not isinstance(__value, Card):
             return NotImplemented
+        if self._code is not None or __value._code is not None:
+            # There is exactly one instance per card in the deck
+            return self is __value
         return self.color == __value.color and self.shape == __value.shape and self.filling == __value.filling and self.count == __value.count
+
+    def __reduce__(self):
+        # Unpickle and copy cards of the deck to their interned instance
+        if self._code is not None:
+            return Card.from_int, (self._code,)
+        return Card, (self.color, self.shape, self.filling, self.count)
+
+
+def _encode(color: Color, shape: Shape, filling: Filling, count: int):
+    return ((color.index * 3 + shape.index) * 3 + filling.index) * 3 + count - 1
+
+
+_CARDS = tuple(
+    Card._create(color, shape, filling, count, _encode(color, shape, filling, count))
+    for color in _COLORS
+    for shape in _SHAPES
+    for filling in _FILLINGS
+    for count in (1, 2, 3)
+)
+_CARDS_BY_SHORT = {str(card): card for card in _CARDS}
@@ -0,0 +1,151 @@
+"""
+Builds Pascal VOC datasets into cached, sharded TFRecords, so that training does not parse every annotation and
+encode every image again on each run.
+
+The annotations are assigned to shards by a stable hash of their name, and every shard is cached under a digest of
+the contents of its images and annotations (and the label map). A shard is only rebuilt when one of its files changed,
+was added or was removed; all other shards are loaded from the cache as is. The digests of the files are remembered
+with their modification time and size, so only the files that changed are read again, and the previous version of a
+rebuilt shard is deleted from the cache.
+
+Usage:
+    python dataset_cache.py data-cards --labels card
+    python dataset_cache.py data-shapes --labels oval-empty oval-filled ... --split data-shapes/split/train.txt
+"""
+import argparse
+import hashlib
+import os
+import zlib
+
+from tflite_model_maker import object_detector
+
+import voc
+from file_utils import FileDigests
+from train_utils import read_index
+
+DEFAULT_CACHE_DIR = os.path.join('.cache', 'datasets')
+DEFAULT_NUM_SHARDS = 16
+DIGESTS_FILENAME = 'digests.sqlite'
+
+
+def shard_of(annotation_name: str, num_shards: int) -> int:
+    """Returns the shard of an annotation, which does not depend on any other annotation in the dataset"""
+    return zlib.crc32(annotation_name.encode('utf-8')) % num_shards
+
+
+def shard_id(annotations_dir, label_map, num_shards: int, shard: int) -> str:
+    """
+    Returns the id of a shard, which starts the cache prefix of every version of the shard. A split of a dataset has
+    the same shard ids as the whole dataset if they have the same number of shards, so caching one deletes the other.
+    """
+    key = f'{os.path.abspath(annotations_dir)}\n{label_map!r}\n{num_shards}\n{shard}'
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def shard_digest(images_dir, annotations_dir, annotation_names, label_map, digests: FileDigests) -> str:
+    """Returns a digest of the contents of the images and annotations of a shard, and the label map"""
+    digest = hashlib.sha256(repr(label_map).encode('utf-8'))
+    for annotation_name in sorted(annotation_names):
+        annotation_path = os.path.join(annotations_dir, f'{annotation_name}.xml')
+        image_path = os.path.join(images_dir, f'{annotation_name}.jpg')
+        if not os.path.exists(image_path):
+            image_path = os.path.join(images_dir, voc.parse_annotation(annotation_path)['filename'])
+        digest.update(annotation_name.encode('utf-8'))
+        digest.update(digests.digest(annotation_path).encode('ascii'))
+        digest.update(digests.digest(image_path).encode('ascii') if os.path.exists(image_path) else b'-')
+    return digest.hexdigest()
+
+
+def load(images_dir, annotations_dir, label_map, annotation_filenames=None, num_shards=DEFAULT_NUM_SHARDS,
+         cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Loads a Pascal VOC dataset from the TFRecord cache, building the shards that are missing or out of date.
+
+    Args:
+        images_dir (str): The directory of images.
+        annotations_dir (str): The directory of annotations.
+        label_map (list|dict): The label map, like for `object_detector.DataLoader.from_pascal_voc`.
+        annotation_filenames (list): The annotation names (without extension) to load, e.g. from
+                                     `train_utils.read_index`. Defaults to all annotations in the directory.
+        num_shards (int): Number of shards to cache the dataset in. Use 1 for validation data: only a single shard
+                          keeps the COCO annotations needed by `model.evaluate`.
+        cache_dir (str): The directory of the cache.
+
+    Returns:
+        object_detector.DataLoader: The dataset.
+    """
+    if annotation_filenames is None:
+        annotation_filenames = [os.path.splitext(name)[0] for name in sorted(os.listdir(annotations_dir))
+                                if name.endswith('.xml')]
+
+    shards = [[] for _ in range(num_shards)]
+    for annotation_name in annotation_filenames:
+        shards[shard_of(annotation_name, num_shards)].append(annotation_name)
+
+    # The cache prefix of every shard by its id, None for empty shards
+    prefixes = {}
+    with FileDigests(os.path.join(cache_dir, DIGESTS_FILENAME)) as digests:
+        for shard, annotation_names in enumerate(shards):
+            shard_prefix = shard_id(annotations_dir, label_map, num_shards, shard)
+            if annotation_names:
+                digest = shard_digest(images_dir, annotations_dir, annotation_names, label_map, digests)
+                prefixes[shard_prefix] = f'{shard_prefix}-{digest}'
+            else:
+                prefixes[shard_prefix] = None
+    _delete_stale_shards(cache_dir, prefixes)
+
+    loaders = []
+    for annotation_names, prefix in zip(shards, prefixes.values()):
+        if prefix is None:
+            continue
+        # from_pascal_voc only writes the TFRecords if no cache with this prefix exists yet
+        loaders.append(object_detector.DataLoader.from_pascal_voc(
+            images_dir=images_dir,
+            annotations_dir=annotations_dir,
+            label_map=label_map,
+            annotation_filenames=annotation_names,
+            num_shards=1,
+            cache_dir=cache_dir,
+            cache_prefix_filename=prefix,
+        ))
+    if not loaders:
+        raise ValueError(f'No annotations found in [{annotations_dir}]')
+
+    if len(loaders) == 1:
+        return loaders[0]
+    return object_detector.DataLoader(
+        [loader.tfrecord_file_patten for loader in loaders],
+        sum(loader.size for loader in loaders),
+        loaders[0].label_map,
+    )
+
+
+def _delete_stale_shards(cache_dir, prefixes: dict):
+    """
+    Deletes the cache files of other versions of the shards: those with the id of a shard but not its current prefix.
+
+    Args:
+        prefixes (dict): The current cache prefix of every shard by its id, or None to delete every version.
+    """
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            shard_prefix = entry.name.split('-', 1)[0]
+            if shard_prefix in prefixes and (prefixes[shard_prefix] is None or
+                                             not entry.name.startswith(prefixes[shard_prefix])):
+                os.remove(entry.path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the TFRecord cache of a Pascal VOC dataset.')
+    parser.add_argument('dataset', help='a directory containing images and Annotations (e.g. data-cards)')
+    parser.add_argument('--labels', nargs='+', required=True, help='the label map, in order')
+    parser.add_argument('--split', help='an index file written by train_utils.split, to only build those annotations')
+    parser.add_argument('--shards', type=int, default=DEFAULT_NUM_SHARDS,
+                        help=f'number of shards (default: {DEFAULT_NUM_SHARDS})')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help=f'(default: {DEFAULT_CACHE_DIR})')
+    args = parser.parse_args()
+
+    data = load(f'{args.dataset}/images', f'{args.dataset}/Annotations', args.labels,
+                annotation_filenames=read_index(args.split) if args.split else None,
+                num_shards=args.shards, cache_dir=args.cache_dir)
+    print(f'Cached {data.size} images in {args.cache_dir}')
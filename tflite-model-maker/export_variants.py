@@ -0,0 +1,159 @@
+"""
+Exports a trained model as float32, float16, dynamic range int8 and full int8 TFLite variants, and compares the
+cards recognized with each variant against a reference model.
+
+The full int8 variant is calibrated on a representative dataset, by default the training data. `train.py` exports the
+variants listed in the `variants` key of its config; this module can also compare variants that were exported before.
+
+Usage:
+    python export_variants.py card runs/cards/efficientdet_lite0-b8-e50/model-float32.tflite \\
+        runs/cards/efficientdet_lite0-b8-e50/model-int8.tflite --images data-cards/images
+    python export_variants.py shape model-float32.tflite model-int8.tflite --images data-cards/images \\
+        --cards output-card-extraction
+"""
+import argparse
+import json
+import os
+from collections import Counter
+
+VARIANTS = ('float32', 'float16', 'dynamic', 'int8')
+
+
+def variant_filename(tflite_filename: str, variant: str) -> str:
+    """Returns the filename of a variant, e.g. model-int8.tflite for model.tflite"""
+    stem, extension = os.path.splitext(tflite_filename)
+    return f'{stem}-{variant}{extension}'
+
+
+def export(detector, export_dir: str, tflite_filename: str, variants=VARIANTS, representative_data=None) -> dict:
+    """
+    Exports a trained `object_detector.ObjectDetector` as TFLite variants.
+
+    Args:
+        detector: The trained detector.
+        export_dir (str): The directory to export to.
+        tflite_filename (str): The base filename, see `variant_filename`.
+        variants (list): The variants to export, see `VARIANTS`.
+        representative_data (object_detector.DataLoader): Data to calibrate the full int8 variant on.
+
+    Returns:
+        dict: The path of every exported variant.
+    """
+    from tflite_model_maker.config import ExportFormat, QuantizationType
+
+    quantization_types = {
+        'float32': QuantizationType.FP32,
+        'float16': QuantizationType.FP16,
+        'dynamic': QuantizationType.DYNAMIC,
+        'int8': QuantizationType.INT8,
+    }
+    paths = {}
+    for variant in variants:
+        if variant not in quantization_types:
+            raise ValueError(f'Invalid variant [{variant}]')
+        filename = variant_filename(tflite_filename, variant)
+        detector.export(export_dir=export_dir, tflite_filename=filename, export_format=[ExportFormat.TFLITE],
+                        quantization_type=quantization_types[variant],
+                        representative_data=representative_data if variant == 'int8' else None)
+        paths[variant] = os.path.join(export_dir, filename)
+    return paths
+
+
+def _recognized(image_paths, card_session, shape_session) -> dict:
+    import predict_utils
+    import recognition
+
+    return {
+        path: Counter(str(card) for card, _ in recognition.recognize(predict_utils.read_image(path),
+                                                                     card_session=card_session,
+                                                                     shape_session=shape_session))
+        for path in image_paths
+    }
+
+
+def compare_recognition(image_paths, reference_sessions, variant_sessions) -> dict:
+    """
+    Recognizes the cards on images of tables with a reference and a variant pair of (card, shape) sessions.
+
+    Returns:
+        dict: The number of 'images' and of images on which both recognized exactly the same cards ('identical'), and
+              per differing image the cards only recognized by the reference ('missing') and by the variant ('extra').
+    """
+    reference = _recognized(image_paths, *reference_sessions)
+    variant = _recognized(image_paths, *variant_sessions)
+    differences = {}
+    for path in image_paths:
+        missing = reference[path] - variant[path]
+        extra = variant[path] - reference[path]
+        if missing or extra:
+            differences[path] = {'missing': sorted(missing.elements()), 'extra': sorted(extra.elements())}
+    return {'images': len(image_paths), 'identical': len(image_paths) - len(differences), 'differences': differences}
+
+
+def check_variant(role: str, model_path: str, reference_path: str, image_paths, cards_target: str = None) -> dict:
+    """
+    Checks that a card or shape detection variant recognizes the same cards as a reference model.
+
+    Args:
+        role (str): 'card' or 'shape', the model the variant replaces. The production model is used for the other.
+        model_path (str): The variant.
+        reference_path (str): The reference, typically the float32 variant.
+        image_paths (list): Images of tables to compare the recognized cards on.
+        cards_target (str): For shape models, card images named with their card code (see
+                            `full_card_detection_validator`) to also validate the variant on.
+
+    Returns:
+        dict: The `compare_recognition` report, and for shape models the validator report as 'validator'.
+    """
+    import full_card_detection_validator
+    import predict_card_detection
+    import predict_shape_detection
+    from model_session import ModelSession
+
+    if role == 'card':
+        shape_session = ModelSession(predict_shape_detection.MODEL_PATH, predict_shape_detection.NUM_THREADS)
+        reference = (ModelSession(reference_path, predict_card_detection.NUM_THREADS), shape_session)
+        variant = (ModelSession(model_path, predict_card_detection.NUM_THREADS), shape_session)
+    elif role == 'shape':
+        card_session = ModelSession(predict_card_detection.MODEL_PATH, predict_card_detection.NUM_THREADS)
+        reference = (card_session, ModelSession(reference_path, predict_shape_detection.NUM_THREADS))
+        variant = (card_session, ModelSession(model_path, predict_shape_detection.NUM_THREADS))
+    else:
+        raise ValueError(f'Invalid role [{role}]')
+
+    report = compare_recognition(image_paths, reference, variant)
+    if role == 'shape' and cards_target is not None:
+        validator = full_card_detection_validator.validate(cards_target, shape_session=variant[1], verbose=False)
+        report['validator'] = {
+            'checked': validator['checked'],
+            'correct': validator['correct'],
+            'accuracy': validator['accuracy'],
+            'attribute_accuracy': {name: stats['accuracy'] for name, stats in validator['attributes'].items()},
+        }
+    return report
+
+
+def image_paths(images_dir: str, limit: int = None) -> list:
+    """Returns the paths of the images of a target (see `target_to_image_names`), optionally only the first few"""
+    from predict_utils import target_to_image_names
+
+    images_dir, image_names = target_to_image_names(images_dir)
+    return [os.path.join(images_dir, name) for name in image_names[:limit]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the cards recognized with exported model variants against '
+                                                 'a reference model.')
+    parser.add_argument('role', choices=['card', 'shape'], help='the model the variants replace')
+    parser.add_argument('reference', help='the reference model, e.g. the float32 variant')
+    parser.add_argument('variants', nargs='+', help='the variants to check')
+    parser.add_argument('--images', required=True, help='a directory of table images to recognize the cards on')
+    parser.add_argument('--limit', type=int, help='only use the first LIMIT images')
+    parser.add_argument('--cards', help='for shape models, a directory of card images to also run the validator on')
+    args = parser.parse_args()
+
+    paths = image_paths(args.images, args.limit)
+    for model_path in args.variants:
+        report = check_variant(args.role, model_path, args.reference, paths, args.cards)
+        print(f'{model_path}: {report["identical"]} of {report["images"]} images recognized identically')
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,61 @@
+"""
+Helpers for files, shared by the caches of the training data and of the model outputs.
+"""
+import hashlib
+import os
+import sqlite3
+
+
+def file_digest(path: str) -> str:
+    """Returns the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileDigests:
+    """
+    The digests of files (see `file_digest`), remembered in SQLite with the modification time and size of the file, so
+    that a file is only read again when either of those changed. New digests are written on `close`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS digests '
+            '(path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, digest TEXT NOT NULL)'
+        )
+        self._pending = []
+
+    def digest(self, path: str) -> str:
+        """Returns the SHA-256 hex digest of a file's contents, reading the file only if it changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self._connection.execute('SELECT mtime_ns, size, digest FROM digests WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_mtime_ns, stat.st_size):
+            return row[2]
+        digest = file_digest(path)
+        self._pending.append((path, stat.st_mtime_ns, stat.st_size, digest))
+        return digest
+
+    def close(self):
+        if self._pending:
+            self._connection.execute('BEGIN')
+            self._connection.executemany('INSERT OR REPLACE INTO digests (path, mtime_ns, size, digest) '
+                                         'VALUES (?, ?, ?, ?)', self._pending)
+            self._connection.execute('COMMIT')
+            self._pending = []
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -1,37 +1,262 @@
-import os.path
+"""
+Validates the card recognition (color analysis and shape detection) on card images whose filenames end with the code
+of the card they show (see `Card.from_filename`), e.g. the output of `predict_card_detection.py extract --save` after
+renaming the images with `rename_extracted_cards.py`.
+
+Besides the overall accuracy, the report holds a confusion matrix per attribute (color, shape, filling and count), so
+it shows which attribute a model gets wrong. With `--workers`, the images are validated by a pool of processes that
+each load the shape detection model once. With `--start-method fork`, the model is read once by this process and the
+forked workers share that copy. The report then also holds the memory usage of every worker: its PSS (which divides
+shared pages between the processes sharing them) shows what the workers actually cost, unlike its RSS.
 
-import cv2
+Usage:
+    python full_card_detection_validator.py output-card-extraction --workers 8 --json report.json
+"""
+import argparse
+import json
+import multiprocessing
+import os.path
 
-import analyze_card_color
+import instrumentation
 import predict_shape_detection
 import predict_utils
-from card_model import Shape, Color, Filling, Card
+import recognition
+from card_model import Card
+from model_session import ModelSession, memory_usage, share_model, use_result_cache
+from result_cache import ResultCache
+
+ATTRIBUTES = ('color', 'shape', 'filling', 'count')
+# Detected attribute value when the attribute could not be determined
+UNKNOWN = '?'
+CHUNK_SIZE = 32
+START_METHODS = ('spawn', 'fork')
+
+
+def check_card(images_dir: str, image_name: str, shape_session=None) -> dict:
+    """
+    Recognizes a single card image and compares the result with the card code in its filename.
+
+    Returns:
+        dict: The 'image', the 'status' ('correct', 'wrong', 'no_color' or 'no_shapes'), and the 'expected' and
+              'detected' value of every attribute. Attributes that could not be determined are detected as `UNKNOWN`.
+    """
+    card = Card.from_filename(image_name)
+    image = predict_utils.read_image(os.path.join(images_dir, image_name))
+    colors, results = recognition.analyze_card(image, shape_session=shape_session)
+
+    detected = dict.fromkeys(ATTRIBUTES, UNKNOWN)
+    if len(colors) > 0:
+        detected['color'] = colors[0]['color']
+    if len(results) > 0:
+        detected['shape'], detected['filling'] = (name[0] for name in results[0]['class_name'].split('-'))
+        detected['count'] = str(len(results))
+
+    if len(colors) == 0:
+        status = 'no_color'
+    elif len(results) == 0:
+        status = 'no_shapes'
+    elif recognition.card_from_analysis(colors, results) != card:
+        status = 'wrong'
+    else:
+        status = 'correct'
+    expected = {'color': str(card.color), 'shape': str(card.shape), 'filling': str(card.filling),
+                'count': str(card.count)}
+    return {'image': image_name, 'status': status, 'expected': expected, 'detected': detected}
+
+
+def _print_check(check: dict):
+    image_name = check['image']
+    if check['status'] == 'no_color':
+        print(f'Unable to determine card color for {image_name}')
+    elif check['status'] == 'no_shapes':
+        print(f'Unable to detect shapes for {image_name}')
+    elif check['status'] == 'wrong':
+        detected = ''.join(check['detected'][attribute] for attribute in ATTRIBUTES)
+        expected = ''.join(check['expected'][attribute] for attribute in ATTRIBUTES)
+        print(f'Detected card {detected}, expected {expected}, in {image_name}')
+
+
+_worker_session = None
+
+
+def _init_worker(shape_model_path: str, num_threads: int, cache_path: str):
+    global _worker_session
+    if cache_path is not None:
+        use_result_cache(ResultCache(cache_path))
+    _worker_session = ModelSession(shape_model_path, num_threads)
+
+
+def _check_chunk(job):
+    images_dir, image_names = job
+    checks = [check_card(images_dir, image_name, _worker_session) for image_name in image_names]
+    return checks, os.getpid(), memory_usage()
 
 
-def main(target: str):
+def _checks(images_dir: str, image_names: list, shape_session, workers: int, cache_path: str,
+            start_method: str = 'spawn', worker_memory: dict = None):
+    """
+    Yields the check of every image, as soon as it is done (so in no particular order with workers).
+
+    With workers, the last memory usage (see `memory_usage`) of every worker is stored in `worker_memory` by its pid.
+    """
+    if workers <= 0:
+        for image_name in image_names:
+            yield check_card(images_dir, image_name, shape_session)
+        return
+
+    if not os.path.exists(predict_shape_detection.MODEL_PATH):
+        # A worker that fails to initialize is replaced by the pool over and over, so fail before starting any
+        raise FileNotFoundError(f'Unable to find model [{predict_shape_detection.MODEL_PATH}]')
+    chunks = [(images_dir, image_names[start:start + CHUNK_SIZE]) for start in range(0, len(image_names), CHUNK_SIZE)]
+    if start_method not in START_METHODS:
+        raise ValueError(f'Invalid start method [{start_method}]')
+    if start_method == 'fork':
+        # The workers inherit the model buffer instead of each reading the model. They create their own interpreters
+        # and database connections, and never use the ones this process may hold.
+        share_model(predict_shape_detection.MODEL_PATH)
+    context = multiprocessing.get_context(start_method)
+    initargs = (predict_shape_detection.MODEL_PATH, predict_shape_detection.NUM_THREADS, cache_path)
+    with context.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        for checks, pid, usage in pool.imap_unordered(_check_chunk, chunks):
+            if worker_memory is not None:
+                worker_memory[pid] = usage
+            yield from checks
+
+
+def summarize(checks) -> dict:
+    """
+    Aggregates card checks (see `check_card`) into a report.
+
+    Returns:
+        dict: The number of cards 'checked' and 'correct', the 'accuracy', the (sorted) names of the images per failure
+              status ('no_color', 'no_shapes' and 'wrong'), and per attribute its 'accuracy' and 'confusion' matrix,
+              as {expected: {detected: count}}.
+    """
+    report = {'checked': 0, 'correct': 0, 'no_color': [], 'no_shapes': [], 'wrong': []}
+    attributes = {attribute: {'correct': 0, 'confusion': {}} for attribute in ATTRIBUTES}
+    for check in checks:
+        report['checked'] += 1
+        if check['status'] == 'correct':
+            report['correct'] += 1
+        else:
+            report[check['status']].append(check['image'])
+        for attribute, stats in attributes.items():
+            expected, detected = check['expected'][attribute], check['detected'][attribute]
+            row = stats['confusion'].setdefault(expected, {})
+            row[detected] = row.get(detected, 0) + 1
+            stats['correct'] += expected == detected
+
+    for status in ('no_color', 'no_shapes', 'wrong'):
+        report[status].sort()
+    report['accuracy'] = report['correct'] / report['checked'] if report['checked'] else 0.0
+    report['attributes'] = {
+        attribute: {
+            'accuracy': stats['correct'] / report['checked'] if report['checked'] else 0.0,
+            'confusion': {expected: dict(sorted(row.items())) for expected, row in sorted(stats['confusion'].items())},
+        }
+        for attribute, stats in attributes.items()
+    }
+    return report
+
+
+def validate(target: str, shape_session=None, verbose: bool = True, workers: int = 0, cache_path: str = None,
+             start_method: str = 'spawn') -> dict:
+    """
+    Recognizes every card image of the target and compares the result with the card code in its filename.
+
+    Args:
+        target (str): A card image, or a directory of card images.
+        shape_session (ModelSession): The shape detection model to use. Defaults to the shared pool. Ignored with
+                                      workers, which each load the shape detection model.
+        verbose (bool): Whether to print every card that was not recognized correctly.
+        workers (int): Number of processes to validate on (default: 0, which validates in this process).
+        cache_path (str): The result cache the workers use, or None to always run the model in the workers.
+        start_method (str): How the workers are started, one of `START_METHODS`. Forked workers share the model
+                            buffer of this process, spawned workers each read the model.
+
+    Returns:
+        dict: See `summarize`. With workers, also the 'memory' usage (see `memory_usage`) of this 'process' and of the
+              'workers', by pid.
+    """
     images_dir, image_names = predict_utils.target_to_image_names(target)
-    for image_name in image_names:
-        image_path = os.path.join(images_dir, image_name)
-        card = Card.from_filename(image_name)
-        image = cv2.imread(image_path)
-        colors = analyze_card_color.analyze_card_color(image)
-        if len(colors) == 0:
-            print(f'Unable to determine card color for {image_name}')
-            continue
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        _, results = predict_shape_detection.run_odt(image_name, gray)
-        if len(results) == 0:
-            print(f'Unable to detect shapes for {image_name}')
-            continue
-        shape, filling = results[0]['class_name'].split('-')
-        shape = Shape.from_long(shape)
-        filling = Filling.from_long(filling)
-        color = Color.from_short(colors[0]['color'])
-        detected_card = Card(color, shape, filling, len(results))
-        if detected_card != card:
-            print(f'Detected card {detected_card}, expected {card}, in {image_name}')
+    worker_memory = {}
+
+    def checks():
+        for check in _checks(images_dir, image_names, shape_session, workers, cache_path, start_method, worker_memory):
+            if verbose:
+                _print_check(check)
+            yield check
+
+    report = summarize(checks())
+    if workers > 0:
+        report['memory'] = {'process': memory_usage(), 'workers': {str(pid): usage for pid, usage in
+                                                                     sorted(worker_memory.items())}}
+    return report
+
+
+def format_report(report: dict) -> str:
+    """Formats a report (see `summarize`) as text, with a confusion matrix per attribute"""
+    lines = [
+        f'{report["correct"]} of {report["checked"]} cards recognized correctly ({report["accuracy"]:.2%})',
+        f'{len(report["no_color"])} without color, {len(report["no_shapes"])} without shapes, '
+        f'{len(report["wrong"])} wrong',
+    ]
+    for attribute, stats in report['attributes'].items():
+        confusion = stats['confusion']
+        columns = sorted({detected for row in confusion.values() for detected in row})
+        lines += ['', f'{attribute} ({stats["accuracy"]:.2%} correct), expected (rows) vs detected (columns):',
+                  ' ' * 9 + ''.join(f'{column:>8}' for column in columns)]
+        for expected, row in confusion.items():
+            lines.append(f'{expected:>8} ' + ''.join(f'{row.get(column, 0):8d}' for column in columns))
+    if 'memory' in report:
+        lines += ['', 'memory (MiB):', f'{"":>10}{"rss":>10}{"pss":>10}{"shared":>10}']
+        processes = [('process', report['memory']['process'])] + list(report['memory']['workers'].items())
+        for name, usage in processes:
+            lines.append(f'{name:>10}' + ''.join(f'{usage.get(field, 0) / 2 ** 20:10.1f}'
+                                                 for field in ('rss', 'pss', 'shared')))
+        workers = report['memory']['workers'].values()
+        lines.append(f'{"workers":>10}' + ''.join(f'{sum(usage.get(field, 0) for usage in workers) / 2 ** 20:10.1f}'
+                                                  for field in ('rss', 'pss')))
+    return '\n'.join(lines)
+
+
+def main(target: str, workers: int = 0, json_path: str = None, cache_path: str = None, start_method: str = 'spawn'):
+    report = validate(target, workers=workers, cache_path=cache_path, start_method=start_method)
+    print()
+    print(format_report(report))
+    if json_path is not None:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
 
 
 if __name__ == '__main__':
-    main('output-card-extraction')
-    # main('output-card-extraction/set-card-game-real-1-goe3.jpg')
+    parser = argparse.ArgumentParser(description='Validate the card recognition against the codes in the filenames.')
+    parser.add_argument('target', nargs='?', default='output-card-extraction',
+                        help='a card image, or a directory of card images (default: output-card-extraction)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of processes to validate on (default: 0, which validates in this process)')
+    parser.add_argument('--start-method', choices=START_METHODS, default='spawn',
+                        help='how the workers are started, fork shares the model buffer of this process between them '
+                             '(default: spawn)')
+    parser.add_argument('--json', metavar='FILE', help='also write the report as JSON to FILE')
+    parser.add_argument('--no-cache', action='store_true', help='always run the model, even for unchanged images')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='record per stage timings and counts to FILE: Prometheus text if it ends with .prom, '
+                             'otherwise one JSON event per line (without --workers)')
+    args = parser.parse_args()
+
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache()
+        use_result_cache(cache)
+    cache_path = cache.path if cache is not None else None
+    try:
+        if args.metrics:
+            with instrumentation.export_to(args.metrics):
+                main(args.target, args.workers, args.json, cache_path, args.start_method)
+        else:
+            main(args.target, args.workers, args.json, cache_path, args.start_method)
+    finally:
+        if cache is not None:
+            use_result_cache(None)
+            cache.close()
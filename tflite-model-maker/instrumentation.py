@@ -0,0 +1,184 @@
+"""
+Opt-in instrumentation of the stages of the prediction pipeline.
+
+Functions decorated with `instrumented` report an event for every call to the registered sinks: the stage name, the
+duration, stage specific counts (e.g. raw vs filtered detections) and, if allocation tracking is enabled, the bytes
+allocated during the call. Without any sinks, a decorated function only pays for a single flag check.
+
+Sinks are plain callables taking an event dict. `JsonLinesExporter` writes every event as a line of JSON, and
+`PrometheusExporter` aggregates events into metrics in the Prometheus text format.
+"""
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+_sinks = []
+_enabled = False
+_track_allocations = False
+_local = threading.local()
+
+
+def add_sink(sink):
+    """Registers a callable that receives an event dict for every instrumented call, enabling instrumentation"""
+    global _enabled
+    _sinks.append(sink)
+    _enabled = True
+
+
+def remove_sink(sink):
+    """Unregisters a sink, disabling instrumentation when no sinks are left"""
+    global _enabled
+    _sinks.remove(sink)
+    _enabled = len(_sinks) > 0
+
+
+def track_allocations(enabled: bool = True):
+    """
+    Enables or disables measuring the bytes allocated by instrumented calls (through `tracemalloc`).
+
+    This slows down all allocations in the process while enabled. When instrumented calls are nested, only the
+    outermost call reports its allocations.
+    """
+    global _track_allocations
+    _track_allocations = enabled
+    if enabled and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def instrumented(stage: str, counts=None):
+    """
+    Decorates a function to report an event for every call to the registered sinks.
+
+    Args:
+        stage (str): The stage name to report.
+        counts (callable): Called with the result and the arguments of each call, returns a dict of counts to report.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+
+            measure_allocations = _track_allocations and not getattr(_local, 'depth', 0)
+            if measure_allocations:
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+            _local.depth = getattr(_local, 'depth', 0) + 1
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                _local.depth -= 1
+
+            event = {'stage': stage, 'seconds': seconds}
+            if counts is not None:
+                event['counts'] = counts(result, *args, **kwargs)
+            if measure_allocations:
+                _, peak = tracemalloc.get_traced_memory()
+                event['allocated_bytes'] = max(0, peak - current)
+            for sink in list(_sinks):
+                sink(event)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class JsonLinesExporter:
+    """A sink that writes every event as a line of JSON to a file"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class PrometheusExporter:
+    """A sink that aggregates events per stage and renders them in the Prometheus text exposition format"""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, prefix: str = 'set_card_game'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    def __call__(self, event):
+        with self._lock:
+            stage = self._stages.setdefault(event['stage'], {
+                'calls': 0, 'seconds': 0.0, 'buckets': [0] * len(self.BUCKETS), 'counts': {}, 'allocated_bytes': 0
+            })
+            stage['calls'] += 1
+            stage['seconds'] += event['seconds']
+            for i, bound in enumerate(self.BUCKETS):
+                if event['seconds'] <= bound:
+                    stage['buckets'][i] += 1
+            for name, value in event.get('counts', {}).items():
+                stage['counts'][name] = stage['counts'].get(name, 0) + value
+            stage['allocated_bytes'] += event.get('allocated_bytes', 0)
+
+    def render(self) -> str:
+        """Returns the aggregated metrics in the Prometheus text format"""
+        duration = f'{self.prefix}_stage_duration_seconds'
+        items = f'{self.prefix}_stage_items_total'
+        allocated = f'{self.prefix}_stage_allocated_bytes_total'
+        lines = [
+            f'# HELP {duration} Time spent per call of a pipeline stage.',
+            f'# TYPE {duration} histogram',
+        ]
+        with self._lock:
+            stages = sorted(self._stages.items())
+            for name, stage in stages:
+                for bound, count in zip(self.BUCKETS, stage['buckets']):
+                    lines.append(f'{duration}_bucket{{stage="{name}",le="{bound}"}} {count}')
+                lines.append(f'{duration}_bucket{{stage="{name}",le="+Inf"}} {stage["calls"]}')
+                lines.append(f'{duration}_sum{{stage="{name}"}} {stage["seconds"]}')
+                lines.append(f'{duration}_count{{stage="{name}"}} {stage["calls"]}')
+            lines += [f'# HELP {items} Items counted by a pipeline stage (e.g. raw and filtered detections).',
+                      f'# TYPE {items} counter']
+            for name, stage in stages:
+                for item, value in sorted(stage['counts'].items()):
+                    lines.append(f'{items}{{stage="{name}",item="{item}"}} {value}')
+            lines += [f'# HELP {allocated} Bytes allocated by a pipeline stage (when allocation tracking is enabled).',
+                      f'# TYPE {allocated} counter']
+            for name, stage in stages:
+                lines.append(f'{allocated}{{stage="{name}"}} {stage["allocated_bytes"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+
+
+@contextmanager
+def export_to(path: str):
+    """
+    Records the events of all instrumented calls in the `with` block to a file: aggregated metrics in the Prometheus
+    text format if the path ends with `.prom`, otherwise every event as a line of JSON.
+    """
+    exporter = PrometheusExporter() if path.endswith('.prom') else JsonLinesExporter(path)
+    add_sink(exporter)
+    try:
+        yield exporter
+    finally:
+        remove_sink(exporter)
+        if isinstance(exporter, PrometheusExporter):
+            exporter.write(path)
+        else:
+            exporter.close()
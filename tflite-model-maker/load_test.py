@@ -0,0 +1,114 @@
+"""
+Load tests a running `service.py` with concurrent clients that upload table photos to /recognize.
+
+Reports the client side latency (p50/p95/p99), the throughput, the status codes and the batch sizes the service
+formed. Without `--images`, synthesized table photos (see `benchmark.synthesize_corpus`) are uploaded.
+
+Usage:
+    python service.py --port 8080 &
+    python load_test.py --port 8080 --concurrency 16 --requests 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+from benchmark import latency_stats, synthesize_corpus
+from predict_utils import target_to_image_names
+
+
+async def _request(host: str, port: int, body: bytes, connection=None):
+    """Posts an image over a kept-alive connection, returning (status, JSON response, connection)"""
+    if connection is None:
+        connection = await asyncio.open_connection(host, port)
+    reader, writer = connection
+    writer.write((f'POST /recognize HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/octet-stream\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    response = json.loads(await reader.readexactly(int(headers['content-length'])))
+    if headers.get('connection', '').lower() == 'close':
+        writer.close()
+        connection = None
+    return status, response, connection
+
+
+async def run_load_test(host: str, port: int, images, concurrency: int, requests: int) -> dict:
+    """Sends `requests` uploads, cycling through the images, from `concurrency` concurrent clients"""
+    samples = []
+    statuses = Counter()
+    batch_sizes = Counter()
+    counter = iter(range(requests))
+
+    async def client():
+        connection = None
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                status, response, connection = await _request(host, port, images[i % len(images)], connection)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                statuses[type(e).__name__] += 1
+                connection = None
+                continue
+            samples.append(time.perf_counter() - start)
+            statuses[status] += 1
+            if status == 200:
+                batch_sizes[response['batch_size']] += 1
+        if connection is not None:
+            connection[1].close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(samples) / seconds, 2),
+        'latency': latency_stats(samples) if samples else None,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        'mean_batch_size': round(float(np.average(list(batch_sizes), weights=list(batch_sizes.values()))), 2)
+        if batch_sizes else None,
+    }
+
+
+def _read_images(images_dir: str, limit: int) -> list:
+    images_dir, image_names = target_to_image_names(images_dir)
+    images = []
+    for image_name in image_names[:limit]:
+        with open(os.path.join(images_dir, image_name), 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the recognition service.')
+    parser.add_argument('--host', default='localhost', help='(default: localhost)')
+    parser.add_argument('--port', type=int, default=8080, help='(default: 8080)')
+    parser.add_argument('--images', help='a directory of table photos to upload (default: synthesized photos)')
+    parser.add_argument('--limit', type=int, default=20, help='maximum number of distinct photos (default: 20)')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients (default: 8)')
+    parser.add_argument('--requests', type=int, default=200, help='total number of requests (default: 200)')
+    parser.add_argument('--output', help='also write the report as JSON to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        images_dir = args.images or synthesize_corpus(corpus_dir, args.limit)[0]
+        images = _read_images(images_dir, args.limit)
+    report = asyncio.run(run_load_test(args.host, args.port, images, args.concurrency, args.requests))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,218 @@
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+import numpy as np
+
+from file_utils import file_digest
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None
+
+_result_cache = None
+_model_contents = {}
+
+
+def use_result_cache(cache):
+    """
+    Makes all sessions look up and store their outputs in the given `result_cache.ResultCache` (None disables it).
+    """
+    global _result_cache
+    _result_cache = cache
+
+
+def share_model(model_path: str):
+    """
+    Reads a model into memory once, after which all sessions of the model are created from that buffer instead of
+    from the file, including sessions in child processes forked afterwards. The children share the parent's buffer
+    (copy-on-write, and it is never written), so N forked workers hold one copy of the weights.
+
+    Sessions created from the file share the weights as well, as TFLite memory maps the file. Sharing the buffer
+    additionally guarantees that all workers run the same model, even if the file is replaced while they start.
+    """
+    if model_path not in _model_contents:
+        with open(model_path, 'rb') as f:
+            _model_contents[model_path] = f.read()
+
+
+def memory_usage() -> dict:
+    """
+    Returns the memory usage of this process in bytes, from /proc (Linux only, empty elsewhere).
+
+    'rss' counts all resident pages, including those shared with other processes (e.g. model weights), so summing it
+    over processes overestimates their total. 'pss' divides every shared page between the processes sharing it, so
+    it sums up to the actual total. 'shared' and 'private' split the resident pages.
+    """
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r', encoding='ascii') as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+        usage['rss'] = fields.get('Rss', 0)
+        usage['pss'] = fields.get('Pss', 0)
+        usage['shared'] = fields.get('Shared_Clean', 0) + fields.get('Shared_Dirty', 0)
+        usage['private'] = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    except OSError:
+        try:
+            with open('/proc/self/statm', 'r', encoding='ascii') as f:
+                _, resident, shared = (int(value) for value in f.read().split()[:3])
+            page_size = os.sysconf('SC_PAGE_SIZE')
+            usage['rss'] = resident * page_size
+            usage['shared'] = shared * page_size
+        except OSError:
+            pass
+    return usage
+
+
+class ModelSession:
+    """
+    A loaded TFLite model, with its signature runner and input/output details cached.
+
+    The model is loaded from the buffer registered with `share_model` if there is one, or else from the file.
+
+    A session wraps a single interpreter and can be passed anywhere an interpreter is expected (e.g. `detect_objects`).
+    TFLite interpreters are not thread-safe, so a session must only be used by one thread at a time. Use a
+    `ModelPool` to share a model between concurrent callers.
+    """
+
+    def __init__(self, model_path: str, num_threads: int = None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        model_content = _model_contents.get(model_path)
+        if model_content is not None:
+            self.interpreter = _interpreter_class()(model_content=model_content, num_threads=num_threads)
+        else:
+            self.interpreter = _interpreter_class()(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._signature_runner = self.interpreter.get_signature_runner()
+        self._input_details = self.interpreter.get_input_details()
+        self._output_details = self.interpreter.get_output_details()
+        _, input_height, input_width, _ = self._input_details[0]['shape']
+        self.input_size = (int(input_height), int(input_width))
+        self._digest = None
+
+    @property
+    def digest(self):
+        """The SHA-256 digest of the model file"""
+        if self._digest is None:
+            self._digest = file_digest(self.model_path)
+        return self._digest
+
+    def get_signature_runner(self):
+        cache = _result_cache
+        if cache is None:
+            return self._signature_runner
+        return partial(self._run_cached, cache)
+
+    def _run_cached(self, cache, images):
+        """
+        Runs the model through the result cache. Each image of the batch is cached separately, so results are shared
+        between batched and single image calls. All model outputs are expected to have a leading batch dimension.
+        """
+        images = np.asarray(images)
+        keys = [cache.key(self.digest, images[i:i + 1]) for i in range(len(images))]
+        cached = [cache.get(key) for key in keys]
+        if len(cached) > 0 and all(outputs is not None for outputs in cached):
+            return {name: np.concatenate([outputs[name] for outputs in cached]) for name in cached[0]}
+
+        outputs = self._signature_runner(images=images)
+        for i, key in enumerate(keys):
+            if cached[i] is None:
+                cache.put(key, {name: value[i:i + 1] for name, value in outputs.items()})
+        return outputs
+
+    def get_input_details(self):
+        return self._input_details
+
+    def get_output_details(self):
+        return self._output_details
+
+
+class ModelPool:
+    """
+    A pool of sessions of the same model, for concurrent callers.
+
+    Sessions are created lazily (up to `size`) and handed out through `session()`. When all sessions are in use,
+    callers block until one is returned.
+    """
+
+    def __init__(self, model_path: str, size: int = 1, num_threads: int = None):
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def grow(self, size: int):
+        """Allows the pool to hold at least `size` sessions."""
+        with self._lock:
+            self.size = max(self.size, size)
+
+    @contextmanager
+    def session(self):
+        """Checks out a session for the duration of the `with` block."""
+        session = self._acquire()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if not create:
+            return self._idle.get()
+        try:
+            return ModelSession(self.model_path, self.num_threads)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(model_path: str, size: int = 1, num_threads: int = None) -> ModelPool:
+    """
+    Returns the shared pool of the given model, so that each `.tflite` file is only loaded once per process.
+
+    Args:
+        model_path (str): Path to the `.tflite` file.
+        size (int): Minimum number of interpreters the pool may hold for concurrent callers.
+        num_threads (int): Number of threads each interpreter uses, or None for the TFLite default.
+
+    Returns:
+        ModelPool: The pool for the given model path and thread count.
+    """
+    key = (model_path, num_threads)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ModelPool(model_path, size, num_threads)
+            _pools[key] = pool
+    pool.grow(size)
+    return pool
+
+
+def _interpreter_class():
+    """Returns the TFLite interpreter class, preferring the lightweight `tflite_runtime` over full TensorFlow"""
+    if Interpreter is not None:
+        return Interpreter
+    import tensorflow as tf
+    return tf.lite.Interpreter
@@ -0,0 +1,48 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_pipeline(items, decode, infer, encode, workers: int, queue_size: int = None):
+    """
+    Runs every item through three stages (decode -> infer -> encode), overlapping the stages.
+
+    The decode and encode stages each run on a pool of `workers` threads, which pays off for work that releases the
+    GIL (e.g. JPEG decoding and encoding in cv2/PIL). The infer stage runs on the calling thread, one item at a time
+    and in input order, so a single interpreter can be used for it. The queues between the stages are bounded, so at
+    most `queue_size` items are decoded ahead of inference and at most `queue_size` items wait to be encoded.
+
+    Args:
+        items (iterable): The input items, consumed lazily.
+        decode (callable): Called with an item, on a decode thread.
+        infer (callable): Called with the result of `decode`, on the calling thread.
+        encode (callable): Called with the result of `infer`, on an encode thread.
+        workers (int): Number of threads in each of the decode and encode pools.
+        queue_size (int): Maximum number of items waiting between two stages (defaults to `2 * workers`).
+
+    Returns:
+        list: The results of `encode`, in input order.
+    """
+    queue_size = queue_size or 2 * workers
+    results = []
+    decoded = deque()
+    encoded = deque()
+
+    with ThreadPoolExecutor(workers, thread_name_prefix='decode') as decode_pool, \
+            ThreadPoolExecutor(workers, thread_name_prefix='encode') as encode_pool:
+
+        def infer_next():
+            inferred = infer(decoded.popleft().result())
+            encoded.append(encode_pool.submit(encode, inferred))
+            while len(encoded) > queue_size:
+                results.append(encoded.popleft().result())
+
+        for item in items:
+            decoded.append(decode_pool.submit(decode, item))
+            if len(decoded) > queue_size:
+                infer_next()
+        while decoded:
+            infer_next()
+        while encoded:
+            results.append(encoded.popleft().result())
+
+    return results
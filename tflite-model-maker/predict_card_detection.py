@@ -1,74 +1,281 @@
+import argparse
 import os.path
+from contextlib import ExitStack
+from functools import partial
 
-import tensorflow as tf
+import cv2
 from PIL import Image
 
+import instrumentation
+import predict_shape_detection
+import recognition
+from model_session import get_pool, use_result_cache
+from pipeline import run_pipeline
 from predict_utils import preprocess_image, detect_objects, filter_objects_by_overlap, draw_results, \
-    target_to_image_names, extract_objects
-
-# Load the TFLite model
-interpreter = tf.lite.Interpreter(model_path='model_card_detection.tflite')
-interpreter.allocate_tensors()
+    target_to_image_names, extract_objects, detect_objects_batch, preprocess_image_from_rgb, tiles_per_side, \
+    tile_regions, detect_objects_tiled
+from result_cache import ResultCache
+from tracking import CardTracker
 
+MODEL_PATH = 'model_card_detection.tflite'
+NUM_THREADS = None
 CLASSES = ['card']
 COLORS = [[255, 0, 0]]
 DETECTION_THRESHOLD = 0.5
 OVERLAP_THRESHOLD = 0.3
+BATCH_SIZE = 8
+MAX_DETECTION_INTERVAL = 8
+# Tiling: cards whose shorter side is below TILE_MIN_CARD_SIZE pixels in the model input are detected again on tiles
+TILE_MIN_CARD_SIZE = 48
+TILE_OVERLAP = 0.25
+MAX_TILES_PER_SIDE = 4
+
+
+def model_pool(size: int = 1):
+    """Returns the pool of card detection interpreters, loading the model on first use"""
+    return get_pool(MODEL_PATH, size=size, num_threads=NUM_THREADS)
 
 
-def run_odt(image_path):
+def run_odt(image_path, session=None, tile=False):
     """Run object detection on the input image and draw the detection results"""
-    # Load the input shape required by the model
-    _, input_height, input_width, _ = interpreter.get_input_details()[0]['shape']
+    if session is None:
+        with model_pool().session() as session:
+            return run_odt(image_path, session, tile)
 
     # Load the input image and preprocess it
-    preprocessed_image, original_image = preprocess_image(
-        image_path,
-        (input_height, input_width)
-    )
+    preprocessed_image, original_image = preprocess_image(image_path, session.input_size)
 
     # Run object detection on the input image
-    raw_results = detect_objects(interpreter, CLASSES, preprocessed_image, threshold=DETECTION_THRESHOLD)
+    raw_results = detect_objects(session, CLASSES, preprocessed_image, threshold=DETECTION_THRESHOLD)
+    if tile:
+        raw_results = refine_with_tiles(session, original_image, raw_results)
+    return original_image, _filter(image_path, raw_results)
+
+
+def refine_with_tiles(session, original_image, raw_results):
+    """
+    Detects the cards again on overlapping tiles of the image if the cards found on the whole image are small, or if
+    no cards were found on it, so that small cards in wide, high resolution shots are not lost by resizing the image
+    down to the model input.
+
+    Returns:
+        list: The raw results of the whole image, plus those of the tiles. Duplicates are left to the overlap filter.
+    """
+    tiles = tiles_per_side(raw_results, session.input_size, TILE_MIN_CARD_SIZE, MAX_TILES_PER_SIDE)
+    if tiles == 1:
+        return raw_results
+    regions = tile_regions(original_image.shape, tiles, TILE_OVERLAP)
+    return raw_results + detect_objects_tiled(session, CLASSES, original_image, regions, DETECTION_THRESHOLD)
+
+
+def run_odt_batch(image_paths, session=None, tile=False):
+    """Run object detection on multiple input images, returning an (original image, results) tuple per image"""
+    if session is None:
+        with model_pool().session() as session:
+            return run_odt_batch(image_paths, session, tile)
+
+    original_images = []
+
+    def preprocessed_images():
+        for image_path in image_paths:
+            preprocessed_image, original_image = preprocess_image(image_path, session.input_size)
+            original_images.append(original_image)
+            yield preprocessed_image
+
+    raw_results = detect_objects_batch(session, CLASSES, preprocessed_images(), threshold=DETECTION_THRESHOLD)
+
+    outputs = []
+    for image_path, original_image, raw in zip(image_paths, original_images, raw_results):
+        if tile:
+            raw = refine_with_tiles(session, original_image, raw)
+        outputs.append((original_image, _filter(image_path, raw)))
+    return outputs
+
+
+def _filter(image_path, raw_results):
     filtered_results = filter_objects_by_overlap(raw_results, OVERLAP_THRESHOLD)
     print(f'Found {len(filtered_results)} ({len(raw_results)} before filtering) objects in {image_path}')
+    return filtered_results
 
-    return original_image, filtered_results
 
+def _batches(images_dir, image_names, tile):
+    for start in range(0, len(image_names), BATCH_SIZE):
+        batch_names = image_names[start:start + BATCH_SIZE]
+        batch_paths = [os.path.join(images_dir, image_name) for image_name in batch_names]
+        yield zip(batch_names, run_odt_batch(batch_paths, tile=tile))
 
-def predict(target: str, save: bool):
-    if save:
-        output_dir = 'output-card-extraction'
-        os.makedirs(output_dir, exist_ok=True)
-    images_dir, image_names = target_to_image_names(target)
-    for image_name in image_names:
-        image_path = os.path.join(images_dir, image_name)
-        original_image, results = run_odt(image_path)
-        detection_result_image = draw_results(COLORS, original_image, results)
-        if save:
-            Image.fromarray(detection_result_image).save(f'{output_dir}/{image_name}')
+
+def _pipelined(images_dir, image_names, output, workers, tile):
+    """Runs detection with decoding and `output` overlapped on `workers` threads each (see `pipeline.run_pipeline`)"""
+    with model_pool().session() as session:
+        def decode(image_name):
+            image_path = os.path.join(images_dir, image_name)
+            preprocessed_image, original_image = preprocess_image(image_path, session.input_size)
+            return image_path, preprocessed_image, original_image
+
+        def infer(decoded):
+            image_path, preprocessed_image, original_image = decoded
+            raw_results = detect_objects(session, CLASSES, preprocessed_image, threshold=DETECTION_THRESHOLD)
+            if tile:
+                raw_results = refine_with_tiles(session, original_image, raw_results)
+            return os.path.basename(image_path), original_image, _filter(image_path, raw_results)
+
+        run_pipeline(image_names, decode, infer, lambda inferred: output(*inferred), workers)
+
+
+def _output_prediction(output_dir, image_name, original_image, results):
+    detection_result_image = draw_results(COLORS, original_image, results, copy=False)
+    if output_dir is not None:
+        Image.fromarray(detection_result_image).save(f'{output_dir}/{image_name}')
+    else:
+        Image.fromarray(detection_result_image).show()
+
+
+def _output_extraction(output_dir, image_name, original_image, results):
+    extracted_objects = extract_objects(original_image, results)
+    for i, extracted_object in enumerate(extracted_objects):
+        if output_dir is not None:
+            base_image_name = image_name.replace('.jpg', '')
+            Image.fromarray(extracted_object).save(f'{output_dir}/{base_image_name}-{i}.jpg')
         else:
-            Image.fromarray(detection_result_image).show()
+            Image.fromarray(extracted_object).show()
 
 
-def extract(target: str, save: bool):
+def _run(target: str, save: bool, workers: int, tile: bool, output):
+    output_dir = None
     if save:
         output_dir = 'output-card-extraction'
         os.makedirs(output_dir, exist_ok=True)
     images_dir, image_names = target_to_image_names(target)
-    for image_name in image_names:
-        image_path = os.path.join(images_dir, image_name)
-        original_image, results = run_odt(image_path)
-        extracted_objects = extract_objects(original_image, results)
-        for i, extracted_object in enumerate(extracted_objects):
-            if save:
-                base_image_name = image_name.replace('.jpg', '')
-                Image.fromarray(extracted_object).save(f'{output_dir}/{base_image_name}-{i}.jpg')
-            else:
-                Image.fromarray(extracted_object).show()
+    # Showing the images opens viewers, which must not happen from the encode threads, so that is only done serially
+    if workers > 0 and output_dir is not None:
+        _pipelined(images_dir, image_names, partial(output, output_dir), workers, tile)
+        return
+    for batch in _batches(images_dir, image_names, tile):
+        for image_name, (original_image, results) in batch:
+            output(output_dir, image_name, original_image, results)
+
+
+def predict(target: str, save: bool, workers: int = 0, tile: bool = False):
+    _run(target, save, workers, tile, _output_prediction)
+
+
+def extract(target: str, save: bool, workers: int = 0, tile: bool = False):
+    _run(target, save, workers, tile, _output_extraction)
+
+
+def track_video(source: str, max_detection_interval: int = MAX_DETECTION_INTERVAL, card_session=None,
+                shape_session=None):
+    """
+    Detects, tracks and recognizes the cards in a video file or camera feed.
+
+    Card detection runs on every frame while the cards are changing. While nothing changes, the interval between
+    detections doubles, up to `max_detection_interval` frames. Detections are associated with the cards of earlier
+    frames (see `tracking.CardTracker`), and only cards that are new or have moved are recognized again.
+
+    Args:
+        source (str): A video file, or the index of a camera device (e.g. '0' for /dev/video0).
+        max_detection_interval (int): Maximum number of frames between two card detection passes.
+        card_session: The card detection session to use, or None to use one from the shared pool.
+        shape_session: The shape detection session to use, or None to use one from the shared pool.
+
+    Yields:
+        tuple: The frame index, the frame (as an RGB array) and the current tracks (see `tracking.Track`).
+    """
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError(f'Unable to open video source [{source}]')
+
+    with ExitStack() as stack:
+        stack.callback(capture.release)
+        if card_session is None:
+            card_session = stack.enter_context(model_pool().session())
+        if shape_session is None:
+            shape_session = stack.enter_context(predict_shape_detection.model_pool().session())
+
+        tracker = CardTracker()
+        interval = 1
+        next_detection = 0
+        frame_index = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+            if frame_index >= next_detection:
+                preprocessed_image, _ = preprocess_image_from_rgb(rgb, card_session.input_size)
+                raw_results = detect_objects(card_session, CLASSES, preprocessed_image, threshold=DETECTION_THRESHOLD)
+                changed = tracker.update(filter_objects_by_overlap(raw_results, OVERLAP_THRESHOLD))
+                for track in tracker.tracks:
+                    if track.needs_recognition and track.missed == 0:
+                        crop = recognition.crop_box(rgb, track.box)
+                        if crop.size > 0:
+                            track.recognized(recognition.recognize_card(crop, shape_session=shape_session))
+                interval = 1 if changed else min(interval * 2, max_detection_interval)
+                next_detection = frame_index + interval
+
+            yield frame_index, rgb, tracker.tracks
+            frame_index += 1
+
+
+def stream(source: str, show: bool, max_detection_interval: int = MAX_DETECTION_INTERVAL):
+    """Prints the recognized cards of a video file or camera feed whenever they change, optionally showing the frames"""
+    previous_cards = None
+    for frame_index, rgb, tracks in track_video(source, max_detection_interval):
+        cards = sorted(str(track.card) for track in tracks if track.card is not None)
+        if cards != previous_cards:
+            print(f'Frame {frame_index}: {len(cards)} cards {" ".join(cards)}')
+            previous_cards = cards
+        if show:
+            results = [
+                {'bounding_box': track.box, 'class_id': 0, 'class_name': str(track.card or '?'), 'score': track.score}
+                for track in tracks
+            ]
+            cv2.imshow(source, cv2.cvtColor(draw_results(COLORS, rgb, results, copy=False), cv2.COLOR_RGB2BGR))
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
 
 
 if __name__ == '__main__':
-    # predict('data-cards/images', True)
-    predict('data-cards/images/b0972e8e-set-card-game-real-8.jpg', False)
-    # extract('data-cards/images', True)
-    # extract('data-cards/images/76f09a9d-set-card-game-real-12.jpg', False)
+    parser = argparse.ArgumentParser(description='Run card detection on an image or a directory of images, or on a '
+                                                 'video.')
+    parser.add_argument('mode', choices=['predict', 'extract', 'stream'],
+                        help='predict: annotate the detected cards, extract: crop out each detected card, '
+                             'stream: track and recognize the cards in a video file or camera feed')
+    parser.add_argument('target', help='an image, or a directory of images (e.g. data-cards/images), or for stream a '
+                                       'video file or camera index (e.g. 0)')
+    parser.add_argument('--save', action='store_true', help='write the output to output-card-extraction instead of '
+                                                            'showing it')
+    parser.add_argument('--show', action='store_true', help='show the annotated frames while streaming (q quits)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of threads to decode and encode images on, overlapped with inference, with '
+                             '--save only (default: 0, which runs everything serially)')
+    parser.add_argument('--max-detection-interval', type=int, default=MAX_DETECTION_INTERVAL,
+                        help='maximum number of frames between card detections while streaming a static scene '
+                             f'(default: {MAX_DETECTION_INTERVAL})')
+    parser.add_argument('--tile', action='store_true',
+                        help='detect the cards again on overlapping tiles of images in which the detected cards are '
+                             'small or no cards are detected, e.g. wide high resolution shots (predict and extract '
+                             'only)')
+    parser.add_argument('--no-cache', action='store_true', help='always run the model, even for unchanged images')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='record per stage timings and counts to FILE: Prometheus text if it ends with .prom, '
+                             'otherwise one JSON event per line')
+    parser.add_argument('--track-allocations', action='store_true',
+                        help='also record the bytes allocated per stage with --metrics (slows everything down)')
+    args = parser.parse_args()
+
+    with ExitStack() as stack:
+        if not args.no_cache and args.mode != 'stream':
+            use_result_cache(stack.enter_context(ResultCache()))
+            stack.callback(use_result_cache, None)
+        if args.metrics:
+            stack.enter_context(instrumentation.export_to(args.metrics))
+            instrumentation.track_allocations(args.track_allocations)
+        if args.mode == 'predict':
+            predict(args.target, args.save, args.workers, args.tile)
+        elif args.mode == 'extract':
+            extract(args.target, args.save, args.workers, args.tile)
+        else:
+            stream(args.target, args.show, args.max_detection_interval)
@@ -1,17 +1,17 @@
+import argparse
 import os.path
 
 import numpy as np
-import tensorflow as tf
 from PIL import Image
 
 from card_model import Card
+from model_session import get_pool, use_result_cache
 from predict_utils import preprocess_image, detect_objects, filter_objects_by_overlap, draw_results, \
     target_to_image_names, preprocess_image_from_opencv
+from result_cache import ResultCache
 
-# Load the TFLite model
-interpreter = tf.lite.Interpreter(model_path='model_shape_detection.tflite')
-interpreter.allocate_tensors()
-
+MODEL_PATH = 'model_shape_detection.tflite'
+NUM_THREADS = None
 CLASSES = [
     'oval-empty', 'oval-filled', 'oval-partial',
     'rhombus-empty', 'rhombus-filled', 'rhombus-partial',
@@ -22,18 +22,24 @@ DETECTION_THRESHOLD = 0.3
 OVERLAP_THRESHOLD = 0.3
 
 
-def run_odt(image_name, opencv_image=None):
+def model_pool(size: int = 1):
+    """Returns the pool of shape detection interpreters, loading the model on first use"""
+    return get_pool(MODEL_PATH, size=size, num_threads=NUM_THREADS)
+
+
+def run_odt(image_name, opencv_image=None, session=None):
     """Run object detection on the input image and draw the detection results"""
-    # Load the input shape required by the model
-    _, input_height, input_width, _ = interpreter.get_input_details()[0]['shape']
+    if session is None:
+        with model_pool().session() as session:
+            return run_odt(image_name, opencv_image, session)
 
     # Load the input image and preprocess it
-    input_size = (input_height, input_width)
+    input_size = session.input_size
     preprocessed_image, original_image = preprocess_image(image_name, input_size) \
         if opencv_image is None else preprocess_image_from_opencv(opencv_image, input_size)
 
     # Run object detection on the input image
-    raw_results = detect_objects(interpreter, CLASSES, preprocessed_image, threshold=DETECTION_THRESHOLD)
+    raw_results = detect_objects(session, CLASSES, preprocessed_image, threshold=DETECTION_THRESHOLD)
     filtered_results = filter_objects_by_overlap(raw_results, OVERLAP_THRESHOLD)
     # print(f'Found {len(filtered_results)} ({len(raw_results)} before filtering) objects in {image_name}')
     if len(set([x['class_id'] for x in filtered_results])) > 1:
@@ -53,8 +59,9 @@ def predict(target: str, save: bool, show: bool):
         original_image, results = run_odt(image_path)
         found_class = CLASSES[int(results[0]['class_id'])]
         if len(results) != card.count or found_class != f'{card.shape.to_long()}-{card.filling.to_long()}':
-            print(f'Found mismatch in {image_path}, expected {card}, found class {found_class}, results ({len(results)} {results}')
-        detection_result_image = draw_results(COLORS, original_image, results)
+            print(f'Found mismatch in {image_path}, expected {card}, found class {found_class}, '
+                  f'results ({len(results)}) {results}')
+        detection_result_image = draw_results(COLORS, original_image, results, copy=False)
 
         if save:
             Image.fromarray(detection_result_image).save(f'{output_dir}/{image_name}')
@@ -63,5 +70,18 @@ def predict(target: str, save: bool, show: bool):
 
 
 if __name__ == '__main__':
-    # predict('data/images', True)
-    predict('data-shapes/images/set-card-game-real-11-rre3.jpg', False, True)
+    parser = argparse.ArgumentParser(description='Run shape detection on a card image or a directory of card images.')
+    parser.add_argument('target', nargs='?', default='data-shapes/images/set-card-game-real-11-rre3.jpg',
+                        help='a card image, or a directory of card images (e.g. data-shapes/images)')
+    parser.add_argument('--save', action='store_true', help='write the output to output-shape-detection')
+    parser.add_argument('--show', action='store_true', help='show the output')
+    parser.add_argument('--no-cache', action='store_true', help='always run the model, even for unchanged images')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        predict(args.target, args.save, args.show)
+    else:
+        with ResultCache() as cache:
+            use_result_cache(cache)
+            predict(args.target, args.save, args.show)
+            use_result_cache(None)
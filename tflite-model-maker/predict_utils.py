@@ -2,37 +2,205 @@ import os
 
 import cv2
 import numpy as np
-import tensorflow as tf
 
+from instrumentation import instrumented
 
+
+def _count_pixels(result, *_, **__):
+    return {'pixels': result[1].shape[0] * result[1].shape[1]}
+
+
+def _count_batch_detections(result, *_, **__):
+    return {'images': len(result), 'detections': sum(len(objects) for objects in result)}
+
+
+def read_image(image_path):
+    """Reads an image from disk as an RGB array"""
+    # Like tf.io.decode_image, ignore the EXIF orientation and always decode to 3 channels
+    img = cv2.imread(image_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise FileNotFoundError(f'Unable to read image [{image_path}]')
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+@instrumented('preprocess_image', counts=_count_pixels)
 def preprocess_image(image_path, input_size):
     """Preprocess the input image to feed to the TFLite model"""
-    img = tf.io.read_file(image_path)
-    img = tf.io.decode_image(img, channels=3)
-    img = tf.image.convert_image_dtype(img, tf.uint8)
-    original_image = img
-    resized_img = tf.image.resize(img, input_size)
-    resized_img = resized_img[tf.newaxis, :]
-    resized_img = tf.cast(resized_img, dtype=tf.uint8)
-    return resized_img, original_image
+    original_image = read_image(image_path)
+    return _resize_for_model(original_image, input_size), original_image
 
 
+@instrumented('preprocess_image_from_opencv', counts=_count_pixels)
 def preprocess_image_from_opencv(cv2_img, input_size):
     """Preprocess the input image to feed to the TFLite model"""
-    rgb = cv2.cvtColor(cv2_img, cv2.COLOR_BGR2RGB)
-    img = tf.convert_to_tensor(rgb, dtype=tf.uint8)
-    original_image = img
-    resized_img = tf.image.resize(img, input_size)
-    resized_img = resized_img[tf.newaxis, :]
-    resized_img = tf.cast(resized_img, dtype=tf.uint8)
-    return resized_img, original_image
+    if cv2_img.ndim == 2:
+        original_image = cv2.cvtColor(cv2_img, cv2.COLOR_GRAY2RGB)
+    else:
+        original_image = cv2.cvtColor(cv2_img, cv2.COLOR_BGR2RGB)
+    return _resize_for_model(original_image, input_size), original_image
+
+
+@instrumented('preprocess_image_from_rgb', counts=_count_pixels)
+def preprocess_image_from_rgb(rgb, input_size):
+    """Preprocess the input image, already decoded to an RGB array, to feed to the TFLite model"""
+    return _resize_for_model(rgb, input_size), rgb
 
 
+def _resize_for_model(rgb, input_size):
+    """Resizes an RGB image to the (height, width) input size and adds the batch dimension"""
+    input_height, input_width = input_size
+    resized_img = cv2.resize(rgb, (int(input_width), int(input_height)), interpolation=cv2.INTER_LINEAR)
+    return resized_img[np.newaxis, :]
+
+
+@instrumented('detect_objects', counts=lambda result, *_, **__: {'images': 1, 'detections': len(result)})
 def detect_objects(interpreter, classes, image, threshold):
     """Returns a list of detection results, each a dictionary of object info."""
 
     signature_fn = interpreter.get_signature_runner()
+    return _run_single(signature_fn, classes, image, threshold)
+
+
+@instrumented('detect_objects_batch', counts=_count_batch_detections)
+def detect_objects_batch(interpreter, classes, images, threshold):
+    """
+    Runs object detection on multiple preprocessed images.
+
+    If the model accepts a dynamic batch dimension, all images are stacked into a single [N, H, W, 3] tensor and the
+    model is invoked once. Otherwise, the images are fed one at a time through a single signature runner.
+
+    Args:
+        interpreter: The TFLite interpreter (or `ModelSession`) of the model.
+        classes (list): The class names of the model.
+        images (iterable): Preprocessed images, each of shape [1, H, W, 3] (as returned by `preprocess_image`).
+        threshold (float): Minimum score for a detection to be included.
+
+    Returns:
+        list: A list with, for each input image, the list of detection results (see `detect_objects`).
+    """
+    signature_fn = interpreter.get_signature_runner()
+
+    if not supports_batching(interpreter):
+        # The batch dimension is fixed, so run the images through the same signature runner one by one. The images
+        # are consumed lazily, which allows callers to pass a generator that preprocesses the next image on demand.
+        return [_run_single(signature_fn, classes, image, threshold) for image in images]
+
+    images = [np.asarray(image) for image in images]
+    if len(images) == 0:
+        return []
+    batch = np.concatenate(images, axis=0)
+    output = signature_fn(images=batch)
+
+    counts = np.reshape(output['output_0'], (len(images),))
+    scores = np.reshape(output['output_1'], (len(images), -1))
+    class_ids = np.reshape(output['output_2'], (len(images), -1))
+    boxes = np.reshape(output['output_3'], (len(images), -1, 4))
+
+    return [
+        _to_results(classes, int(counts[i]), scores[i], class_ids[i], boxes[i], threshold)
+        for i in range(len(images))
+    ]
 
+
+def supports_batching(interpreter):
+    """Returns whether the batch dimension of the model input can be resized to more than one image."""
+    shape_signature = interpreter.get_input_details()[0].get('shape_signature')
+    return shape_signature is not None and len(shape_signature) > 0 and shape_signature[0] == -1
+
+
+def tiles_per_side(results, input_size, min_object_size, max_tiles_per_side, empty_tiles_per_side=None):
+    """
+    Returns how many tiles per side an image should be split into for its objects to be detected reliably, based on
+    the results of a detection pass over the whole image: 1 (no tiling) if the objects are large enough in the model
+    input, otherwise enough tiles to scale the median object up to `min_object_size` model input pixels. If nothing
+    was detected, the objects may all be too small to be detected on the whole image, so it is tiled anyway.
+
+    Args:
+        results (list): Detection results of the whole image (see `detect_objects`).
+        input_size (tuple): The (height, width) of the model input.
+        min_object_size (int): The minimum size, in model input pixels, of the shorter side of an object.
+        max_tiles_per_side (int): The maximum number of tiles per side.
+        empty_tiles_per_side (int): The number of tiles per side if nothing was detected (default: the maximum).
+    """
+    if len(results) == 0:
+        return max_tiles_per_side if empty_tiles_per_side is None else empty_tiles_per_side
+    boxes = np.stack([obj['bounding_box'] for obj in results])
+    input_height, input_width = input_size
+    sizes = np.minimum((boxes[:, 2] - boxes[:, 0]) * input_height, (boxes[:, 3] - boxes[:, 1]) * input_width)
+    median_size = float(np.median(sizes))
+    if median_size >= min_object_size:
+        return 1
+    return int(min(max_tiles_per_side, np.ceil(min_object_size / max(median_size, 1.0))))
+
+
+def tile_regions(image_shape, tiles_per_side, overlap):
+    """
+    Splits an image into a grid of overlapping tiles.
+
+    Args:
+        image_shape (tuple): The shape of the image, starting with (height, width).
+        tiles_per_side (int): The number of tiles per side.
+        overlap (float): The fraction of a tile that overlaps with its neighbor. Objects smaller than the overlap are
+                         fully inside at least one tile.
+
+    Returns:
+        list: The [ymin, xmin, ymax, xmax] pixel coordinates of every tile.
+    """
+    height, width = image_shape[:2]
+    # n tiles of size t, overlapping by overlap * t, cover n * t - (n - 1) * overlap * t pixels
+    tile_height = height / (tiles_per_side - (tiles_per_side - 1) * overlap)
+    tile_width = width / (tiles_per_side - (tiles_per_side - 1) * overlap)
+    regions = []
+    for row in range(tiles_per_side):
+        for column in range(tiles_per_side):
+            ymin = int(round(row * tile_height * (1 - overlap)))
+            xmin = int(round(column * tile_width * (1 - overlap)))
+            regions.append([ymin, xmin, min(height, int(round(ymin + tile_height))),
+                            min(width, int(round(xmin + tile_width)))])
+    return regions
+
+
+def detect_objects_tiled(interpreter, classes, rgb, regions, threshold, edge_margin=0.01):
+    """
+    Runs object detection on tiles of an image, in one batch if the model supports it.
+
+    Objects touching an edge of a tile that lies inside the image are dropped: they are cut off by the tile, and are
+    detected in full in an overlapping tile.
+
+    Args:
+        interpreter: The TFLite interpreter (or `ModelSession`) of the model.
+        classes (list): The class names of the model.
+        rgb (numpy.ndarray): The full RGB image.
+        regions (list): The tiles to run detection on (see `tile_regions`).
+        threshold (float): Minimum score for a detection to be included.
+        edge_margin (float): The distance, relative to the tile, within which an object touches an edge.
+
+    Returns:
+        list: The detection results of all tiles, with bounding boxes relative to the full image.
+    """
+    height, width = rgb.shape[:2]
+    input_size = interpreter.get_input_details()[0]['shape'][1:3]
+    images = (_resize_for_model(rgb[ymin:ymax, xmin:xmax], input_size) for ymin, xmin, ymax, xmax in regions)
+    tile_results = detect_objects_batch(interpreter, classes, images, threshold)
+
+    results = []
+    for (ymin, xmin, ymax, xmax), objects in zip(regions, tile_results):
+        # Only the edges of the tile that are not on the edge of the image cut off objects
+        inner_edges = np.array([ymin > 0, xmin > 0, ymax < height, xmax < width])
+        scale = np.array([ymax - ymin, xmax - xmin, ymax - ymin, xmax - xmin], dtype=np.float32)
+        offset = np.array([ymin, xmin, ymin, xmin], dtype=np.float32)
+        size = np.array([height, width, height, width], dtype=np.float32)
+        for obj in objects:
+            box = np.asarray(obj['bounding_box'], dtype=np.float32)
+            touches = np.array([box[0] < edge_margin, box[1] < edge_margin,
+                                box[2] > 1 - edge_margin, box[3] > 1 - edge_margin])
+            if np.any(touches & inner_edges):
+                continue
+            results.append({**obj, 'bounding_box': (box * scale + offset) / size})
+    return results
+
+
+def _run_single(signature_fn, classes, image, threshold):
     # Feed the input image to the model
     output = signature_fn(images=image)
 
@@ -41,7 +209,10 @@ def detect_objects(interpreter, classes, image, threshold):
     scores = np.squeeze(output['output_1'])
     class_ids = np.squeeze(output['output_2'])
     boxes = np.squeeze(output['output_3'])
+    return _to_results(classes, count, scores, class_ids, boxes, threshold)
+
 
+def _to_results(classes, count, scores, class_ids, boxes, threshold):
     results = []
     for i in range(count):
         if scores[i] >= threshold:
@@ -89,6 +260,75 @@ def calculate_overlap(rect1, rect2):
     return inter_area / area1
 
 
+def calculate_overlap_matrix(boxes):
+    """
+    Calculates, for every pair of boxes, the ratio of the first box's area that overlaps with the second box.
+
+    Parameters:
+    - boxes: array of shape (N, 4), each row [ymin, xmin, ymax, xmax]
+
+    Returns:
+    - overlap: array of shape (N, N), where overlap[i, j] == calculate_overlap(boxes[i], boxes[j])
+    """
+    boxes = np.asarray(boxes)
+    ymin, xmin, ymax, xmax = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+
+    # Width and height of the intersection of every pair of boxes
+    inter_width = np.maximum(0, np.minimum(xmax[:, None], xmax[None, :]) - np.maximum(xmin[:, None], xmin[None, :]))
+    inter_height = np.maximum(0, np.minimum(ymax[:, None], ymax[None, :]) - np.maximum(ymin[:, None], ymin[None, :]))
+    inter_area = inter_width * inter_height
+
+    area = (ymax - ymin) * (xmax - xmin)
+    # Degenerate boxes have no overlap with anything (see calculate_overlap)
+    safe_area = np.where(area == 0, 1, area)
+    return np.where(area[:, None] == 0, 0, inter_area / safe_area[:, None])
+
+
+def filter_boxes_by_overlap(boxes, scores, overlap_threshold):
+    """
+    Determines which boxes to keep when discarding boxes that overlap with a higher scoring box.
+
+    Parameters:
+    - boxes: array of shape (N, 4), each row [ymin, xmin, ymax, xmax]
+    - scores: array of shape (N,)
+    - overlap_threshold: float, percentage above which a box will be filtered out
+
+    Returns:
+    - keep: boolean array of shape (N,), True for the boxes to keep
+    """
+    n = len(scores)
+    keep = np.ones(n, dtype=bool)
+    if n < 2:
+        return keep
+
+    scores = np.asarray(scores)
+    overlap = calculate_overlap_matrix(boxes)
+    conflicts = (overlap > overlap_threshold) | (overlap.T > overlap_threshold)
+
+    for i in range(n):
+        if not keep[i]:
+            continue  # Already marked for removal
+
+        # Kept boxes after i that conflict with i, in order
+        candidates = np.flatnonzero(conflicts[i, i + 1:] & keep[i + 1:]) + i + 1
+        if len(candidates) == 0:
+            continue
+
+        # i removes every conflicting box with a lower score, until it meets one with an equal or higher score,
+        # which removes i instead.
+        stronger = scores[candidates] >= scores[i]
+        if stronger.any():
+            first_stronger = int(np.argmax(stronger))
+            keep[candidates[:first_stronger]] = False
+            keep[i] = False
+        else:
+            keep[candidates] = False
+
+    return keep
+
+
+@instrumented('filter_objects_by_overlap',
+              counts=lambda result, objects, *_, **__: {'raw': len(objects), 'filtered': len(result)})
 def filter_objects_by_overlap(objects, overlap_threshold):
     """
     Filters out objects that have more than a given overlap percentage with any other object.
@@ -100,44 +340,87 @@ def filter_objects_by_overlap(objects, overlap_threshold):
     Returns:
     - filtered_objects: list of dicts, objects with no high-overlap neighbors
     """
-    keep = [True] * len(objects)
+    if len(objects) < 2:
+        return list(objects)
 
-    for i in range(len(objects)):
-        if not keep[i]:
-            continue  # Already marked for removal
+    boxes = np.stack([obj['bounding_box'] for obj in objects])
+    scores = np.array([obj['score'] for obj in objects])
+    keep = filter_boxes_by_overlap(boxes, scores, overlap_threshold)
 
-        box_i = objects[i]['bounding_box']
+    filtered_objects = [obj for obj, k in zip(objects, keep) if k]
+    return filtered_objects
 
-        for j in range(i + 1, len(objects)):
-            if not keep[j]:
-                continue  # Already marked for removal
 
-            box_j = objects[j]['bounding_box']
-            overlap_i = calculate_overlap(box_i, box_j)
-            overlap_j = calculate_overlap(box_j, box_i)
+def pixel_box(box, image_shape):
+    """Converts a relative [ymin, xmin, ymax, xmax] box to (ymin, xmin, ymax, xmax) pixel coordinates in an image"""
+    height, width = image_shape[:2]
+    ymin, xmin, ymax, xmax = box
+    return (max(0, int(ymin * height)), max(0, int(xmin * width)),
+            max(0, int(ymax * height)), max(0, int(xmax * width)))
 
-            if overlap_i > overlap_threshold or overlap_j > overlap_threshold:
-                if objects[i]['score'] > objects[j]['score']:
-                    keep[j] = False  # Keep i, remove j
-                else:
-                    keep[i] = False  # Keep j, remove i
-                    break  # No need to check i further, it’s removed
 
-    filtered_objects = [obj for obj, k in zip(objects, keep) if k]
-    return filtered_objects
+class CropView:
+    """
+    A crop of a frame, which only holds a reference to the frame and the pixel coordinates of the crop.
+
+    `array` is a view on the frame, so it shares the frame's memory and reflects changes to the frame. Use `copy()`
+    to materialize a crop that has to outlive changes to (or reuse of) the frame buffer.
+    """
+
+    __slots__ = ('frame', 'box', 'pixel_box')
+
+    def __init__(self, frame, box):
+        self.frame = frame
+        self.box = box
+        self.pixel_box = pixel_box(box, frame.shape)
+
+    @property
+    def array(self):
+        ymin, xmin, ymax, xmax = self.pixel_box
+        return self.frame[ymin:ymax, xmin:xmax]
+
+    @property
+    def shape(self):
+        ymin, xmin, ymax, xmax = self.pixel_box
+        return (max(0, ymax - ymin), max(0, xmax - xmin)) + self.frame.shape[2:]
+
+    def copy(self):
+        return self.array.copy()
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.array
+        return array if dtype is None else array.astype(dtype, copy=False)
 
 
-def draw_results(colors, original_image, results):
+@instrumented('draw_results',
+              counts=lambda result, colors, original_image, results, *_, **__: {'objects': len(results)})
+def draw_results(colors, original_image, results, copy=True):
+    """
+    Draws the bounding boxes and labels of detection results on an image.
+
+    Args:
+        colors (list): The color per class id.
+        original_image (numpy.ndarray): The RGB uint8 image.
+        results (list): The detection results (see `detect_objects`).
+        copy (bool): Whether to draw on a copy of the image. With False, the image itself is drawn on, which avoids
+                     a full-frame copy when the caller no longer needs the original.
+
+    Returns:
+        numpy.ndarray: The image with the results drawn on it.
+    """
+    if copy:
+        original_image_np = np.array(original_image, dtype=np.uint8)
+    else:
+        original_image_np = np.asarray(original_image)
+        if original_image_np.dtype != np.uint8 or not original_image_np.flags.writeable \
+                or not original_image_np.flags.c_contiguous:
+            raise ValueError(f'Invalid image to draw on in place [{original_image_np.dtype}], a writeable, contiguous '
+                             'uint8 array is required')
     # Plot the detection results on the input image
-    original_image_np = original_image.numpy().astype(np.uint8)
     for obj in results:
         # Convert the object bounding box from relative coordinates to absolute
         # coordinates based on the original image resolution
-        ymin, xmin, ymax, xmax = obj['bounding_box']
-        xmin = int(xmin * original_image_np.shape[1])
-        xmax = int(xmax * original_image_np.shape[1])
-        ymin = int(ymin * original_image_np.shape[0])
-        ymax = int(ymax * original_image_np.shape[0])
+        ymin, xmin, ymax, xmax = pixel_box(obj['bounding_box'], original_image_np.shape)
 
         # Find the class index of the current object
         class_id = int(obj['class_id'])
@@ -151,26 +434,19 @@ def draw_results(colors, original_image, results):
         cv2.putText(original_image_np, label, (xmin, y),
                     cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
     # Return the final image
-    original_uint8 = original_image_np.astype(np.uint8)
-    return original_uint8
+    return original_image_np
 
 
-def extract_objects(original_image, objects):
-    results = []
-    original_image_np = original_image.numpy().astype(np.uint8)
-    for obj in objects:
-        # Convert the object bounding box from relative coordinates to absolute
-        # coordinates based on the original image resolution
-        ymin, xmin, ymax, xmax = obj['bounding_box']
-        xmin = int(xmin * original_image_np.shape[1])
-        xmax = int(xmax * original_image_np.shape[1])
-        ymin = int(ymin * original_image_np.shape[0])
-        ymax = int(ymax * original_image_np.shape[0])
+def crop_objects(original_image, objects):
+    """Returns a `CropView` per object, without copying any pixels"""
+    frame = np.asarray(original_image)
+    return [CropView(frame, obj['bounding_box']) for obj in objects]
 
-        cropped = original_image_np[ymin:ymax, xmin:xmax]
-        results.append(cropped)
 
-    return results
+@instrumented('extract_objects', counts=lambda result, *_, **__: {'objects': len(result)})
+def extract_objects(original_image, objects):
+    """Returns the part of the image inside the bounding box of every object, as views on the image"""
+    return [crop.array for crop in crop_objects(np.asarray(original_image, dtype=np.uint8), objects)]
 
 
 def target_to_image_names(target: str) -> tuple[str, list[str]]:
@@ -0,0 +1,176 @@
+"""
+End-to-end recognition of the cards in a photo of a table.
+
+The cards are detected with the card detection model and cropped out of the frame in memory. Each crop is converted
+once to HSV (for the color analysis) and once to grayscale (for the shape detection model), without writing anything
+to disk in between.
+
+Usage:
+    python recognition.py <image_or_directory>
+"""
+import os
+import sys
+import time
+from contextlib import contextmanager, ExitStack
+
+import cv2
+import numpy as np
+
+import predict_card_detection
+import predict_shape_detection
+from analyze_card_color import analyze_card_color_hsv
+from card_model import Card, Color, Shape, Filling
+from predict_utils import detect_objects, filter_objects_by_overlap, preprocess_image_from_rgb, read_image, pixel_box, \
+    target_to_image_names
+
+
+@contextmanager
+def _timed(timings, stage):
+    """Adds the time spent in the `with` block to `timings[stage]`, if timings are being collected"""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def recognize(image, timings=None, card_session=None, shape_session=None):
+    """
+    Recognizes all cards in an image of a table.
+
+    Args:
+        image (numpy.ndarray): The full image, as an RGB array (e.g. as returned by `read_image`).
+        timings (dict): If given, the seconds spent in each stage are added to it, keyed by stage name
+                        ('card_detection', 'crop', 'color', 'shape_input', 'shape_detection').
+        card_session: The card detection session to use, or None to use one from the shared pool.
+        shape_session: The shape detection session to use, or None to use one from the shared pool.
+
+    Returns:
+        list: A list of (Card, bounding box) tuples, one for each card that could be recognized. The bounding box is
+              [ymin, xmin, ymax, xmax] relative to the image size.
+    """
+    with ExitStack() as stack:
+        if card_session is None:
+            card_session = stack.enter_context(predict_card_detection.model_pool().session())
+        if shape_session is None:
+            shape_session = stack.enter_context(predict_shape_detection.model_pool().session())
+
+        with _timed(timings, 'card_detection'):
+            preprocessed_image, _ = preprocess_image_from_rgb(image, card_session.input_size)
+            raw_results = detect_objects(card_session, predict_card_detection.CLASSES, preprocessed_image,
+                                         threshold=predict_card_detection.DETECTION_THRESHOLD)
+            card_results = filter_objects_by_overlap(raw_results, predict_card_detection.OVERLAP_THRESHOLD)
+
+        return recognize_detected(image, card_results, timings, shape_session)
+
+
+def recognize_detected(image, card_results, timings=None, shape_session=None):
+    """
+    Recognizes the cards at the (filtered) card detection results of an image, see `recognize`.
+
+    This allows running the card detection separately, e.g. on a batch of images.
+    """
+    if shape_session is None:
+        with predict_shape_detection.model_pool().session() as shape_session:
+            return recognize_detected(image, card_results, timings, shape_session)
+
+    recognized = []
+    for card_result in card_results:
+        box = card_result['bounding_box']
+        with _timed(timings, 'crop'):
+            crop = crop_box(image, box)
+        if crop.size == 0:
+            continue
+        card = recognize_card(crop, timings, shape_session)
+        if card is not None:
+            recognized.append((card, box))
+    return recognized
+
+
+def recognize_card(crop, timings=None, shape_session=None):
+    """
+    Recognizes a single card.
+
+    Args:
+        crop (numpy.ndarray): The RGB image of a single card.
+        timings (dict): See `recognize`.
+        shape_session: See `recognize`.
+
+    Returns:
+        Card: The recognized card, or None if the color or the shapes could not be determined.
+    """
+    colors, shape_results = analyze_card(crop, timings, shape_session)
+    return card_from_analysis(colors, shape_results)
+
+
+def analyze_card(crop, timings=None, shape_session=None):
+    """
+    Runs the color analysis and the shape detection on a single card.
+
+    Args:
+        crop (numpy.ndarray): The RGB image of a single card.
+        timings (dict): See `recognize`.
+        shape_session: See `recognize`.
+
+    Returns:
+        tuple: The detected colors (see `analyze_card_color`) and the filtered shape detection results.
+    """
+    if shape_session is None:
+        with predict_shape_detection.model_pool().session() as shape_session:
+            return analyze_card(crop, timings, shape_session)
+
+    with _timed(timings, 'color'):
+        colors = analyze_card_color_hsv(cv2.cvtColor(crop, cv2.COLOR_RGB2HSV))
+    if len(colors) == 0:
+        return colors, []
+
+    with _timed(timings, 'shape_input'):
+        # Resizing the single gray channel before expanding it to the three channels the model expects is cheaper
+        # than resizing three identical channels.
+        input_height, input_width = shape_session.input_size
+        gray = cv2.resize(cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY), (input_width, input_height),
+                          interpolation=cv2.INTER_LINEAR)
+        shape_input = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)[np.newaxis, :]
+
+    with _timed(timings, 'shape_detection'):
+        raw_results = detect_objects(shape_session, predict_shape_detection.CLASSES, shape_input,
+                                     threshold=predict_shape_detection.DETECTION_THRESHOLD)
+        shape_results = filter_objects_by_overlap(raw_results, predict_shape_detection.OVERLAP_THRESHOLD)
+    return colors, shape_results
+
+
+def card_from_analysis(colors, shape_results):
+    """Combines the color analysis and the shape detection results into a card, or None if either is empty"""
+    if len(colors) == 0 or len(shape_results) == 0:
+        return None
+    shape, filling = shape_results[0]['class_name'].split('-')
+    return Card(Color.from_short(colors[0]['color']), Shape.from_long(shape), Filling.from_long(filling),
+                len(shape_results))
+
+
+def crop_box(image, box):
+    """Returns the part of the image inside the relative [ymin, xmin, ymax, xmax] box, as a view on the image"""
+    ymin, xmin, ymax, xmax = pixel_box(box, image.shape)
+    return image[ymin:ymax, xmin:xmax]
+
+
+def main(target: str):
+    images_dir, image_names = target_to_image_names(target)
+    for image_name in image_names:
+        timings = {}
+        with _timed(timings, 'decode'):
+            image = read_image(os.path.join(images_dir, image_name))
+        cards = recognize(image, timings)
+        stages = ', '.join(f'{stage} {seconds * 1000:.1f}ms' for stage, seconds in timings.items())
+        print(f'Recognized {len(cards)} cards in {image_name}: {" ".join(str(card) for card, _ in cards)}')
+        print(f'  {stages}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Usage: python recognition.py <image_or_directory>')
+        sys.exit(1)
+    main(sys.argv[1])
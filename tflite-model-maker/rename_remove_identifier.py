@@ -4,20 +4,32 @@ removing the random UUID prefix and updating internal XML references accordingly
 
 This process is non-destructive and does not modify the original files.
 
+Finished pairs are recorded in a manifest in the destination directory, so an interrupted run
+resumes where it left off. Images can be hardlinked or reflinked instead of copied, which avoids
+copying the image bytes when the destination is on the same file system.
+
 Usage:
     1. Run it from the terminal, providing the path to the source directory
        containing your 'Annotations' and 'images' folders.
 
     Example:
        python rename_remove_identifier.py /path/to/your/dataset
+       python rename_remove_identifier.py /path/to/your/dataset --workers 16 --link hardlink
+       python rename_remove_identifier.py /path/to/your/dataset --dry-run
 """
+import argparse
+import errno
+import json
 import os
 import re
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuration ---
 DEST_DIR_NAME = 'renamed'  # The directory where processed files will be saved
+MANIFEST_NAME = '.manifest.jsonl'  # Records the finished pairs, inside the destination directory
+LINK_MODES = ('copy', 'hardlink', 'reflink')
 # ---------------------
 
 # Define the regex pattern to capture the random prefix and the rest of the filename
@@ -25,97 +37,253 @@ DEST_DIR_NAME = 'renamed'  # The directory where processed files will be saved
 # Group 2: (set-card-game-real-\d+(-[a-z0-9]+)?) -> The base name to keep with an optional suffix
 filename_pattern = re.compile(r'([a-z0-9]+-)(set-card-game-real-\d+(-[a-z0-9]+)?)')
 
+# The FICLONE ioctl (linux/fs.h), which makes the destination share the extents of the source
+_FICLONE = 0x40049409
+
+
+def _source_signature(path):
+    """Identifies the version of a source file, so that changed sources are processed again on resume"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _replace_atomically(dest_path, write):
+    """Calls write(temporary_path) and moves the result to dest_path, so dest_path is never left half written"""
+    temporary_path = f'{dest_path}.partial'
+    if os.path.lexists(temporary_path):
+        os.remove(temporary_path)
+    write(temporary_path)
+    os.replace(temporary_path, dest_path)
 
-def process_files(source_dir):
+
+def _reflink(source_path, dest_path):
+    try:
+        import fcntl
+    except ImportError:
+        # Not available on Windows, where the image is copied instead
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform') from None
+    with open(source_path, 'rb') as source, open(dest_path, 'wb') as dest:
+        fcntl.ioctl(dest.fileno(), _FICLONE, source.fileno())
+    shutil.copystat(source_path, dest_path)
+
+
+def link_image(source_path, dest_path, mode='copy'):
     """
-    Finds, renames, copies, and modifies the annotation and image files.
+    Places the image at source_path at dest_path.
+
+    Args:
+        source_path (str): The source image.
+        dest_path (str): The destination, which is replaced if it exists.
+        mode (str): 'copy' copies the bytes, 'hardlink' creates a hard link to the source and 'reflink' creates a
+                    copy-on-write clone of the source. Falls back to copying when the file system does not support
+                    the mode (e.g. across devices).
+
+    Returns:
+        str: The mode that was actually used.
     """
-    # Define source and destination paths based on the input
-    source_annotations_dir = os.path.join(source_dir, 'Annotations')
-    source_images_dir = os.path.join(source_dir, 'images')
-    dest_dir = os.path.join(source_dir, DEST_DIR_NAME)
-    dest_annotations_dir = os.path.join(dest_dir, 'Annotations')
-    dest_images_dir = os.path.join(dest_dir, 'images')
+    if mode not in LINK_MODES:
+        raise ValueError(f'Invalid link mode [{mode}]')
 
-    # 1. Create destination directories if they don't exist
-    print(f"Setting up destination directory: '{dest_dir}'")
-    os.makedirs(dest_annotations_dir, exist_ok=True)
-    os.makedirs(dest_images_dir, exist_ok=True)
+    if mode == 'hardlink':
+        try:
+            _replace_atomically(dest_path, lambda path: os.link(source_path, path))
+            return mode
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    elif mode == 'reflink':
+        try:
+            _replace_atomically(dest_path, lambda path: _reflink(source_path, path))
+            return mode
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF):
+                raise
 
-    # Check if source directories exist
-    if not os.path.isdir(source_annotations_dir):
-        print(f"Error: Source directory '{source_annotations_dir}' not found.")
-        return
+    _replace_atomically(dest_path, lambda path: shutil.copy2(source_path, path))
+    return 'copy'
 
-    print(f"Processing files from '{source_annotations_dir}' and '{source_images_dir}'...")
-    processed_count = 0
 
-    # Get a sorted list of files for predictable order
-    xml_files = sorted(os.listdir(source_annotations_dir))
+def find_pairs(source_dir):
+    """
+    Finds the XML/image pairs to rename.
+
+    Returns:
+        tuple: A list of pairs, each a dict with the old and new names and the source and destination paths, and a
+               list of (filename, reason) for the skipped files.
+    """
+    source_annotations_dir = os.path.join(source_dir, 'Annotations')
+    source_images_dir = os.path.join(source_dir, 'images')
+    dest_dir = os.path.join(source_dir, DEST_DIR_NAME)
 
-    # 2. Iterate through files in the Annotations directory
-    for old_xml_name in xml_files:
+    pairs = []
+    skipped = []
+    # Get a sorted list of files for predictable order
+    for old_xml_name in sorted(os.listdir(source_annotations_dir)):
         if not old_xml_name.endswith('.xml'):
-            print(f"  - Skipping '{old_xml_name}' (not an XML file).")
+            skipped.append((old_xml_name, 'not an XML file'))
             continue
         match = filename_pattern.match(old_xml_name)
         if not match:
-            print(f"  - Skipping '{old_xml_name}' (does not match pattern).")
+            skipped.append((old_xml_name, 'does not match pattern'))
             continue
 
-        # 3. Determine old and new filenames
         random_identifier = match.group(1)  # e.g., '1be2d382-'
         base_name = match.group(2)  # e.g., 'set-card-game-real-2'
-
         old_jpg_name = f"{random_identifier}{base_name}.jpg"
         new_jpg_name = f"{base_name}.jpg"
 
-        new_xml_name = f"{base_name}.xml"
-
-        source_xml_path = os.path.join(source_annotations_dir, old_xml_name)
-        dest_xml_path = os.path.join(dest_annotations_dir, new_xml_name)
-
         source_jpg_path = os.path.join(source_images_dir, old_jpg_name)
-        dest_jpg_path = os.path.join(dest_images_dir, new_jpg_name)
-
-        # 4. Check if the corresponding image file exists
         if not os.path.exists(source_jpg_path):
-            print(f"  - Warning: XML file '{old_xml_name}' has no matching image. Skipping.")
+            skipped.append((old_xml_name, 'has no matching image'))
             continue
 
-        # 5. Read XML, replace filename, and write to new location
-        try:
-            with open(source_xml_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+        pairs.append({
+            'old_xml_name': old_xml_name,
+            'old_jpg_name': old_jpg_name,
+            'new_jpg_name': new_jpg_name,
+            'source_xml_path': os.path.join(source_annotations_dir, old_xml_name),
+            'source_jpg_path': source_jpg_path,
+            'dest_xml_path': os.path.join(dest_dir, 'Annotations', f"{base_name}.xml"),
+            'dest_jpg_path': os.path.join(dest_dir, 'images', new_jpg_name),
+        })
+    return pairs, skipped
 
-            modified_content = content.replace(old_jpg_name, new_jpg_name)
 
-            with open(dest_xml_path, 'w', encoding='utf-8') as f:
-                f.write(modified_content)
+def read_manifest(manifest_path):
+    """Returns the finished pairs recorded in a manifest, by old XML name"""
+    finished = {}
+    if not os.path.exists(manifest_path):
+        return finished
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may have been cut off by an interruption
+                continue
+            finished[entry['xml']] = entry
+    return finished
 
-            # 6. Copy the corresponding image file with the new name
-            shutil.copy2(source_jpg_path, dest_jpg_path)
 
-            processed_count += 1
+def _is_finished(pair, entry):
+    return entry is not None \
+        and entry['xml_signature'] == _source_signature(pair['source_xml_path']) \
+        and entry['jpg_signature'] == _source_signature(pair['source_jpg_path']) \
+        and os.path.exists(pair['dest_xml_path']) and os.path.exists(pair['dest_jpg_path'])
+
+
+def process_pair(pair, link='copy'):
+    """Writes the renamed XML and image of a pair, returning its manifest entry"""
+    xml_signature = _source_signature(pair['source_xml_path'])
+    jpg_signature = _source_signature(pair['source_jpg_path'])
+
+    # Read XML, replace filename, and write to new location
+    with open(pair['source_xml_path'], 'r', encoding='utf-8') as f:
+        content = f.read()
+    modified_content = content.replace(pair['old_jpg_name'], pair['new_jpg_name'])
+
+    def write_xml(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(modified_content)
+
+    _replace_atomically(pair['dest_xml_path'], write_xml)
+
+    # Place the corresponding image file with the new name
+    used_link = link_image(pair['source_jpg_path'], pair['dest_jpg_path'], link)
+
+    return {'xml': pair['old_xml_name'], 'xml_signature': xml_signature, 'jpg_signature': jpg_signature,
+            'link': used_link}
+
+
+def process_files(source_dir, workers=1, link='copy', dry_run=False):
+    """
+    Finds, renames, copies, and modifies the annotation and image files.
+
+    Args:
+        source_dir (str): The directory containing the 'Annotations' and 'images' folders.
+        workers (int): Number of threads to process pairs on. Copying is I/O bound, so this can be well above the
+                       number of cores, especially on network storage.
+        link (str): How to place the images, see `link_image`.
+        dry_run (bool): Only report what would be done, without writing anything.
+    """
+    if link not in LINK_MODES:
+        raise ValueError(f'Invalid link mode [{link}]')
+
+    # Define source and destination paths based on the input
+    source_annotations_dir = os.path.join(source_dir, 'Annotations')
+    source_images_dir = os.path.join(source_dir, 'images')
+    dest_dir = os.path.join(source_dir, DEST_DIR_NAME)
+    manifest_path = os.path.join(dest_dir, MANIFEST_NAME)
+
+    # Check if source directories exist
+    if not os.path.isdir(source_annotations_dir):
+        print(f"Error: Source directory '{source_annotations_dir}' not found.")
+        return
+
+    print(f"Processing files from '{source_annotations_dir}' and '{source_images_dir}'...")
+    pairs, skipped = find_pairs(source_dir)
+    for name, reason in skipped:
+        print(f"  - Skipping '{name}' ({reason}).")
+
+    finished = read_manifest(manifest_path)
+    todo = [pair for pair in pairs if not _is_finished(pair, finished.get(pair['old_xml_name']))]
+    done_count = len(pairs) - len(todo)
 
+    if dry_run:
+        image_bytes = sum(os.path.getsize(pair['source_jpg_path']) for pair in todo)
+        print(f"\nDry run: {len(pairs)} file pairs found, {done_count} already done, {len(todo)} to process, "
+              f"{len(skipped)} files skipped.")
+        print(f"Would {link} {len(todo)} images ({image_bytes / 1e6:.1f} MB) into '{dest_dir}'.")
+        return
+
+    # Create destination directories if they don't exist
+    print(f"Setting up destination directory: '{dest_dir}'")
+    os.makedirs(os.path.join(dest_dir, 'Annotations'), exist_ok=True)
+    os.makedirs(os.path.join(dest_dir, 'images'), exist_ok=True)
+    if done_count:
+        print(f"Resuming: {done_count} file pairs were already processed.")
+
+    def process(pair):
+        try:
+            return process_pair(pair, link)
         except Exception as e:
-            print(f"  - Error processing '{old_xml_name}': {e}")
+            print(f"  - Error processing '{pair['old_xml_name']}': {e}")
+            return None
 
-    print(f"\n✅ Done! Processed {processed_count} file pairs.")
+    processed_count = 0
+    fallback_count = 0
+    # Only this thread appends to the manifest, one line per finished pair, flushed right away
+    with open(manifest_path, 'a', encoding='utf-8') as manifest, ThreadPoolExecutor(max(1, workers)) as executor:
+        for entry in executor.map(process, todo):
+            if entry is None:
+                continue
+            manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
+            processed_count += 1
+            if entry['link'] != link:
+                fallback_count += 1
+
+    print(f"\n✅ Done! Processed {processed_count} file pairs ({done_count} already done before).")
+    if fallback_count:
+        print(f"{fallback_count} images were copied because the file system does not support {link}.")
     print(f"Renamed files are located in the '{dest_dir}' directory.")
 
 
 if __name__ == "__main__":
-    # Check if the user provided exactly one command-line argument
-    if len(sys.argv) != 2:
-        print("Usage: python rename_script.py <source_directory>")
-        sys.exit(1)  # Exit with an error code
-
-    source_path = sys.argv[1]
+    parser = argparse.ArgumentParser(description='Copy and rename the images and annotations of a Label Studio export, '
+                                                 'removing the random prefix.')
+    parser.add_argument('source_dir', help="the directory containing the 'Annotations' and 'images' folders")
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of threads to copy files on (default: 8)')
+    parser.add_argument('--link', choices=LINK_MODES, default='copy',
+                        help='copy the images, or hardlink or reflink them when the file system supports it '
+                             '(default: copy)')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be done')
+    args = parser.parse_args()
 
     # Check if the provided path is a valid directory
-    if not os.path.isdir(source_path):
-        print(f"Error: Provided path '{source_path}' is not a valid directory.")
+    if not os.path.isdir(args.source_dir):
+        print(f"Error: Provided path '{args.source_dir}' is not a valid directory.")
         sys.exit(1)
 
-    process_files(source_path)
+    process_files(args.source_dir, args.workers, args.link, args.dry_run)
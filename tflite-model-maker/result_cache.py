@@ -0,0 +1,135 @@
+"""
+An on-disk cache of raw model outputs, so that unchanged images are not run through an unchanged model again.
+
+Entries are keyed on a digest of the model file and of the exact input tensor fed to the model. The input tensor is
+fully determined by the image and the preprocessing, so any change to either of those, or to the model, results in a
+different key. The outputs are stored before any thresholds are applied, so detection and overlap thresholds can be
+changed without invalidating the cache.
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_PATH = os.path.join('.cache', 'results.sqlite')
+DEFAULT_MAX_ENTRIES = 200_000
+# Number of hits whose last use is kept in memory before it is written to the database
+_MAX_PENDING_USES = 1024
+
+
+class ResultCache:
+    """
+    A SQLite backed cache of raw model outputs, with least-recently-used eviction.
+
+    The cache can be shared by the threads of a process and by multiple processes. Hits do not write to the database:
+    their last use is written in batches, with the next put, every `_MAX_PENDING_USES` hits, and on `close`. Once the
+    cache holds more than `max_entries` entries, the least recently used are evicted down to 15/16 of `max_entries`,
+    so that eviction does not run on every put of a full cache. Close the cache when done with it.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            path (str): The SQLite database file.
+            max_entries (int): Maximum number of entries to keep. The least recently used entries are evicted first.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._pending_uses = {}
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS outputs (key TEXT PRIMARY KEY, data BLOB NOT NULL, last_used INTEGER NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)')
+        self._entries = self._count()
+
+    @staticmethod
+    def key(model_digest: str, input_tensor) -> str:
+        """Returns the cache key of running the model with the given digest on the given input tensor"""
+        input_tensor = np.ascontiguousarray(input_tensor)
+        digest = hashlib.sha256(model_digest.encode('ascii'))
+        digest.update(f'{input_tensor.dtype.str}{input_tensor.shape}'.encode('ascii'))
+        digest.update(input_tensor.data)
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """Returns the cached outputs (a dict of arrays) for the key, or None"""
+        with self._lock:
+            row = self._connection.execute('SELECT data FROM outputs WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pending_uses[key] = time.time_ns()
+            if len(self._pending_uses) >= _MAX_PENDING_USES:
+                self._flush_uses()
+        with np.load(io.BytesIO(row[0]), allow_pickle=False) as data:
+            return {name: data[name] for name in data.files}
+
+    def put(self, key: str, outputs: dict):
+        """Stores the outputs (a dict of arrays) for the key"""
+        buffer = io.BytesIO()
+        np.savez(buffer, **{name: np.asarray(value) for name, value in outputs.items()})
+        with self._lock:
+            self._pending_uses.pop(key, None)
+            self._flush_uses()
+            self._connection.execute('INSERT OR REPLACE INTO outputs (key, data, last_used) VALUES (?, ?, ?)',
+                                     (key, buffer.getvalue(), time.time_ns()))
+            # An upper bound: replaced entries are counted too, and other processes may have evicted entries
+            self._entries += 1
+            if self._entries > self.max_entries:
+                self._entries = self._count()
+                if self._entries > self.max_entries:
+                    self._evict()
+
+    def _count(self) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM outputs').fetchone()[0]
+
+    def _flush_uses(self):
+        if not self._pending_uses:
+            return
+        self._connection.execute('BEGIN')
+        self._connection.executemany('UPDATE outputs SET last_used = ? WHERE key = ?',
+                                     [(last_used, key) for key, last_used in self._pending_uses.items()])
+        self._connection.execute('COMMIT')
+        self._pending_uses.clear()
+
+    def _evict(self):
+        self._flush_uses()
+        keep = self.max_entries - self.max_entries // 16
+        self._connection.execute(
+            'DELETE FROM outputs WHERE key IN '
+            '(SELECT key FROM outputs ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (keep,)
+        )
+        self._entries = min(self._entries, keep)
+
+    def clear(self):
+        with self._lock:
+            self._pending_uses.clear()
+            self._connection.execute('DELETE FROM outputs')
+            self._entries = 0
+
+    def close(self):
+        with self._lock:
+            if self._connection is None:
+                return
+            self._flush_uses()
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,337 @@
+"""
+A local HTTP service that recognizes the cards, and the sets among them, in uploaded photos of a table.
+
+The models are loaded and warmed up once at startup. Concurrent requests are coalesced into micro-batches: the first
+request of a batch waits at most `--batch-window-ms` for others to arrive (up to `--max-batch` images), after which the
+card detection runs once for the whole batch. Decoding the uploads runs on a thread pool, and inference on a single
+dedicated thread, so the event loop only parses requests and writes responses.
+
+Endpoints:
+    POST /recognize  The body is an encoded image (e.g. JPEG or PNG). Responds with JSON:
+                     {"cards": [{"card": "rof2", "code": 58, "box": [ymin, xmin, ymax, xmax]}, ...],
+                      "sets": [[i, j, k], ...], "batch_size": 3, "timings_ms": {...}}
+                     where the sets are indices into "cards" and the box is relative to the image size.
+    GET /health      Responds with {"status": "ok", "memory": {...}} once the models are loaded, with the memory
+                     usage of the service in bytes (see `model_session.memory_usage`).
+
+Usage:
+    python service.py --port 8080
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import predict_card_detection
+import predict_shape_detection
+import recognition
+import set_solver
+from model_session import ModelSession, memory_usage
+from predict_utils import detect_objects_batch, filter_objects_by_overlap, preprocess_image_from_rgb
+
+DEFAULT_PORT = 8080
+DEFAULT_BATCH_WINDOW_MS = 10
+DEFAULT_MAX_BATCH = 8
+MAX_BODY_BYTES = 32 * 1024 * 1024
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 411: 'Length Required',
+            413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Recognizer:
+    """Recognizes the cards in batches of images, with models that stay loaded (not thread-safe)"""
+
+    def __init__(self, num_threads: int = None):
+        self.card_session = ModelSession(predict_card_detection.MODEL_PATH, num_threads)
+        self.shape_session = ModelSession(predict_shape_detection.MODEL_PATH, num_threads)
+
+    def warm_up(self):
+        """Runs both models once, so that the first request does not pay for lazy initialization"""
+        height, width = self.card_session.input_size
+        self.recognize_batch([np.zeros((height, width, 3), dtype=np.uint8)])
+        height, width = self.shape_session.input_size
+        recognition.recognize_card(np.full((height, width, 3), 255, dtype=np.uint8), shape_session=self.shape_session)
+
+    def recognize_batch(self, images) -> list:
+        """
+        Recognizes the cards in RGB images, running the card detection once for all of them.
+
+        An image that fails (e.g. an image OpenCV cannot resize) does not fail the others: its slot holds the exception
+        instead. If the batched card detection fails, the detection is repeated image by image to find the culprit.
+
+        Returns:
+            list: Per image, a dict with the recognized 'cards', the 'sets' among them and the 'timings_ms', or the
+                  exception that failed the image.
+        """
+        start = time.perf_counter()
+        responses = [None] * len(images)
+        preprocessed = {}
+        for i, image in enumerate(images):
+            try:
+                preprocessed[i] = preprocess_image_from_rgb(image, self.card_session.input_size)[0]
+            except Exception as e:
+                responses[i] = e
+        raw_results = dict(zip(preprocessed, self._detect(list(preprocessed.values()))))
+        detection_ms = (time.perf_counter() - start) * 1000
+
+        for i, raw in raw_results.items():
+            if isinstance(raw, Exception):
+                responses[i] = raw
+                continue
+            timings = {}
+            try:
+                card_results = filter_objects_by_overlap(raw, predict_card_detection.OVERLAP_THRESHOLD)
+                recognized = recognition.recognize_detected(images[i], card_results, timings, self.shape_session)
+            except Exception as e:
+                responses[i] = e
+                continue
+            responses[i] = _response(recognized, len(images), {
+                'card_detection': detection_ms,
+                **{stage: seconds * 1000 for stage, seconds in timings.items()},
+            })
+        return responses
+
+    def _detect(self, preprocessed) -> list:
+        """Runs the card detection on preprocessed images, returning per image its raw results or its exception"""
+        try:
+            return detect_objects_batch(self.card_session, predict_card_detection.CLASSES, preprocessed,
+                                        threshold=predict_card_detection.DETECTION_THRESHOLD)
+        except Exception as e:
+            if len(preprocessed) == 1:
+                return [e]
+        return [self._detect([image])[0] for image in preprocessed]
+
+
+def _response(recognized, batch_size: int, timings_ms: dict) -> dict:
+    cards = [
+        {'card': str(card), 'code': card.to_int() if card.count in (1, 2, 3) else None,
+         'box': [round(float(value), 5) for value in box]}
+        for card, box in recognized
+    ]
+    # Cards with an impossible count (e.g. when too many shapes were detected) cannot be part of a set
+    in_deck = [i for i, card in enumerate(cards) if card['code'] is not None]
+    sets = set_solver.find_sets([recognized[i][0] for i in in_deck])
+    return {
+        'cards': cards,
+        'sets': [[in_deck[i], in_deck[j], in_deck[k]] for i, j, k in sets],
+        'batch_size': batch_size,
+        'timings_ms': {stage: round(ms, 3) for stage, ms in timings_ms.items()},
+    }
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent submissions into batches for a function that processes a list of items at once.
+
+    A batch is started as soon as it holds `max_batch_size` items, or `window` seconds after its first item arrived.
+    Batches are processed one at a time on the given executor. If `process_batch` raises, every submission of the
+    batch fails; a function that can fail per item returns the exceptions as results instead (see `Recognizer`).
+    """
+
+    def __init__(self, process_batch, executor, max_batch_size: int = DEFAULT_MAX_BATCH,
+                 window: float = DEFAULT_BATCH_WINDOW_MS / 1000):
+        self.process_batch = process_batch
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, item):
+        """Returns the result of processing the item, as part of a batch"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.process_batch, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+def decode_image(data: bytes):
+    """Decodes an uploaded image to an RGB array"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if image is None:
+        raise HttpError(400, 'Unable to decode image')
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class RecognitionService:
+    def __init__(self, batcher: MicroBatcher, decode_executor):
+        self.batcher = batcher
+        self.decode_executor = decode_executor
+
+    async def handle(self, method: str, path: str, body: bytes):
+        """Returns the (status, JSON value) response to a request"""
+        if path == '/health':
+            if method != 'GET':
+                raise HttpError(405, f'Invalid method [{method}]')
+            return 200, {'status': 'ok', 'memory': memory_usage()}
+        if path == '/recognize':
+            if method != 'POST':
+                raise HttpError(405, f'Invalid method [{method}]')
+            if not body:
+                raise HttpError(400, 'Missing image')
+            image = await asyncio.get_running_loop().run_in_executor(self.decode_executor, decode_image, body)
+            result = await self.batcher.submit(image)
+            if isinstance(result, Exception):
+                # Only this image failed, the other images of its batch were recognized
+                raise HttpError(500, f'Unable to recognize image [{result}]')
+            return 200, result
+        raise HttpError(404, f'Invalid path [{path}]')
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves the requests of a connection, keeping it open between requests unless the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = True
+                try:
+                    method, path, version, headers = _parse_head(request_line, await _read_headers(reader))
+                    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                    body = await _read_body(reader, method, headers)
+                    status, value = await self.handle(method, path.split('?', 1)[0], body)
+                except HttpError as e:
+                    status, value = e.status, {'error': str(e)}
+                    # The rest of the request may not have been read, so the connection cannot be reused
+                    keep_alive = keep_alive and e.status not in (400, 411, 413)
+                except Exception as e:
+                    status, value, keep_alive = 500, {'error': str(e)}, False
+                _write_response(writer, status, value, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _read_headers(reader: asyncio.StreamReader) -> dict:
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+def _parse_head(request_line: bytes, headers: dict):
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise HttpError(400, 'Invalid request line')
+    method, path, version = parts
+    return method, path, version, headers
+
+
+async def _read_body(reader: asyncio.StreamReader, method: str, headers: dict) -> bytes:
+    if 'content-length' not in headers:
+        if method == 'POST':
+            raise HttpError(411, 'Missing Content-Length')
+        return b''
+    try:
+        length = int(headers['content-length'])
+    except ValueError:
+        raise HttpError(400, f'Invalid Content-Length [{headers["content-length"]}]') from None
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, f'Image too large [{length} bytes]')
+    return await reader.readexactly(length)
+
+
+def _write_response(writer: asyncio.StreamWriter, status: int, value, keep_alive: bool):
+    body = json.dumps(value).encode('utf-8')
+    head = (f'HTTP/1.1 {status} {_REASONS.get(status, "")}\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+    writer.write(head.encode('latin-1') + body)
+
+
+async def serve(host: str, port: int, batch_window_ms: float, max_batch: int, decode_threads: int,
+                num_threads: int = None, recognizer=None):
+    """Loads the models and serves requests until cancelled"""
+    inference_executor = ThreadPoolExecutor(1, thread_name_prefix='inference')
+    decode_executor = ThreadPoolExecutor(decode_threads, thread_name_prefix='decode')
+    loop = asyncio.get_running_loop()
+    if recognizer is None:
+        recognizer = await loop.run_in_executor(inference_executor, Recognizer, num_threads)
+        await loop.run_in_executor(inference_executor, recognizer.warm_up)
+
+    batcher = MicroBatcher(recognizer.recognize_batch, inference_executor, max_batch, batch_window_ms / 1000)
+    batcher.start()
+    service = RecognitionService(batcher, decode_executor)
+    server = await asyncio.start_server(service.serve_connection, host, port)
+    print(f'Serving on {", ".join(str(socket.getsockname()) for socket in server.sockets)}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+        inference_executor.shutdown()
+        decode_executor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve card recognition over HTTP.')
+    parser.add_argument('--host', default='0.0.0.0', help='the address to listen on (default: 0.0.0.0)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'(default: {DEFAULT_PORT})')
+    parser.add_argument('--batch-window-ms', type=float, default=DEFAULT_BATCH_WINDOW_MS,
+                        help='how long the first request of a batch waits for others to arrive '
+                             f'(default: {DEFAULT_BATCH_WINDOW_MS})')
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH,
+                        help=f'maximum number of images per batch (default: {DEFAULT_MAX_BATCH})')
+    parser.add_argument('--decode-threads', type=int, default=4,
+                        help='number of threads to decode uploads on (default: 4)')
+    parser.add_argument('--threads', type=int, help='number of threads per interpreter')
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.batch_window_ms, args.max_batch, args.decode_threads,
+                          args.threads))
+    except KeyboardInterrupt:
+        pass
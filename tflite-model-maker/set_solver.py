@@ -0,0 +1,133 @@
+"""
+Finds the "sets" among recognized cards.
+
+Each card is encoded as an integer 0..80, with one base-3 digit per property. For any two different cards there is
+exactly one card that completes a set: per property, its digit is the one that makes the three digits either all
+equal or all different, i.e. `(-a - b) % 3`. Looking up that third card for every pair makes finding all sets O(n²)
+instead of checking all O(n³) triples.
+"""
+import numpy as np
+
+from card_model import Card, DECK_SIZE
+
+
+def encode_card(card: Card) -> int:
+    """Encodes a card as an integer in 0..80 (see `Card.to_int`)"""
+    return card.to_int()
+
+
+def _complete(a: int, b: int) -> int:
+    third = 0
+    weight = 1
+    for _ in range(4):
+        third += (-(a % 3) - (b % 3)) % 3 * weight
+        a //= 3
+        b //= 3
+        weight *= 3
+    return third
+
+
+# _THIRD[a][b] is the code of the card that forms a set with the cards with codes a and b
+_THIRD = [[_complete(a, b) for b in range(DECK_SIZE)] for a in range(DECK_SIZE)]
+
+# All 1080 sets in the deck, as rows of ascending codes
+SET_TRIPLES = np.array([
+    (a, b, _THIRD[a][b])
+    for a in range(DECK_SIZE)
+    for b in range(a + 1, DECK_SIZE)
+    if _THIRD[a][b] > b
+], dtype=np.int64)
+
+
+def third_card(a: int, b: int) -> int:
+    """Returns the code of the card that completes a set with the cards with codes a and b"""
+    return _THIRD[a][b]
+
+
+def _iter_sets(cards):
+    codes = [encode_card(card) for card in cards]
+    positions = {}
+    for i, code in enumerate(codes):
+        positions.setdefault(code, []).append(i)
+
+    for i in range(len(codes)):
+        row = _THIRD[codes[i]]
+        for j in range(i + 1, len(codes)):
+            if codes[j] == codes[i]:
+                # Two identical cards can't be part of the same set
+                continue
+            for k in positions.get(row[codes[j]], ()):
+                if k > j:
+                    yield i, j, k
+
+
+def find_sets(cards) -> list:
+    """
+    Finds all sets among the given cards.
+
+    Args:
+        cards (list): The cards, e.g. as recognized in an image of a table. Duplicate cards are allowed.
+
+    Returns:
+        list: A list of (i, j, k) index tuples into `cards`, with i < j < k, in lexicographic order.
+    """
+    return list(_iter_sets(cards))
+
+
+def find_first_set(cards):
+    """Returns the lexicographically first (i, j, k) set of indices into `cards`, or None if there is no set"""
+    return next(_iter_sets(cards), None)
+
+
+def count_sets(cards) -> int:
+    """Returns the number of sets among the given cards"""
+    return sum(1 for _ in _iter_sets(cards))
+
+
+def encode_boards(boards, size: int = None) -> np.ndarray:
+    """
+    Encodes a list of boards (each a list of cards) into an array for `count_sets_batch`.
+
+    Args:
+        boards (list): The boards, each a list of cards.
+        size (int): The number of columns, at least the number of cards on the largest board. Defaults to that.
+
+    Returns:
+        numpy.ndarray: A (len(boards), size) array of card codes, padded with -1.
+    """
+    if size is None:
+        size = max((len(board) for board in boards), default=0)
+    encoded = np.full((len(boards), size), -1, dtype=np.int16)
+    for row, board in enumerate(boards):
+        encoded[row, :len(board)] = [encode_card(card) for card in board]
+    return encoded
+
+
+def count_sets_batch(boards, chunk_size: int = 16384) -> np.ndarray:
+    """
+    Counts the sets on many boards at once.
+
+    Args:
+        boards (numpy.ndarray): A (B, n) array of card codes (see `encode_card`), where -1 marks an empty slot.
+        chunk_size (int): Number of boards processed at a time, which bounds the memory used.
+
+    Returns:
+        numpy.ndarray: A (B,) array with the number of sets on each board, equal to `count_sets` of each board
+                       (duplicate cards included).
+    """
+    boards = np.asarray(boards)
+    counts = np.empty(len(boards), dtype=np.int64)
+    a, b, c = SET_TRIPLES[:, 0], SET_TRIPLES[:, 1], SET_TRIPLES[:, 2]
+    for start in range(0, len(boards), chunk_size):
+        chunk = boards[start:start + chunk_size]
+        # Number of copies of every card on each board, with empty slots counted in an extra column
+        slots = np.where(chunk < 0, DECK_SIZE, chunk) + np.arange(len(chunk))[:, None] * (DECK_SIZE + 1)
+        occurrences = np.bincount(slots.ravel(), minlength=len(chunk) * (DECK_SIZE + 1)) \
+            .reshape(len(chunk), DECK_SIZE + 1)
+        counts[start:start + chunk_size] = (occurrences[:, a] * occurrences[:, b] * occurrences[:, c]).sum(axis=1)
+    return counts
+
+
+def has_set_batch(boards, chunk_size: int = 16384) -> np.ndarray:
+    """Returns a (B,) boolean array telling whether each board (see `count_sets_batch`) contains at least one set"""
+    return count_sets_batch(boards, chunk_size) > 0
@@ -0,0 +1,296 @@
+"""
+Synthesizes labeled table photos from extracted card images, for load testing and to grow the card detection
+training set without labeling more photos by hand.
+
+Every table is a background (a random crop of one of the `--backgrounds` photos, or a synthesized table surface) on
+which a random number of card images (named per `Card.from_filename`, e.g. the renamed `output-card-extraction`) are
+placed at random positions, rotations and scales. Cards never overlap, like on a real table (which the overlap filter
+relies on). The lighting of every card and of the whole table is varied, after which the table is written as JPEG to
+`<output>/images` and its card boxes as Pascal VOC annotation to `<output>/Annotations`, the layout the training
+scripts and `dataset_cache.py` read.
+
+Table `i` only depends on `--seed` and `i`, so the output does not depend on the number of workers, and an interrupted
+run can be resumed: tables whose image and annotation already exist are skipped. Files are only ever moved into place
+complete, so an existing file is never a truncated one.
+
+Usage:
+    python synthesize_tables.py output-card-extraction data-synthetic --count 100000 --workers 8
+    python load_test.py --images data-synthetic/images
+"""
+import argparse
+import functools
+import multiprocessing
+import os
+
+import cv2
+import numpy as np
+
+import voc
+from card_model import Card
+from predict_utils import target_to_image_names
+
+DEFAULT_SIZE = (960, 1280)  # (height, width) of a synthesized table
+DEFAULT_CARDS = (3, 15)  # minimum and maximum number of cards on a table
+# Length of the long side of a card, as a fraction of the short side of the table
+CARD_SCALE = (0.12, 0.3)
+# Minimum distance in pixels between the boxes of two cards
+CARD_GAP = 4
+MAX_PLACEMENT_ATTEMPTS = 50
+CHUNK_SIZE = 16
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def card_images(cards_dir: str) -> list:
+    """Returns the paths of the card images in a directory whose filename ends with a valid card code"""
+    cards_dir, image_names = target_to_image_names(cards_dir)
+    paths = []
+    for image_name in image_names:
+        if not image_name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        try:
+            Card.from_filename(image_name)
+        except (ValueError, IndexError):
+            continue
+        paths.append(os.path.join(cards_dir, image_name))
+    return paths
+
+
+@functools.lru_cache(maxsize=256)
+def _read_image(path: str) -> np.ndarray:
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f'Unable to read image [{path}]')
+    return image
+
+
+def _background(rng, size, background_paths) -> np.ndarray:
+    height, width = size
+    if background_paths:
+        image = _read_image(background_paths[rng.integers(len(background_paths))])
+        # Scale the background to cover the table, and take a random crop of it
+        scale = max(height / image.shape[0], width / image.shape[1]) * rng.uniform(1, 1.5)
+        image = cv2.resize(image, (int(np.ceil(image.shape[1] * scale)), int(np.ceil(image.shape[0] * scale))),
+                           interpolation=cv2.INTER_LINEAR)
+        y = rng.integers(image.shape[0] - height + 1)
+        x = rng.integers(image.shape[1] - width + 1)
+        return image[y:y + height, x:x + width].astype(np.float32)
+
+    # A table surface: a random base color with coarse blotches (the grain is added with the sensor noise)
+    blotches = rng.normal(0, 10, (height // 64 + 2, width // 64 + 2, 1)) + rng.uniform(30, 170, 3)
+    return cv2.resize(blotches.astype(np.float32), (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+def _transform_card(rng, card, table_size):
+    """Rotates and scales a card image, returning it with its coverage mask (both just large enough to hold it)"""
+    card_height, card_width = card.shape[:2]
+    long_side = rng.uniform(*CARD_SCALE) * min(table_size)
+    scale = long_side / max(card_height, card_width)
+    angle = rng.uniform(-180, 180)
+    matrix = cv2.getRotationMatrix2D((card_width / 2, card_height / 2), angle, scale)
+    corners = np.array([[0, 0, 1], [card_width, 0, 1], [0, card_height, 1], [card_width, card_height, 1]]) @ matrix.T
+    minimum = np.floor(corners.min(axis=0))
+    width, height = (np.ceil(corners.max(axis=0)) - minimum).astype(int)
+    matrix[:, 2] -= minimum
+    warped = cv2.warpAffine(card, matrix, (width, height), flags=cv2.INTER_LINEAR, borderValue=(0, 0, 0))
+    mask = cv2.warpAffine(np.ones((card_height, card_width), dtype=np.float32), matrix, (width, height),
+                          flags=cv2.INTER_LINEAR, borderValue=0)
+    return warped, mask
+
+
+def _find_position(rng, size, table_size, boxes):
+    """Returns a random (x, y) at which a card of the size does not overlap any of the boxes, or None"""
+    height, width = size
+    table_height, table_width = table_size
+    if height > table_height or width > table_width:
+        return None
+    for _ in range(MAX_PLACEMENT_ATTEMPTS):
+        x = int(rng.integers(table_width - width + 1))
+        y = int(rng.integers(table_height - height + 1))
+        if all(x + width + CARD_GAP <= xmin or xmax + CARD_GAP <= x or y + height + CARD_GAP <= ymin or
+               ymax + CARD_GAP <= y for xmin, ymin, xmax, ymax in boxes):
+            return x, y
+    return None
+
+
+def _light(rng, table):
+    """Varies the lighting of a table: exposure, white balance, a light gradient, sensor noise and focus"""
+    height, width = table.shape[:2]
+    direction = rng.normal(size=2)
+    direction *= rng.uniform(0, 0.5) / (np.linalg.norm(direction) or 1)
+    # The light falls off along a random direction, as a product of a vertical and a horizontal gradient, so that
+    # it can be applied as a column and a row (with the exposure per channel) instead of per pixel
+    column = 1 + np.linspace(-0.5, 0.5, height) * direction[1]
+    row = 1 + np.linspace(-0.5, 0.5, width) * direction[0]
+    exposure = rng.uniform(0.7, 1.25) * rng.uniform(0.9, 1.1, 3)
+    pixels = table.reshape(height, width * 3)
+    pixels *= column[:, np.newaxis].astype(np.float32)
+    pixels *= np.outer(row, exposure).reshape(1, width * 3).astype(np.float32)
+    # OpenCV draws the noise about three times faster than NumPy, seeded from rng to keep the table reproducible
+    cv2.setRNGSeed(int(rng.integers(2 ** 31)))
+    noise = np.empty_like(table)
+    cv2.randn(noise, 0, rng.uniform(2, 8))
+    table += noise
+    if rng.random() < 0.3:
+        table = cv2.GaussianBlur(table, (5, 5), 0)
+    return table
+
+
+def synthesize(index: int, seed: int, card_paths: list, background_paths: list = None, size=DEFAULT_SIZE,
+               cards=DEFAULT_CARDS, label: str = 'card'):
+    """
+    Synthesizes a single table.
+
+    Args:
+        index (int): The number of the table. Together with the seed, it determines the table.
+        seed (int): The seed of the whole run.
+        card_paths (list): The card images to choose from (see `card_images`).
+        background_paths (list): The background images to choose from, or None to synthesize table surfaces.
+        size (tuple): The (height, width) of the table.
+        cards (tuple): The minimum and maximum number of cards. Fewer cards are placed if they do not fit.
+        label (str): The label of the card objects, or 'code' to label every card with its code (e.g. 'rof2').
+
+    Returns:
+        tuple: The table as BGR image, and its objects (see `voc.write_annotation`).
+    """
+    rng = np.random.default_rng([seed, index])
+    table = _background(rng, size, background_paths)
+    count = int(rng.integers(cards[0], cards[1] + 1))
+    chosen = rng.choice(len(card_paths), min(count, len(card_paths)), replace=False)
+
+    objects = []
+    boxes = []
+    for card_index in chosen:
+        path = card_paths[card_index]
+        warped, mask = _transform_card(rng, _read_image(path), size)
+        position = _find_position(rng, mask.shape, size, boxes)
+        if position is None:
+            continue
+        x, y = position
+        height, width = mask.shape
+        # Every card catches the light a little differently
+        card = warped.astype(np.float32) * rng.uniform(0.85, 1.15) + rng.uniform(-15, 15)
+        region = table[y:y + height, x:x + width]
+        alpha = mask[..., np.newaxis]
+        region[:] = region * (1 - alpha) + card * alpha
+        boxes.append((x, y, x + width, y + height))
+        card_label = str(Card.from_filename(os.path.basename(path))) if label == 'code' else label
+        objects.append({'label': card_label, 'box': (x, y, x + width, y + height)})
+
+    table = _light(rng, table)
+    return np.clip(table, 0, 255, out=table).astype(np.uint8), objects
+
+
+_worker_options = None
+
+
+def _init_worker(options: dict):
+    global _worker_options
+    _worker_options = options
+
+
+def _write_chunk(indices) -> dict:
+    """Synthesizes and writes tables, returning the number of 'tables' and 'cards' written and tables 'skipped'"""
+    options = _worker_options
+    images_dir = os.path.join(options['output_dir'], 'images')
+    annotations_dir = os.path.join(options['output_dir'], 'Annotations')
+    stats = {'tables': 0, 'cards': 0, 'skipped': 0}
+    for index in indices:
+        name = f'{options["prefix"]}-{index:08d}'
+        image_path = os.path.join(images_dir, f'{name}.jpg')
+        annotation_path = os.path.join(annotations_dir, f'{name}.xml')
+        if os.path.exists(image_path) and os.path.exists(annotation_path):
+            stats['skipped'] += 1
+            continue
+        table, objects = synthesize(index, options['seed'], options['card_paths'], options['background_paths'],
+                                    options['size'], options['cards'], options['label'])
+        # Both files are written under a temporary name and then moved into place, the annotation last, so that
+        # neither is ever left half written and a table with an annotation is complete
+        _, encoded = cv2.imencode('.jpg', table, [cv2.IMWRITE_JPEG_QUALITY, options['quality']])
+        temporary_path = f'{image_path}.partial'
+        with open(temporary_path, 'wb') as f:
+            f.write(encoded.tobytes())
+        os.replace(temporary_path, image_path)
+        voc.write_annotation(annotation_path, f'{name}.jpg', table.shape[1], table.shape[0], objects)
+        stats['tables'] += 1
+        stats['cards'] += len(objects)
+    return stats
+
+
+def generate(cards_dir: str, output_dir: str, count: int, workers: int = 0, seed: int = 0, start: int = 0,
+             backgrounds_dir: str = None, size=DEFAULT_SIZE, cards=DEFAULT_CARDS, label: str = 'card',
+             quality: int = 90, prefix: str = 'synthetic') -> dict:
+    """
+    Synthesizes tables `start` up to `start + count` (see `synthesize`) and writes them to the output directory.
+
+    Args:
+        workers (int): Number of processes to synthesize on (default: 0, which synthesizes in this process).
+        quality (int): The JPEG quality.
+        prefix (str): The prefix of the filenames, which are followed by the table number.
+
+    Returns:
+        dict: The number of 'tables' and 'cards' written, and of tables 'skipped' because they already existed.
+    """
+    if cards[0] < 0 or cards[1] < cards[0]:
+        raise ValueError(f'Invalid number of cards [{cards}]')
+    card_paths = card_images(cards_dir)
+    if not card_paths:
+        raise ValueError(f'No card images found in [{cards_dir}]')
+    background_paths = None
+    if backgrounds_dir is not None:
+        backgrounds_dir, background_names = target_to_image_names(backgrounds_dir)
+        background_paths = [os.path.join(backgrounds_dir, name) for name in background_names
+                            if name.lower().endswith(IMAGE_EXTENSIONS)]
+        if not background_paths:
+            raise ValueError(f'No background images found in [{backgrounds_dir}]')
+
+    os.makedirs(os.path.join(output_dir, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, 'Annotations'), exist_ok=True)
+    options = {'output_dir': output_dir, 'seed': seed, 'card_paths': card_paths, 'background_paths': background_paths,
+               'size': tuple(size), 'cards': tuple(cards), 'label': label, 'quality': quality, 'prefix': prefix}
+    chunks = [range(chunk_start, min(chunk_start + CHUNK_SIZE, start + count))
+              for chunk_start in range(start, start + count, CHUNK_SIZE)]
+
+    stats = {'tables': 0, 'cards': 0, 'skipped': 0}
+    if workers <= 0:
+        _init_worker(options)
+        results = map(_write_chunk, chunks)
+        for result in results:
+            for key, value in result.items():
+                stats[key] += value
+        return stats
+
+    # The workers write the tables themselves as they go, only the counts are sent back
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=_init_worker, initargs=(options,)) as pool:
+        for i, result in enumerate(pool.imap_unordered(_write_chunk, chunks)):
+            for key, value in result.items():
+                stats[key] += value
+            if i % 100 == 99:
+                print(f'{stats["tables"] + stats["skipped"]} of {count} tables done')
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthesize labeled table photos from extracted card images.')
+    parser.add_argument('cards', help='a directory of card images whose filenames end with the card code')
+    parser.add_argument('output', help='the directory to write images and Annotations to (e.g. data-synthetic)')
+    parser.add_argument('--count', type=int, default=1000, help='number of tables (default: 1000)')
+    parser.add_argument('--start', type=int, default=0,
+                        help='number of the first table, to add tables to an earlier run (default: 0)')
+    parser.add_argument('--seed', type=int, default=0, help='(default: 0)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes to synthesize on, 0 for this process (default: number of CPUs)')
+    parser.add_argument('--backgrounds', help='a directory of photos to use as background (default: synthesized)')
+    parser.add_argument('--size', type=int, nargs=2, default=DEFAULT_SIZE, metavar=('HEIGHT', 'WIDTH'),
+                        help=f'size of a table (default: {DEFAULT_SIZE[0]} {DEFAULT_SIZE[1]})')
+    parser.add_argument('--cards-per-table', type=int, nargs=2, default=DEFAULT_CARDS, metavar=('MIN', 'MAX'),
+                        help=f'number of cards on a table (default: {DEFAULT_CARDS[0]} {DEFAULT_CARDS[1]})')
+    parser.add_argument('--label', default='card',
+                        help="the label of the cards, or 'code' to label them with their card code (default: card)")
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality (default: 90)')
+    args = parser.parse_args()
+
+    result = generate(args.cards, args.output, args.count, args.workers, args.seed, args.start, args.backgrounds,
+                      args.size, args.cards_per_table, args.label, args.quality)
+    print(f'Wrote {result["tables"]} tables with {result["cards"]} cards to {args.output}, '
+          f'skipped {result["skipped"]} existing tables')
@@ -0,0 +1,75 @@
+"""Stand-ins for the models, shared by the tests"""
+import numpy as np
+
+
+class StubSession:
+    """
+    A stand-in for `model_session.ModelSession` that returns fixed detections without running a model.
+
+    The detections are the cells of a rows x columns grid, each reported twice (with a slightly shifted box and a
+    lower score), so that the overlap filter has work to do.
+    """
+
+    def __init__(self, input_size=(320, 320), grid=(3, 4), class_id=0, max_detections=25):
+        self.input_size = input_size
+        rows, columns = grid
+        boxes, scores = [], []
+        for row in range(rows):
+            for column in range(columns):
+                box = [(row + 0.1) / rows, (column + 0.1) / columns, (row + 0.9) / rows, (column + 0.9) / columns]
+                boxes += [box, [box[0] + 0.01, box[1] + 0.01, box[2] + 0.01, box[3] + 0.01]]
+                scores += [0.9, 0.6]
+        count = min(len(boxes), max_detections)
+        self._outputs = {
+            'output_0': np.array([count], dtype=np.float32),
+            'output_1': np.zeros((1, max_detections), dtype=np.float32),
+            'output_2': np.full((1, max_detections), class_id, dtype=np.float32),
+            'output_3': np.zeros((1, max_detections, 4), dtype=np.float32),
+        }
+        self._outputs['output_1'][0, :count] = scores[:count]
+        self._outputs['output_3'][0, :count] = boxes[:count]
+
+    def get_input_details(self):
+        height, width = self.input_size
+        return [{'shape': np.array([1, height, width, 3]), 'shape_signature': np.array([-1, height, width, 3])}]
+
+    def get_signature_runner(self):
+        def run(images):
+            return {name: np.repeat(value, len(images), axis=0) for name, value in self._outputs.items()}
+
+        return run
+
+
+class BrightRegionSession:
+    """
+    A stand-in for `model_session.ModelSession` that detects the bright pixels of an image as one object, but only if
+    they cover at least `min_fraction` of the model input, like a detector that misses objects that are too small.
+    """
+
+    def __init__(self, input_size=(320, 320), min_fraction=0.01):
+        self.input_size = input_size
+        self.min_fraction = min_fraction
+
+    def get_input_details(self):
+        height, width = self.input_size
+        return [{'shape': np.array([1, height, width, 3]), 'shape_signature': np.array([-1, height, width, 3])}]
+
+    def get_signature_runner(self):
+        def run(images):
+            outputs = {'output_0': np.zeros((len(images),), dtype=np.float32),
+                       'output_1': np.zeros((len(images), 1), dtype=np.float32),
+                       'output_2': np.zeros((len(images), 1), dtype=np.float32),
+                       'output_3': np.zeros((len(images), 1, 4), dtype=np.float32)}
+            for i, image in enumerate(images):
+                bright = np.asarray(image)[..., 0] > 128
+                if bright.mean() < self.min_fraction:
+                    continue
+                ys, xs = np.nonzero(bright)
+                height, width = bright.shape
+                outputs['output_0'][i] = 1
+                outputs['output_1'][i, 0] = 0.9
+                outputs['output_3'][i, 0] = [ys.min() / height, xs.min() / width, (ys.max() + 1) / height,
+                                             (xs.max() + 1) / width]
+            return outputs
+
+        return run
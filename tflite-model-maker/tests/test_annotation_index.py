@@ -0,0 +1,16 @@
+import voc
+from annotation_index import AnnotationIndex
+
+
+def test_update_skips_invalid_annotations(tmp_path):
+    annotations_dir = tmp_path / 'data' / 'Annotations'
+    annotations_dir.mkdir(parents=True)
+    voc.write_annotation(str(annotations_dir / 'good.xml'), 'good.jpg', 100, 100,
+                         [{'label': 'card', 'box': (1, 2, 30, 40)}])
+    (annotations_dir / 'truncated.xml').write_text('<annotation><filename>truncated.jpg</filename>')
+
+    with AnnotationIndex(str(tmp_path / 'annotations.sqlite')) as index:
+        stats = index.update(str(tmp_path / 'data'))
+        assert (stats['added'], stats['invalid']) == (1, 1)
+        assert list(stats['errors']) == ['truncated.xml']
+        assert index.class_counts(str(tmp_path / 'data')) == {'card': {'objects': 1, 'images': 1}}
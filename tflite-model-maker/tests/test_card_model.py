@@ -0,0 +1,44 @@
+import copy
+import pickle
+
+import pytest
+
+from card_model import Card, Color, Filling, Shape, DECK_SIZE
+
+ATTRIBUTES = [Color.GREEN, Color.PURPLE, Color.RED, Shape.OVAL, Shape.RHOMBUS, Shape.WAVE, Filling.EMPTY,
+              Filling.FILLED, Filling.PARTIAL]
+
+
+def _round_trips(value):
+    return [pickle.loads(pickle.dumps(value)), copy.copy(value), copy.deepcopy(value)]
+
+
+@pytest.mark.parametrize('attribute', ATTRIBUTES, ids=str)
+def test_attribute_round_trips_to_the_same_instance(attribute):
+    for result in _round_trips(attribute):
+        assert result is attribute
+        assert result == attribute
+
+
+def test_deck_card_round_trips_to_the_interned_instance():
+    for code in range(DECK_SIZE):
+        card = Card.from_int(code)
+        for result in _round_trips(card):
+            assert result is card
+            assert result.to_int() == code
+
+
+def test_card_outside_the_deck_round_trips_to_an_equal_card():
+    card = Card(Color.RED, Shape.WAVE, Filling.PARTIAL, 5)
+    for result in _round_trips(card):
+        assert result == card
+        assert hash(result) == hash(card)
+        assert str(result) == 'rwp5'
+        with pytest.raises(ValueError):
+            result.to_int()
+
+
+def test_cards_in_containers_round_trip():
+    cards = [Card.from_int(0), Card.from_short('gof2'), Card(Color.GREEN, Shape.OVAL, Filling.FILLED, 4)]
+    assert pickle.loads(pickle.dumps(cards)) == cards
+    assert copy.deepcopy({card: str(card) for card in cards}) == {card: str(card) for card in cards}
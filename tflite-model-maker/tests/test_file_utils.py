@@ -0,0 +1,23 @@
+import os
+
+import file_utils
+from file_utils import FileDigests, file_digest
+
+
+def test_file_digests_only_reads_changed_files(tmp_path, monkeypatch):
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(b'first')
+    with FileDigests(str(tmp_path / 'digests.sqlite')) as digests:
+        assert digests.digest(str(path)) == file_digest(str(path))
+
+    reads = []
+    monkeypatch.setattr(file_utils, 'file_digest', lambda p: reads.append(p) or file_digest(p))
+    with FileDigests(str(tmp_path / 'digests.sqlite')) as digests:
+        digests.digest(str(path))
+        assert reads == []
+
+        path.write_bytes(b'second')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        assert digests.digest(str(path)) == file_digest(str(path))
+        assert len(reads) == 1
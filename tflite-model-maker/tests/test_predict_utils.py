@@ -0,0 +1,103 @@
+import cv2
+import numpy as np
+import pytest
+
+import predict_card_detection
+from predict_utils import calculate_overlap, filter_objects_by_overlap, detect_objects, tiles_per_side
+from stubs import BrightRegionSession
+
+
+def _filter_objects_by_overlap_nested_loop(objects, overlap_threshold):
+    """The implementation of `filter_objects_by_overlap` before it was vectorized, as reference"""
+    keep = [True] * len(objects)
+
+    for i in range(len(objects)):
+        if not keep[i]:
+            continue
+
+        box_i = objects[i]['bounding_box']
+
+        for j in range(i + 1, len(objects)):
+            if not keep[j]:
+                continue
+
+            box_j = objects[j]['bounding_box']
+            overlap_i = calculate_overlap(box_i, box_j)
+            overlap_j = calculate_overlap(box_j, box_i)
+
+            if overlap_i > overlap_threshold or overlap_j > overlap_threshold:
+                if objects[i]['score'] > objects[j]['score']:
+                    keep[j] = False
+                else:
+                    keep[i] = False
+                    break
+
+    return [obj for obj, k in zip(objects, keep) if k]
+
+
+def _random_objects(rng, n):
+    """
+    Boxes on a coarse grid with scores from a small set, so that tied scores, zero-area boxes, and identical and nested
+    boxes are common
+    """
+    corners = rng.integers(0, 6, (n, 2, 2)) / 5
+    ymin, ymax = np.sort(corners[:, :, 0], axis=1).T
+    xmin, xmax = np.sort(corners[:, :, 1], axis=1).T
+    boxes = np.stack([ymin, xmin, ymax, xmax], axis=1)
+    scores = rng.integers(1, 5, n) / 4
+    return [{'bounding_box': box, 'class_id': 0, 'score': score} for box, score in zip(boxes, scores)]
+
+
+def _assert_same(objects, overlap_threshold):
+    expected = _filter_objects_by_overlap_nested_loop(objects, overlap_threshold)
+    actual = filter_objects_by_overlap(objects, overlap_threshold)
+    assert [id(obj) for obj in actual] == [id(obj) for obj in expected]
+
+
+@pytest.mark.parametrize('n', [0, 1, 2, 3, 10, 100])
+@pytest.mark.parametrize('overlap_threshold', [0.0, 0.1, 0.5, 0.8, 0.999])
+def test_matches_nested_loop_on_random_boxes(n, overlap_threshold):
+    rng = np.random.default_rng([n, int(overlap_threshold * 1000)])
+    for _ in range(20):
+        _assert_same(_random_objects(rng, n), overlap_threshold)
+
+
+@pytest.mark.parametrize('overlap_threshold', [0.0, 0.5, 0.999])
+def test_matches_nested_loop_on_special_boxes(overlap_threshold):
+    box = [0.2, 0.2, 0.6, 0.6]
+    cases = [
+        # Identical boxes with tied scores
+        [(box, 0.5), (box, 0.5), (box, 0.5)],
+        # Identical boxes with increasing and decreasing scores
+        [(box, 0.3), (box, 0.5), (box, 0.7)],
+        [(box, 0.7), (box, 0.5), (box, 0.3)],
+        # Nested boxes
+        [([0.0, 0.0, 1.0, 1.0], 0.5), (box, 0.9), ([0.3, 0.3, 0.4, 0.4], 0.5)],
+        # Zero-area boxes, inside and on the edge of another box
+        [([0.3, 0.3, 0.3, 0.5], 0.9), (box, 0.5), ([0.2, 0.2, 0.2, 0.2], 0.5), ([0.4, 0.1, 0.4, 0.9], 0.1)],
+        # Boxes that only touch
+        [([0.0, 0.0, 0.5, 0.5], 0.5), ([0.5, 0.0, 1.0, 0.5], 0.5), ([0.0, 0.5, 0.5, 1.0], 0.5)],
+    ]
+    for case in cases:
+        objects = [{'bounding_box': np.array(box), 'class_id': 0, 'score': score} for box, score in case]
+        _assert_same(objects, overlap_threshold)
+
+
+def test_tiles_per_side_tiles_images_without_detections():
+    assert tiles_per_side([], (320, 320), 48, 4) == 4
+    assert tiles_per_side([], (320, 320), 48, 4, empty_tiles_per_side=2) == 2
+
+
+def test_refine_with_tiles_finds_objects_only_detected_at_tile_scale():
+    session = BrightRegionSession()
+    image = np.zeros((1200, 1200, 3), dtype=np.uint8)
+    image[300:360, 600:660] = 255
+    preprocessed = cv2.resize(image, session.input_size[::-1])[np.newaxis]
+
+    raw_results = detect_objects(session, predict_card_detection.CLASSES, preprocessed, 0.5)
+    assert raw_results == []
+
+    results = predict_card_detection.refine_with_tiles(session, image, raw_results)
+    assert len(results) > 0
+    for obj in results:
+        np.testing.assert_allclose(obj['bounding_box'], [0.25, 0.5, 0.3, 0.55], atol=0.01)
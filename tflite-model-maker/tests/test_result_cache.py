@@ -0,0 +1,33 @@
+import numpy as np
+
+from result_cache import ResultCache
+
+
+def _outputs(value):
+    return {'scores': np.full((1, 4), value, dtype=np.float32)}
+
+
+def test_put_evicts_least_recently_used_once_full(tmp_path):
+    with ResultCache(str(tmp_path / 'results.sqlite'), max_entries=16) as cache:
+        for i in range(16):
+            cache.put(str(i), _outputs(i))
+        assert cache.get('0') is not None
+        cache.put('16', _outputs(16))
+
+        assert cache._count() <= 16
+        assert cache.get('0') is not None
+        assert cache.get('1') is None
+        assert cache.get('16') is not None
+
+
+def test_hits_are_written_on_close(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    with ResultCache(path) as cache:
+        cache.put('a', _outputs(1))
+        last_used = cache._connection.execute('SELECT last_used FROM outputs').fetchone()[0]
+        np.testing.assert_array_equal(cache.get('a')['scores'], _outputs(1)['scores'])
+        assert cache._connection.execute('SELECT last_used FROM outputs').fetchone()[0] == last_used
+    cache.close()
+
+    with ResultCache(path) as cache:
+        assert cache._connection.execute('SELECT last_used FROM outputs').fetchone()[0] > last_used
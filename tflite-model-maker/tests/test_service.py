@@ -0,0 +1,78 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+
+import service
+from stubs import StubSession
+
+
+class StubRecognizer:
+    """Records the batches it gets, and fails the images that are completely black"""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def recognize_batch(self, images):
+        self.batch_sizes.append(len(images))
+        return [ValueError('black image') if not image.any() else {'cards': [], 'sets': [], 'mean': float(image.mean())}
+                for image in images]
+
+
+def _png(value):
+    return cv2.imencode('.png', np.full((8, 8, 3), value, dtype=np.uint8))[1].tobytes()
+
+
+async def _handle_concurrently(recognizer, bodies):
+    with ThreadPoolExecutor(1) as inference_executor, ThreadPoolExecutor(2) as decode_executor:
+        batcher = service.MicroBatcher(recognizer.recognize_batch, inference_executor, max_batch_size=8, window=0.5)
+        batcher.start()
+        recognition_service = service.RecognitionService(batcher, decode_executor)
+
+        async def handle(body):
+            try:
+                return await recognition_service.handle('POST', '/recognize', body)
+            except service.HttpError as e:
+                return e.status, str(e)
+
+        try:
+            return await asyncio.gather(*(handle(body) for body in bodies))
+        finally:
+            await batcher.stop()
+
+
+def test_concurrent_requests_are_coalesced_and_fail_individually():
+    recognizer = StubRecognizer()
+    responses = asyncio.run(_handle_concurrently(recognizer, [_png(100), _png(0), _png(200)]))
+
+    assert recognizer.batch_sizes == [3]
+    assert responses[0] == (200, {'cards': [], 'sets': [], 'mean': 100.0})
+    assert responses[1][0] == 500 and 'black image' in responses[1][1]
+    assert responses[2] == (200, {'cards': [], 'sets': [], 'mean': 200.0})
+
+
+def test_a_failing_batch_fails_all_its_requests():
+    class FailingRecognizer(StubRecognizer):
+        def recognize_batch(self, images):
+            super().recognize_batch(images)
+            raise RuntimeError('model crashed')
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(_handle_concurrently(FailingRecognizer(), [_png(100), _png(200)]))
+
+
+def test_recognizer_isolates_an_image_that_fails():
+    recognizer = service.Recognizer.__new__(service.Recognizer)
+    recognizer.card_session = StubSession()
+    recognizer.shape_session = StubSession(input_size=(64, 64), grid=(1, 1))
+    images = [np.full((240, 320, 3), 200, dtype=np.uint8), np.zeros((0, 0, 3), dtype=np.uint8),
+              np.full((240, 320, 3), 100, dtype=np.uint8)]
+
+    responses = recognizer.recognize_batch(images)
+
+    assert isinstance(responses[1], Exception)
+    for response in (responses[0], responses[2]):
+        assert set(response) == {'cards', 'sets', 'batch_size', 'timings_ms'}
+        assert response['batch_size'] == 3
@@ -0,0 +1,40 @@
+from card_model import Card
+from tracking import CardTracker
+
+BOX = [0.1, 0.1, 0.4, 0.3]
+
+
+def _detections(*boxes):
+    return [{'bounding_box': box, 'score': 0.9} for box in boxes]
+
+
+def test_failed_recognition_is_retried_while_the_card_does_not_move():
+    tracker = CardTracker()
+    tracker.update(_detections(BOX))
+    track = tracker.tracks[0]
+
+    track.recognized(None)
+    assert track.card is None
+    tracker.update(_detections(BOX))
+    assert track.needs_recognition
+
+    card = Card.from_short('rof2')
+    track.recognized(card)
+    assert track.card is card
+    tracker.update(_detections(BOX))
+    assert not track.needs_recognition
+
+
+def test_failed_re_recognition_keeps_the_previous_card():
+    tracker = CardTracker()
+    tracker.update(_detections(BOX))
+    track = tracker.tracks[0]
+    card = Card.from_short('gwe3')
+    track.recognized(card)
+
+    # The card moved, so it is recognized again, which fails
+    assert tracker.update(_detections([0.15, 0.1, 0.45, 0.3]))
+    assert track.needs_recognition
+    track.recognized(None)
+    assert track.card is card
+    assert track.needs_recognition
@@ -0,0 +1,111 @@
+from predict_utils import calculate_overlap
+
+
+def box_similarity(box1, box2):
+    """
+    Returns how well two [ymin, xmin, ymax, xmax] boxes match, between 0 and 1.
+
+    This is the smallest of the two overlap ratios (see `calculate_overlap`), i.e. the intersection relative to the
+    larger of the two boxes. Like IoU, it is only close to 1 when the boxes nearly coincide.
+    """
+    return min(calculate_overlap(box1, box2), calculate_overlap(box2, box1))
+
+
+class Track:
+    """A card followed across frames"""
+
+    def __init__(self, track_id: int, box, score):
+        self.track_id = track_id
+        self.box = box
+        self.score = score
+        self.card = None
+        # The box at the time the card was last recognized, or None if it has to be (re)recognized
+        self.recognized_box = None
+        self.missed = 0
+
+    @property
+    def needs_recognition(self):
+        return self.recognized_box is None
+
+    def recognized(self, card):
+        """
+        Records the card recognized at the current box. If it could not be recognized (None), e.g. in a blurred frame,
+        the track keeps its previous card and is recognized again on the next detection pass.
+        """
+        if card is None:
+            return
+        self.card = card
+        self.recognized_box = self.box
+
+
+class CardTracker:
+    """
+    Associates the card detections of consecutive frames, so that cards only have to be recognized again when they
+    are new or have moved.
+    """
+
+    def __init__(self, match_threshold: float = 0.5, moved_threshold: float = 0.9, max_missed: int = 2):
+        """
+        Args:
+            match_threshold (float): Minimum `box_similarity` for a detection to be associated with a track.
+            moved_threshold (float): A card whose box has a `box_similarity` below this with the box it was recognized
+                                     at has moved, and needs to be recognized again.
+            max_missed (int): Number of consecutive detection passes a track may go undetected before it is dropped.
+        """
+        self.match_threshold = match_threshold
+        self.moved_threshold = moved_threshold
+        self.max_missed = max_missed
+        self.tracks = []
+        self._next_id = 0
+
+    def update(self, detections):
+        """
+        Updates the tracks with the detections of a new frame.
+
+        Args:
+            detections (list): Detection results, each a dict with a 'bounding_box' and a 'score'.
+
+        Returns:
+            bool: Whether anything changed, i.e. a card appeared, disappeared or moved.
+        """
+        # Greedily associate the most similar (track, detection) pairs first
+        pairs = []
+        for t, track in enumerate(self.tracks):
+            for d, detection in enumerate(detections):
+                similarity = box_similarity(track.box, detection['bounding_box'])
+                if similarity >= self.match_threshold:
+                    pairs.append((similarity, t, d))
+        pairs.sort(key=lambda pair: pair[0], reverse=True)
+
+        changed = False
+        matched_tracks = set()
+        matched_detections = set()
+        for _, t, d in pairs:
+            if t in matched_tracks or d in matched_detections:
+                continue
+            matched_tracks.add(t)
+            matched_detections.add(d)
+            track = self.tracks[t]
+            track.box = detections[d]['bounding_box']
+            track.score = detections[d]['score']
+            track.missed = 0
+            if track.recognized_box is not None and \
+                    box_similarity(track.box, track.recognized_box) < self.moved_threshold:
+                track.recognized_box = None
+                changed = True
+
+        tracks = []
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    changed = True
+                    continue
+            tracks.append(track)
+        for d, detection in enumerate(detections):
+            if d not in matched_detections:
+                tracks.append(Track(self._next_id, detection['bounding_box'], detection['score']))
+                self._next_id += 1
+                changed = True
+        self.tracks = tracks
+        return changed
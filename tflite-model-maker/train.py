@@ -0,0 +1,304 @@
+"""
+Trains object detection models from a config file, optionally sweeping over model specs, batch sizes and epochs.
+
+Every combination is a trial, trained in its own process (several in parallel with `--parallel`). A trial trains in
+rounds of `eval_every` epochs, evaluates the COCO AP on the validation split after each round, and stops early when the
+AP did not improve for `patience` rounds, keeping the best weights. The model and its optimizer are compiled once, and
+every round continues where the previous one stopped, so the learning rate schedule (warmup and decay over all epochs)
+and the optimizer state are the same as when training all epochs at once. The model is then exported as every
+quantization variant in `variants` (see `export_variants`) to `<output_dir>/<name>/<trial>/`, with a `metrics.json`
+holding their evaluation metrics. When all trials are done, the inference latency of every exported model is measured
+one after the other, so the trials do not compete for the CPU. With `recognition_images`, the cards recognized with each
+quantized variant are compared against its float32 variant. A summary of all models is written next to the trials.
+
+Example config (keys that are left out take the value from `DEFAULT_CONFIG`):
+    {
+        "name": "cards",
+        "data_dir": "data-cards",
+        "label_map": ["card"],
+        "specs": ["efficientdet_lite0", "efficientdet_lite1"],
+        "batch_sizes": [8, 16],
+        "epochs": [50]
+    }
+
+Usage:
+    python train.py cards.json --parallel 2
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import time
+
+import export_variants
+
+DEFAULT_CONFIG = {
+    'name': None,  # Name of the sweep, the trials are written to <output_dir>/<name>
+    'data_dir': None,  # Directory containing images and Annotations
+    'label_map': None,
+    'tflite_filename': 'model.tflite',
+    'split_fraction': 0.8,
+    'split_seed': 0,
+    'specs': ['efficientdet_lite0'],
+    'batch_sizes': [8],
+    'epochs': [50],  # Maximum number of epochs
+    'eval_every': 5,  # Number of epochs per round, after which the validation AP is checked
+    'patience': 2,  # Number of rounds without improvement of the validation AP before stopping
+    'train_whole_model': True,
+    'output_dir': 'runs',
+    'latency_images': 20,  # Number of validation images to measure the inference latency on
+    'latency_repeat': 5,
+    'num_threads': None,  # Number of threads of the interpreter when measuring latency, like in production
+    'variants': ['float32', 'float16', 'dynamic', 'int8'],  # Quantization variants to export, see export_variants
+    'role': None,  # 'card' or 'shape': the model the variants replace, to compare the recognized cards with
+    'recognition_images': None,  # Directory of table images to compare the recognized cards of the variants on
+    'recognition_limit': 50,
+    'validation_cards': None,  # For shape models, directory of card images to run the validator on
+    'promote': False,  # Copy the best model of promote_variant to tflite_filename in the working directory
+    'promote_variant': 'int8',  # Matches the default (full integer) quantization of model maker
+}
+
+
+def load_config(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return resolve_config(config)
+
+
+def resolve_config(config: dict) -> dict:
+    """Fills in the defaults and checks the config"""
+    unknown = set(config) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f'Invalid config keys [{", ".join(sorted(unknown))}]')
+    config = {**DEFAULT_CONFIG, **config}
+    for key in ('name', 'data_dir', 'label_map'):
+        if config[key] is None:
+            raise ValueError(f'Missing config key [{key}]')
+    return config
+
+
+def trials(config: dict) -> list:
+    """Returns the trials of a config: one dict with a spec, batch size and number of epochs per combination"""
+    return [
+        {'trial': f'{spec}-b{batch_size}-e{epochs}', 'spec': spec, 'batch_size': batch_size, 'epochs': epochs}
+        for spec, batch_size, epochs in itertools.product(config['specs'], config['batch_sizes'], config['epochs'])
+    ]
+
+
+def _load_data(config: dict):
+    import dataset_cache
+    from train_utils import split, read_index
+
+    data_dir = config['data_dir']
+    split_dir = f'{data_dir}/split'
+    split(f'{data_dir}/images', f'{data_dir}/Annotations', target_dir=split_dir, fraction=config['split_fraction'],
+          seed=config['split_seed'], mode='index')
+    train_data = dataset_cache.load(
+        images_dir=f'{data_dir}/images',
+        annotations_dir=f'{data_dir}/Annotations',
+        label_map=config['label_map'],
+        annotation_filenames=read_index(f'{split_dir}/train.txt'),
+    )
+    validation_data = dataset_cache.load(
+        images_dir=f'{data_dir}/images',
+        annotations_dir=f'{data_dir}/Annotations',
+        label_map=config['label_map'],
+        annotation_filenames=read_index(f'{split_dir}/test.txt'),
+        num_shards=1,
+    )
+    return train_data, validation_data
+
+
+def _train_round(detector, train_data, validation_data, trained_epochs, epochs, batch_size):
+    """
+    Trains the model for a number of epochs after `trained_epochs`.
+
+    The first round creates and compiles the model through `detector.train`. Later rounds continue fitting the compiled
+    model the way `detector.train` fits it, with the same validation data and callbacks: unlike `detector.train`, which
+    recreates the model and its optimizer, this keeps the weights, the optimizer state and the step count the learning
+    rate schedule depends on.
+    """
+    if batch_size > train_data.size or batch_size > validation_data.size:
+        raise ValueError(f'Invalid batch size [{batch_size}], the train and validation data have '
+                         f'{train_data.size} and {validation_data.size} images')
+    if trained_epochs == 0:
+        detector.train(train_data, validation_data, epochs=epochs, batch_size=batch_size)
+        return
+    from tensorflow_examples.lite.model_maker.third_party.efficientdet.keras import train_lib
+
+    with detector.model_spec.ds_strategy.scope():
+        train_ds = train_data.gen_dataset(detector.model_spec, batch_size, is_training=True)
+        validation_ds = validation_data.gen_dataset(detector.model_spec, batch_size, is_training=False)
+        detector.model.fit(train_ds, initial_epoch=trained_epochs, epochs=trained_epochs + epochs,
+                           steps_per_epoch=max(1, train_data.size // batch_size),
+                           callbacks=train_lib.get_callbacks(detector.model_spec.config.as_dict(), validation_ds),
+                           validation_data=validation_ds,
+                           validation_steps=max(1, validation_data.size // batch_size))
+
+
+def run_trial(config: dict, trial: dict, threads: int = None) -> dict:
+    """
+    Trains, evaluates and exports the model of a single trial.
+
+    Returns:
+        dict: The trial with its training history and evaluation metrics, and the path and metrics of every exported
+              variant.
+    """
+    import tensorflow as tf
+    assert tf.__version__.startswith('2')
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+    tf.get_logger().setLevel('ERROR')
+    from absl import logging
+    logging.set_verbosity(logging.ERROR)
+    from tflite_model_maker import model_spec
+    from tflite_model_maker import object_detector
+
+    trial_dir = os.path.join(config['output_dir'], config['name'], trial['trial'])
+    os.makedirs(trial_dir, exist_ok=True)
+    train_data, validation_data = _load_data(config)
+
+    spec = model_spec.get(trial['spec'])
+    # The learning rate schedule is set up for this many epochs when the model is compiled in the first round
+    spec.config.num_epochs = trial['epochs']
+    detector = object_detector.create(
+        train_data,
+        model_spec=spec,
+        batch_size=trial['batch_size'],
+        train_whole_model=config['train_whole_model'],
+        validation_data=validation_data,
+        epochs=trial['epochs'],
+        do_train=False,
+    )
+
+    start = time.perf_counter()
+    history = []
+    best_ap, best_weights, best_epochs, stale_rounds = -1.0, None, 0, 0
+    trained_epochs = 0
+    while trained_epochs < trial['epochs'] and stale_rounds < config['patience']:
+        epochs = min(config['eval_every'], trial['epochs'] - trained_epochs)
+        _train_round(detector, train_data, validation_data, trained_epochs, epochs, trial['batch_size'])
+        trained_epochs += epochs
+        ap = float(detector.evaluate(validation_data, batch_size=trial['batch_size'])['AP'])
+        history.append({'epochs': trained_epochs, 'AP': ap})
+        print(f'[{trial["trial"]}] {trained_epochs} epochs: AP {ap:.4f}')
+        if ap > best_ap:
+            best_ap, best_weights, best_epochs, stale_rounds = ap, detector.model.get_weights(), trained_epochs, 0
+        else:
+            stale_rounds += 1
+    detector.model.set_weights(best_weights)
+    training_seconds = time.perf_counter() - start
+
+    model_paths = export_variants.export(detector, trial_dir, config['tflite_filename'], config['variants'],
+                                         representative_data=train_data)
+    metrics = {
+        **trial,
+        'epochs_trained': trained_epochs,
+        'best_epochs': best_epochs,
+        'stopped_early': trained_epochs < trial['epochs'],
+        'training_seconds': round(training_seconds, 1),
+        'history': history,
+        'eval': {name: float(value) for name, value in detector.evaluate(validation_data).items()},
+        'variants': {
+            variant: {
+                'model_path': model_path,
+                'model_bytes': os.path.getsize(model_path),
+                'eval_tflite': {name: float(value) for name, value in
+                                detector.evaluate_tflite(model_path, validation_data).items()},
+            }
+            for variant, model_path in model_paths.items()
+        },
+    }
+    _write_json(os.path.join(trial_dir, 'metrics.json'), metrics)
+    return metrics
+
+
+def _run_trial(job):
+    return run_trial(*job)
+
+
+def measure_latency(config: dict, model_path: str) -> dict:
+    """Measures the inference latency (preprocessing excluded) of a model on the validation images"""
+    from benchmark import measure
+    from model_session import ModelSession
+    from predict_utils import preprocess_image, detect_objects
+    from train_utils import read_index
+
+    session = ModelSession(model_path, config['num_threads'])
+    names = read_index(f'{config["data_dir"]}/split/test.txt')[:config['latency_images']]
+    images = [preprocess_image(f'{config["data_dir"]}/images/{name}.jpg', session.input_size)[0] for name in names]
+    return measure(lambda image: detect_objects(session, config['label_map'], image, 0.0), images,
+                   config['latency_repeat'])
+
+
+def _write_json(path: str, value):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(value, f, indent=2)
+
+
+def run(config: dict, parallel: int = 1) -> list:
+    """
+    Runs all trials of a config, then measures the latency of the exported models and, if configured, compares the
+    cards recognized with each quantized variant against its float32 variant.
+
+    Args:
+        config (dict): The config, see `DEFAULT_CONFIG`.
+        parallel (int): Number of trials to train at the same time. The CPU threads are divided between them.
+
+    Returns:
+        list: The metrics of every exported model (one per trial and variant), best validation AP first.
+    """
+    config = resolve_config(config)
+    jobs = trials(config)
+    print(f'Running {len(jobs)} trials of {config["name"]}, {parallel} at a time')
+    if parallel > 1 and len(jobs) > 1:
+        threads = max(1, (os.cpu_count() or 1) // parallel)
+        # TensorFlow is not fork safe, so every trial runs in a fresh interpreter
+        with multiprocessing.get_context('spawn').Pool(parallel, maxtasksperchild=1) as pool:
+            results = list(pool.imap_unordered(_run_trial, [(config, trial, threads) for trial in jobs]))
+    else:
+        results = [run_trial(config, trial) for trial in jobs]
+
+    recognition_images = export_variants.image_paths(config['recognition_images'], config['recognition_limit']) \
+        if config['recognition_images'] else None
+    rows = []
+    for metrics in results:
+        variants = metrics['variants']
+        for variant, variant_metrics in variants.items():
+            variant_metrics['latency'] = measure_latency(config, variant_metrics['model_path'])
+            if recognition_images and 'float32' in variants and variant != 'float32':
+                variant_metrics['recognition'] = export_variants.check_variant(
+                    config['role'], variant_metrics['model_path'], variants['float32']['model_path'],
+                    recognition_images, config['validation_cards'])
+            rows.append({'trial': metrics['trial'], 'variant': variant, **variant_metrics})
+        _write_json(os.path.join(config['output_dir'], config['name'], metrics['trial'], 'metrics.json'), metrics)
+
+    rows.sort(key=lambda row: row['eval_tflite']['AP'], reverse=True)
+    _write_json(os.path.join(config['output_dir'], config['name'], 'summary.json'), rows)
+    print(f'{"trial":36} {"variant":8} {"AP tflite":>10} {"p50 ms":>8} {"p95 ms":>8} {"MB":>6} {"same cards":>11}')
+    for row in rows:
+        recognition = row.get('recognition')
+        same_cards = f'{recognition["identical"]}/{recognition["images"]}' if recognition else '-'
+        print(f'{row["trial"]:36} {row["variant"]:8} {row["eval_tflite"]["AP"]:10.4f} '
+              f'{row["latency"]["p50_ms"]:8.2f} {row["latency"]["p95_ms"]:8.2f} {row["model_bytes"] / 1e6:6.2f} '
+              f'{same_cards:>11}')
+
+    if config['promote']:
+        best = next((row for row in rows if row['variant'] == config['promote_variant']), None)
+        if best is None:
+            raise ValueError(f'Invalid promote_variant [{config["promote_variant"]}], it was not exported')
+        shutil.copyfile(best['model_path'], config['tflite_filename'])
+        print(f'Copied {best["model_path"]} to {config["tflite_filename"]}')
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train object detection models from a config file.')
+    parser.add_argument('config', help='a JSON config file')
+    parser.add_argument('--parallel', type=int, default=1, help='number of trials to train at the same time '
+                                                                '(default: 1)')
+    args = parser.parse_args()
+    run(load_config(args.config), args.parallel)
@@ -1,26 +1,135 @@
-def split(images_dir, annotations_dir, target_dir, fraction):
-    train_dir = f'{target_dir}/train'
-    test_dir = f'{target_dir}/test'
-    if os.path.exists(train_dir) or os.path.exists(test_dir):
+import os
+import random
+import shutil
+from collections import Counter, defaultdict
+
+import voc
+
+SPLIT_MODES = ('symlink', 'index', 'copy')
+
+
+def _stratification_groups(images_dir, annotations_dir):
+    """
+    Groups the annotated images by their rarest label, reading every annotation once.
+
+    Returns:
+        dict: The image names (sorted) per label. Images without objects are grouped under None.
+    """
+    image_labels = {}
+    for image_name in sorted(os.listdir(images_dir)):
+        annotation_path = os.path.join(annotations_dir, f'{os.path.splitext(image_name)[0]}.xml')
+        if not os.path.exists(annotation_path):
+            print(f'No annotation for {image_name}, skipping')
+            continue
+        image_labels[image_name] = set(voc.labels(annotation_path))
+
+    # Images with several labels are stratified on their rarest label, so that rare classes are spread evenly
+    label_counts = Counter(label for labels in image_labels.values() for label in labels)
+    groups = defaultdict(list)
+    for image_name, labels in image_labels.items():
+        key = min(labels, key=lambda label: (label_counts[label], label)) if labels else None
+        groups[key].append(image_name)
+    return groups
+
+
+def _assign(groups, fraction, folds, seed):
+    """Returns the image names per subset ('train'/'test', or 'fold-{i}/train'/'fold-{i}/test')"""
+    rng = random.Random(seed)
+    if folds is None:
+        subsets = {'train': [], 'test': []}
+        for key in sorted(groups, key=str):
+            image_names = list(groups[key])
+            rng.shuffle(image_names)
+            threshold = int(round(len(image_names) * fraction))
+            subsets['train'] += image_names[:threshold]
+            subsets['test'] += image_names[threshold:]
+        return subsets
+
+    fold_images = [[] for _ in range(folds)]
+    offset = 0
+    for key in sorted(groups, key=str):
+        image_names = list(groups[key])
+        rng.shuffle(image_names)
+        # Continue dealing where the previous group stopped, so the folds stay the same size
+        for i, image_name in enumerate(image_names):
+            fold_images[(offset + i) % folds].append(image_name)
+        offset = (offset + len(image_names)) % folds
+    subsets = {}
+    for fold in range(folds):
+        subsets[f'fold-{fold}/train'] = [name for other, images in enumerate(fold_images) if other != fold
+                                         for name in images]
+        subsets[f'fold-{fold}/test'] = fold_images[fold]
+    return subsets
+
+
+def _write_subset(images_dir, annotations_dir, subset_dir, image_names, mode):
+    subset_images = f'{subset_dir}/images'
+    subset_annotations = f'{subset_dir}/Annotations'
+    os.makedirs(subset_images, exist_ok=True)
+    os.makedirs(subset_annotations, exist_ok=True)
+    for image_name in image_names:
+        annotation_name = f'{os.path.splitext(image_name)[0]}.xml'
+        for source_dir, dest_dir, name in ((images_dir, subset_images, image_name),
+                                           (annotations_dir, subset_annotations, annotation_name)):
+            source = os.path.join(source_dir, name)
+            if mode == 'copy':
+                shutil.copy(source, dest_dir)
+            else:
+                os.symlink(os.path.relpath(source, dest_dir), os.path.join(dest_dir, name))
+
+
+def read_index(index_path):
+    """
+    Reads an index file written by `split` with mode 'index'.
+
+    Returns:
+        list: The annotation filenames without extension, as expected by the `annotation_filenames` argument of
+              `object_detector.DataLoader.from_pascal_voc`.
+    """
+    with open(index_path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def split(images_dir, annotations_dir, target_dir, fraction, seed=0, folds=None, mode='symlink'):
+    """
+    Splits a Pascal VOC dataset into a train and a test set, stratified by label.
+
+    The split only depends on the seed and the set of images, so it can be reproduced. Images are stratified on their
+    rarest label, so every label is split in (roughly) the given fraction.
+
+    Args:
+        images_dir (str): The directory of images.
+        annotations_dir (str): The directory of annotations, named like the images with an .xml extension.
+        target_dir (str): The directory to write the split to.
+        fraction (float): The fraction of images to put in the train set. Ignored with `folds`.
+        seed (int): The seed of the shuffle.
+        folds (int): If given, writes this many folds for k-fold cross validation instead: each fold is used as the
+                     test set once, with the other folds as train set.
+        mode (str): 'symlink' writes images/ and Annotations/ directories per subset (e.g. train/images) with
+                    symbolic links to the original files, 'index' writes a text file per subset (e.g. train.txt) with
+                    the annotation names (see `read_index`), and 'copy' copies the files.
+
+    Returns:
+        dict: The image names per subset, or None if the target directory already contains a split.
+    """
+    if mode not in SPLIT_MODES:
+        raise ValueError(f'Invalid split mode [{mode}]')
+    if folds is not None and folds < 2:
+        raise ValueError(f'Invalid number of folds [{folds}]')
+
+    subset_names = ['train', 'test'] if folds is None else ['fold-0/train', 'fold-0/test']
+    existing = [f'{target_dir}/{name}.txt' if mode == 'index' else f'{target_dir}/{name}' for name in subset_names]
+    if any(os.path.exists(path) for path in existing):
         print("Target directory already exists, not splitting")
-        return
-    train_images = f'{train_dir}/images'
-    train_annotations = f'{train_dir}/Annotations'
-    os.makedirs(train_images, exist_ok=True)
-    os.makedirs(train_annotations, exist_ok=True)
-    test_images = f'{test_dir}/images'
-    test_annotations = f'{test_dir}/Annotations'
-    os.makedirs(test_images, exist_ok=True)
-    os.makedirs(test_annotations, exist_ok=True)
-
-    image_paths = os.listdir(images_dir)
-    random.shuffle(image_paths)
-
-    threshold = int(len(image_paths) * fraction)
-    for i, image_path in enumerate(image_paths):
-        if i < threshold:
-            shutil.copy(f'{images_dir}/{image_path}', train_images)
-            shutil.copy(f'{annotations_dir}/{image_path.replace("jpg", "xml")}', train_annotations)
+        return None
+
+    subsets = _assign(_stratification_groups(images_dir, annotations_dir), fraction, folds, seed)
+    for name, image_names in subsets.items():
+        if mode == 'index':
+            index_path = f'{target_dir}/{name}.txt'
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            with open(index_path, 'w', encoding='utf-8') as f:
+                f.writelines(f'{os.path.splitext(image_name)[0]}\n' for image_name in image_names)
         else:
-            shutil.copy(f'{images_dir}/{image_path}', test_images)
-            shutil.copy(f'{annotations_dir}/{image_path.replace("jpg", "xml")}', test_annotations)
+            _write_subset(images_dir, annotations_dir, f'{target_dir}/{name}', image_names, mode)
+    return subsets
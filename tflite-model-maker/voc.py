@@ -0,0 +1,73 @@
+"""
+Reading and writing Pascal VOC annotations, the format Label Studio exports and tflite_model_maker trains on.
+"""
+import os
+import xml.etree.ElementTree as ET
+
+
+def parse_annotation(annotation_path):
+    """
+    Parses a Pascal VOC annotation file.
+
+    Returns:
+        dict: The 'filename', 'width' and 'height' of the annotated image, and its 'objects', each a dict with a
+              'label' and a 'box' of absolute (xmin, ymin, xmax, ymax) coordinates.
+    """
+    root = ET.parse(annotation_path).getroot()
+    size = root.find('size')
+    objects = []
+    for obj in root.iter('object'):
+        box = obj.find('bndbox')
+        objects.append({
+            'label': obj.findtext('name'),
+            'box': tuple(float(box.findtext(name)) for name in ('xmin', 'ymin', 'xmax', 'ymax')),
+        })
+    return {
+        'filename': root.findtext('filename'),
+        'width': int(size.findtext('width')) if size is not None else None,
+        'height': int(size.findtext('height')) if size is not None else None,
+        'objects': objects,
+    }
+
+
+def labels(annotation_path):
+    """Returns the labels of the objects in a Pascal VOC annotation file, without parsing the rest"""
+    return [name.text for name in ET.parse(annotation_path).getroot().iterfind('object/name')]
+
+
+def write_annotation(annotation_path, filename, width, height, objects):
+    """
+    Writes a Pascal VOC annotation file, in the layout Label Studio exports.
+
+    The annotation is written to a temporary file next to it first, which then replaces it, so an interrupted write
+    never leaves a truncated annotation behind.
+
+    Args:
+        annotation_path (str): The annotation file to write.
+        filename (str): The filename of the annotated image.
+        width (int): The width of the image.
+        height (int): The height of the image.
+        objects (list): The objects, each a dict with a 'label' and a 'box' of absolute (xmin, ymin, xmax, ymax)
+                        coordinates, like `parse_annotation` returns them.
+    """
+    root = ET.Element('annotation')
+    ET.SubElement(root, 'folder').text = 'images'
+    ET.SubElement(root, 'filename').text = filename
+    size = ET.SubElement(root, 'size')
+    ET.SubElement(size, 'width').text = str(width)
+    ET.SubElement(size, 'height').text = str(height)
+    ET.SubElement(size, 'depth').text = '3'
+    for obj in objects:
+        element = ET.SubElement(root, 'object')
+        ET.SubElement(element, 'name').text = obj['label']
+        ET.SubElement(element, 'pose').text = 'Unspecified'
+        ET.SubElement(element, 'truncated').text = '0'
+        ET.SubElement(element, 'difficult').text = '0'
+        box = ET.SubElement(element, 'bndbox')
+        for name, value in zip(('xmin', 'ymin', 'xmax', 'ymax'), obj['box']):
+            ET.SubElement(box, name).text = str(int(round(value)))
+    tree = ET.ElementTree(root)
+    ET.indent(tree)
+    temporary_path = f'{annotation_path}.partial'
+    tree.write(temporary_path, encoding='utf-8', xml_declaration=False)
+    os.replace(temporary_path, annotation_path)